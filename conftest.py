@@ -9,11 +9,15 @@ def pytest_addoption(parser):
     parser.addoption(
         "--skip-integration", action="store_true", default=False, help="skip integration tests"
     )
+    parser.addoption(
+        "--run-benchmark", action="store_true", default=False, help="run benchmark tests"
+    )
 
 
 def pytest_configure(config):
     config.addinivalue_line("markers", "slow: mark test as slow to run")
     config.addinivalue_line("markers", "integration: mark test as integration to run")
+    config.addinivalue_line("markers", "benchmark: mark test as benchmark to run on demand")
 
 def pytest_collection_modifyitems(config, items):
     if config.getoption("--skip-slow"):
@@ -25,4 +29,9 @@ def pytest_collection_modifyitems(config, items):
         skip_integration = pytest.mark.skip(reason="you need to remove --skip-integration option to run")
         for item in items:
             if "integration" in item.keywords:
-                item.add_marker(skip_integration)
\ No newline at end of file
+                item.add_marker(skip_integration)
+    if not config.getoption("--run-benchmark"):
+        skip_benchmark = pytest.mark.skip(reason="you need to add --run-benchmark option to run")
+        for item in items:
+            if "benchmark" in item.keywords:
+                item.add_marker(skip_benchmark)
\ No newline at end of file
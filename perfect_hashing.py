@@ -1,11 +1,14 @@
-from typing import List
+from typing import Callable, List, NamedTuple
 import array
 import struct
+import sys
+from random import randrange
 
 # https://docs.python.org/2/library/sys.html#sys.maxint
 LONG_SIZE_IN_BYTES = struct.calcsize('l')
 MIN_INT = -2 ** (8 * LONG_SIZE_IN_BYTES - 1)
 MAX_TRIALS = 4
+HUGE_PRIME_NUMBER = 2147483647
 
 
 class HashError(Exception):
@@ -20,6 +23,15 @@ class PerfectHashSecondLevelError(HashError):
     pass
 
 
+class PerfectHashStatistics(NamedTuple):
+    """Statistics of HashTablePerfect build"""
+    first_level_trials: int
+    hash_function_counter: int
+    max_hash_function_counter_per_bucket: int
+    slots_count: int
+    memory_size: int
+
+
 class HashTableChain:
     __slots__ = ("hash_function", "collection_size", "counts", "hash_table")
 
@@ -29,21 +41,37 @@ class HashTableChain:
         self.fill_hash_table(collection)
 
     def fill_hash_table(self, collection: List[int]):
-        # TODO: implement me and use array.array
-        pass
+        """Adding all elements to HashTable with chain solution for collision"""
+        self.counts = array.array('l', [0] * self.collection_size)
+        self.hash_table = [None] * self.collection_size
+        for element in collection:
+            key = self.hash_function(element) % self.collection_size
+            if self.counts[key] == 0:
+                self.hash_table[key] = array.array('l', [element])
+            else:
+                self.hash_table[key].append(element)
+            self.counts[key] += 1
 
     def __contains__(self, item) -> bool:
-        # TODO: implement me
-        pass
+        """checking by key, then checking the whole chain if exists"""
+        if self.collection_size == 0:
+            return False
+        key = self.hash_function(item) % self.collection_size
+        return self.counts[key] > 0 and item in self.hash_table[key]
 
 
 class HashTablePerfect:
-    """build static hash table with < 4n memory space with universal hash family"""
+    """build static hash table with < 4n memory space with universal hash family
+
+    Only the first level is rebuilt when the memory bound is exceeded. Second
+    level functions are drawn per bucket, and a collision makes only the
+    colliding bucket draw a new one.
+    """
     __slots__ = (
         "hash_first_level", "hash_second_level",
         "hash_function_counter", "hash_function_counter_per_bucket",
         "max_trials_first_level", "max_hash_function_counter",
-        "collection_size", "counts", "hash_table",
+        "collection_size", "counts", "hash_table", "first_level_trials",
     )
 
     def __init__(self, collection: List[int], max_trials_first_level=MAX_TRIALS, max_hash_function_counter=None):
@@ -54,12 +82,16 @@ class HashTablePerfect:
         self.counts = array.array('l', [])
         self.hash_function_counter = 0
         self.hash_function_counter_per_bucket = array.array('l', [])
+        self.first_level_trials = 0
+        self.hash_table = []
 
-        self.fill_hash_table(collection)
+        if self.collection_size:
+            self.fill_hash_table(collection)
 
     def fill_hash_table(self, collection: List[int]):
         for _ in range(self.max_trials_first_level):
-            self.hash_first_level = self.generate_new_hash_function()
+            self.first_level_trials += 1
+            self.hash_first_level = self.generate_new_hash_function(self.collection_size)
             self.hash_second_level = [hash] * self.collection_size
             self._fill_first_level_counts(collection)
             if self._is_big_memory_consumption():
@@ -70,36 +102,73 @@ class HashTablePerfect:
 
         raise PerfectHashFirstLevelError("cannot build perfect hash table within %s trials" % self.max_trials_first_level)
 
-    def generate_new_hash_function(self):
-        # TODO: implement me
-        hash_function = lambda item: 0
+    def generate_new_hash_function(self, size: int) -> Callable[[int], int]:
+        """Pick random function ((a * item + b) mod p) mod size from universal family"""
+        a, b = randrange(1, HUGE_PRIME_NUMBER), randrange(0, HUGE_PRIME_NUMBER)
+
+        def hash_function(item: int) -> int:
+            return ((a * item + b) % HUGE_PRIME_NUMBER) % size
 
         self.hash_function_counter += 1
-        if self.hash_function_counter >= self.max_hash_function_counter:
+        if self.hash_function_counter > self.max_hash_function_counter:
             raise PerfectHashSecondLevelError("cannot build perfect hash table with %s hash functions" % self.max_hash_function_counter)
 
         return hash_function
 
     def _fill_first_level_counts(self, collection: List[int]):
-        # TODO: implement me
         self.counts = array.array('l', [0] * self.collection_size)
+        for element in collection:
+            self.counts[self.hash_first_level(element)] += 1
 
     def _is_big_memory_consumption(self) -> bool:
-        # TODO: implement me
-        return True
+        return sum(bucket_size * bucket_size for bucket_size in self.counts) > 4 * self.collection_size
 
     def _fill_second_level(self, collection: List[int]):
         self.hash_table = []
         for _ in range(self.collection_size):
             self.hash_table.append(array.array('l', []))
 
-        # TODO: populate hash_function_counter_per_bucket
         self.hash_function_counter_per_bucket = array.array('l', [0] * self.collection_size)
-        # TODO: implement me
-        # you can use HashTableChain as temporary intermediate helper collection for buckets
-        # in this case, do not forget to specify correct hash_function for it
-        # hash_table_chain = HashTableChain(collection, hash_function=self.hash_first_level)
+        hash_table_chain = HashTableChain(collection, hash_function=self.hash_first_level)
+        for bucket_number, bucket in enumerate(hash_table_chain.hash_table):
+            if bucket is not None:
+                self._fill_bucket(bucket_number, bucket)
+
+    def _fill_bucket(self, bucket_number: int, bucket: array.array):
+        """Draw second-level functions for the bucket until its elements do not collide"""
+        table_size = self.counts[bucket_number] ** 2
+        while True:
+            hash_function = self.generate_new_hash_function(table_size)
+            self.hash_function_counter_per_bucket[bucket_number] += 1
+            table = array.array('l', [MIN_INT]) * table_size
+            for element in bucket:
+                key = hash_function(element)
+                if table[key] not in (MIN_INT, element):
+                    break
+                table[key] = element
+            else:
+                self.hash_second_level[bucket_number] = hash_function
+                self.hash_table[bucket_number] = table
+                return
+
+    @property
+    def statistics(self) -> PerfectHashStatistics:
+        """Trials of the first level, drawn hash functions and memory of the tables"""
+        memory_size = sys.getsizeof(self.counts) + sys.getsizeof(self.hash_function_counter_per_bucket)
+        memory_size += sys.getsizeof(self.hash_table) + sum(map(sys.getsizeof, self.hash_table))
+        return PerfectHashStatistics(
+            first_level_trials=self.first_level_trials,
+            hash_function_counter=self.hash_function_counter,
+            max_hash_function_counter_per_bucket=max(self.hash_function_counter_per_bucket, default=0),
+            slots_count=sum(map(len, self.hash_table)),
+            memory_size=memory_size,
+        )
 
     def __contains__(self, item) -> bool:
-        # TODO: implement me
-        return False
+        if self.collection_size == 0:
+            return False
+        bucket_number = self.hash_first_level(item)
+        table = self.hash_table[bucket_number]
+        if not table:
+            return False
+        return table[self.hash_second_level[bucket_number](item)] == item
@@ -1,8 +1,519 @@
-class StoragePolicy:
+"""Storage policies to dump and load inverted index (word -> postings mapping)
+
+Every policy is registered by name in STORAGE_POLICIES, so new formats can be
+added and benchmarked without changes in InvertedIndex.
+"""
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from struct import Struct, pack, unpack, unpack_from, calcsize
+from time import perf_counter
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, Mapping, NamedTuple, Optional, Sequence, Tuple, Type
+import json
+import mmap
+import os
+import pickle
+
+POSTINGS_TYPECODE = "I"
+MAPPED_INDEX_MAGIC = b"IIDX"
+MAPPED_INDEX_HEADER = Struct("=4sI")
+MAPPED_INDEX_ENTRY = Struct("=QIQI")
+COMPRESSED_BLOCK_SIZE = 128
+PERFECT_INDEX_MAGIC = b"PIDX"
+PERFECT_INDEX_HEADER = Struct("=4sIQQQ")
+PERFECT_INDEX_TYPECODE = "Q"
+
+STORAGE_POLICIES: Dict[str, Type[StoragePolicy]] = {}
+
+
+class StoragePolicyReport(NamedTuple):
+    """Measurements of one storage policy"""
+    name: str
+    dump_time: float
+    load_time: float
+    file_size: int
+
+
+def register_storage_policy(name: str):
+    """Class decorator adding storage policy to STORAGE_POLICIES
+
+    Policies are used as classes, so incomplete one is rejected right here
+    instead of failing at the first dump or load.
+    """
+    def register(policy: Type[StoragePolicy]) -> Type[StoragePolicy]:
+        if policy.__abstractmethods__:
+            raise TypeError(f"storage policy {name} does not implement {', '.join(sorted(policy.__abstractmethods__))}")
+        policy.name = name
+        STORAGE_POLICIES[name] = policy
+        return policy
+    return register
+
+
+class StoragePolicy(ABC):
+    """Interface of storage backend"""
+    name = None
+
     @staticmethod
-    def dump(word_to_docs_mapping, filepath: str):
-        pass
+    @abstractmethod
+    def dump(word_to_docs_mapping: Mapping[str, Iterable[int]], filepath: str) -> None:
+        """Save mapping into file"""
 
     @staticmethod
-    def load(filepath: str):
-        pass
+    @abstractmethod
+    def load(filepath: str) -> Mapping[str, Iterable[int]]:
+        """Load mapping from file"""
+
+    @classmethod
+    def measure(cls, word_to_docs_mapping: Mapping[str, Iterable[int]],
+                filepath: str) -> StoragePolicyReport:
+        """Dump and load mapping, report elapsed time and file size
+
+        Memory-mapped mappings are closed right after loading.
+        """
+        dump_start = perf_counter()
+        cls.dump(word_to_docs_mapping, filepath)
+        dump_time = perf_counter() - dump_start
+        load_start = perf_counter()
+        loaded_mapping = cls.load(filepath)
+        load_time = perf_counter() - load_start
+        if hasattr(loaded_mapping, "close"):
+            loaded_mapping.close()
+        return StoragePolicyReport(cls.name, dump_time, load_time, os.path.getsize(filepath))
+
+
+@register_storage_policy("json")
+class JsonStoragePolicy(StoragePolicy):
+    """Plain json dictionary"""
+    @staticmethod
+    def dump(word_to_docs_mapping, filepath):
+        with open(filepath, 'w') as fout:
+            json.dump(word_to_docs_mapping, fout, default=list)
+
+    @staticmethod
+    def load(filepath):
+        with open(filepath, 'r') as fin:
+            return json.load(fin)
+
+
+@register_storage_policy("struct")
+class StructStoragePolicy(StoragePolicy):
+    """Json header [word, postings count] and postings as unsigned shorts"""
+    @staticmethod
+    def dump(word_to_docs_mapping, filepath):
+        pairs, values = [], []
+
+        for key, value in word_to_docs_mapping.items():
+            pairs.append([key, len(value)])
+            values.extend(value)  # List[int]
+        header = json.dumps(pairs).encode()
+        meta = len(header)
+
+        with open(filepath, "wb") as fout:
+            fout.write(pack('I', meta))
+            fout.write(pack(f'{meta}s', header))
+            fout.write(pack(f'{len(values)}H', *values))
+
+    @staticmethod
+    def load(filepath):
+        with open(filepath, 'rb') as fin:
+            fileContent = fin.read()
+        meta_size = calcsize('I')
+        header_size, = unpack('I', fileContent[:meta_size])
+        header, = unpack(f'{header_size}s', fileContent[meta_size:(header_size+meta_size)])
+        pairs = json.loads(header.decode())
+        body_offset = header_size + meta_size
+        loaded_dict = {}
+        for pair in pairs:
+            uns_short_size = 2
+            loaded_dict[pair[0]] = list(unpack_from(f"{pair[1]}H", fileContent, body_offset))
+            body_offset += uns_short_size * pair[1]
+        return loaded_dict
+
+
+@register_storage_policy("pickle")
+class PickleStoragePolicy(StoragePolicy):
+    """Pickled dictionary of array('I') postings"""
+    @staticmethod
+    def dump(word_to_docs_mapping, filepath):
+        with open(filepath, "wb") as fout:
+            pickle.dump(
+                {word: array(POSTINGS_TYPECODE, postings) for word, postings in word_to_docs_mapping.items()},
+                fout, protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+    @staticmethod
+    def load(filepath):
+        with open(filepath, "rb") as fin:
+            return pickle.load(fin)
+
+
+def dump_mapped_index(index_as_dict: Mapping[str, Iterable[int]], filepath: str) -> None:
+    """Save index in the format readable by MappedPostings"""
+    with open(filepath, "wb") as fout:
+        write_mapped_index(index_as_dict, fout)
+
+
+def write_mapped_index(index_as_dict: Mapping[str, Iterable[int]], fout: BinaryIO,
+                       typecode: str = POSTINGS_TYPECODE) -> None:
+    """Write index readable by MappedPostings at the current position of the file
+
+    Layout: header (magic, words count), directory of fixed-size entries
+    (word offset, word length, postings offset, postings count) sorted by
+    utf-8 encoded word, words blob and postings blob aligned to the item size.
+    Offsets are relative to the start of the index, so it may be embedded
+    into another file at the position aligned to the item size as well.
+    """
+    itemsize = calcsize(typecode)
+    encoded_words = sorted((word.encode(), word) for word in index_as_dict)
+    directory_size = MAPPED_INDEX_HEADER.size + MAPPED_INDEX_ENTRY.size * len(encoded_words)
+    words_size = sum(len(encoded_word) for encoded_word, _ in encoded_words)
+    postings_start = directory_size + words_size
+    postings_start += -postings_start % itemsize
+
+    fout.write(MAPPED_INDEX_HEADER.pack(MAPPED_INDEX_MAGIC, len(encoded_words)))
+    word_offset, postings_offset = directory_size, postings_start
+    for encoded_word, word in encoded_words:
+        postings_count = len(index_as_dict[word])
+        fout.write(MAPPED_INDEX_ENTRY.pack(
+            word_offset, len(encoded_word), postings_offset, postings_count
+        ))
+        word_offset += len(encoded_word)
+        postings_offset += postings_count * itemsize
+    for encoded_word, _ in encoded_words:
+        fout.write(encoded_word)
+    fout.write(bytes(postings_start - directory_size - words_size))
+    for _, word in encoded_words:
+        array(typecode, index_as_dict[word]).tofile(fout)
+
+
+class MappedPostings(Mapping):
+    """Read-only word -> postings mapping over memory-mapped index file
+
+    Nothing is parsed at startup: words are found by binary search over the
+    sorted directory and postings are returned as zero-copy memoryview.
+    The index may start at some position of the file and hold items of any
+    array typecode, see write_mapped_index.
+    """
+    def __init__(self, filepath: str, typecode: str = POSTINGS_TYPECODE, start: int = 0):
+        """Map file into memory and check its header"""
+        with open(filepath, "rb") as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self._typecode, self._start = typecode, start
+        magic, self._words_count = MAPPED_INDEX_HEADER.unpack_from(self._mmap, start)
+        if magic != MAPPED_INDEX_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{filepath} is not a mapped inverted index")
+        self._view = memoryview(self._mmap)
+
+    def _entry(self, position: int) -> Tuple[int, int, int, int]:
+        """Read directory entry by its position, offsets are absolute"""
+        word_offset, word_length, postings_offset, postings_count = MAPPED_INDEX_ENTRY.unpack_from(
+            self._mmap, self._start + MAPPED_INDEX_HEADER.size + position * MAPPED_INDEX_ENTRY.size
+        )
+        return self._start + word_offset, word_length, self._start + postings_offset, postings_count
+
+    def _word(self, position: int) -> bytes:
+        """Read encoded word by its position in directory"""
+        word_offset, word_length, _, _ = self._entry(position)
+        return self._mmap[word_offset:word_offset + word_length]
+
+    def find(self, word: str) -> int:
+        """Binary search of the word, return its position in sorted directory"""
+        encoded_word = word.encode()
+        low, high = 0, self._words_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._word(middle) < encoded_word:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._words_count or self._word(low) != encoded_word:
+            raise KeyError(word)
+        return low
+
+    def __getitem__(self, word: str) -> memoryview:
+        """Zero-copy view of postings of the word"""
+        _, _, postings_offset, postings_count = self._entry(self.find(word))
+        postings_end = postings_offset + postings_count * calcsize(self._typecode)
+        return self._view[postings_offset:postings_end].cast(self._typecode)
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over words in sorted order"""
+        for position in range(self._words_count):
+            yield self._word(position).decode()
+
+    def __len__(self) -> int:
+        return self._words_count
+
+    def close(self) -> None:
+        """Unmap file, postings views returned before must be released"""
+        self._view.release()
+        self._mmap.close()
+
+def dump_perfect_index(index_as_dict: Mapping[str, Iterable[int]], filepath: str) -> None:
+    """Save index in the format readable by PerfectHashPostings
+
+    Layout: header (magic, words count, prime, first-level hash parameters),
+    bucket slot offsets (words count + 1 prefix sums), second-level hash
+    parameters (a, b) of every bucket, slots of the same entries as in mapped
+    index (empty slots have zero postings count), words blob and 4-byte
+    aligned postings blob. Words are hashed by stable_string_hash, distinct
+    words with the same hash are rejected by HashTablePerfect.
+    """
+    from task_Yaropolov_Oleg_perfect_hashing import HashTablePerfect, stable_string_hash
+
+    words = list(index_as_dict)
+    hash_table = HashTablePerfect(words, key_function=stable_string_hash)
+    offsets = array(PERFECT_INDEX_TYPECODE, hash_table.offsets)
+    slot_words = [None] * len(hash_table.slots)
+    for word in words:
+        slot_words[hash_table.slot_position(stable_string_hash(word))] = word
+
+    encoded_words = [None if word is None else word.encode() for word in slot_words]
+    slots_start = (PERFECT_INDEX_HEADER.size
+                   + calcsize(PERFECT_INDEX_TYPECODE) * (len(offsets) + 2 * len(words)))
+    words_start = slots_start + MAPPED_INDEX_ENTRY.size * len(slot_words)
+    words_size = sum(len(encoded_word) for encoded_word in encoded_words if encoded_word is not None)
+    postings_start = words_start + words_size
+    postings_start += -postings_start % calcsize(POSTINGS_TYPECODE)
+
+    with open(filepath, "wb") as fout:
+        fout.write(PERFECT_INDEX_HEADER.pack(
+            PERFECT_INDEX_MAGIC, len(words), hash_table.prime, *hash_table.first_level_parameters
+        ))
+        offsets.tofile(fout)
+        array(PERFECT_INDEX_TYPECODE, hash_table.second_level_parameters).tofile(fout)
+        word_offset, postings_offset = words_start, postings_start
+        for encoded_word, word in zip(encoded_words, slot_words):
+            if word is None:
+                fout.write(MAPPED_INDEX_ENTRY.pack(0, 0, 0, 0))
+                continue
+            postings_count = len(index_as_dict[word])
+            fout.write(MAPPED_INDEX_ENTRY.pack(
+                word_offset, len(encoded_word), postings_offset, postings_count
+            ))
+            word_offset += len(encoded_word)
+            postings_offset += postings_count * calcsize(POSTINGS_TYPECODE)
+        for encoded_word in encoded_words:
+            if encoded_word is not None:
+                fout.write(encoded_word)
+        fout.write(bytes(postings_start - words_start - words_size))
+        for word in slot_words:
+            if word is not None:
+                array(POSTINGS_TYPECODE, index_as_dict[word]).tofile(fout)
+
+
+class PerfectHashPostings(Mapping):
+    """Read-only word -> postings mapping over memory-mapped perfect hash index
+
+    Bucket offsets and hash parameters are zero-copy views of the file, so
+    nothing is built at startup, and every lookup probes exactly one slot.
+    Perfect hashing module (and NumPy) is imported only by this policy.
+    """
+    def __init__(self, filepath: str):
+        """Map file into memory, check its header and view hash arrays"""
+        from task_Yaropolov_Oleg_perfect_hashing import stable_string_hash, universal_hash
+
+        self._string_hash, self._universal_hash = stable_string_hash, universal_hash
+        with open(filepath, "rb") as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._words_count, self._prime, *self._first_level_parameters = (
+            PERFECT_INDEX_HEADER.unpack_from(self._mmap, 0)
+        )
+        if magic != PERFECT_INDEX_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{filepath} is not a perfect hash inverted index")
+        self._view = memoryview(self._mmap)
+        item_size = calcsize(PERFECT_INDEX_TYPECODE)
+        parameters_start = PERFECT_INDEX_HEADER.size + item_size * (self._words_count + 1)
+        self._slots_start = parameters_start + item_size * 2 * self._words_count
+        self._offsets = self._view[PERFECT_INDEX_HEADER.size:parameters_start].cast(PERFECT_INDEX_TYPECODE)
+        self._parameters = self._view[parameters_start:self._slots_start].cast(PERFECT_INDEX_TYPECODE)
+
+    def _entry(self, slot: int) -> Tuple[int, int, int, int]:
+        """Read slot entry by its position"""
+        return MAPPED_INDEX_ENTRY.unpack_from(self._mmap, self._slots_start + slot * MAPPED_INDEX_ENTRY.size)
+
+    def _find_slot(self, word: str) -> int:
+        """Probe the only slot the word may occupy"""
+        key = self._string_hash(word)
+        bucket_number = self._universal_hash(key, self._first_level_parameters, self._prime, self._words_count)
+        bucket_start, bucket_end = self._offsets[bucket_number], self._offsets[bucket_number + 1]
+        if bucket_start == bucket_end:
+            raise KeyError(word)
+        parameters = (self._parameters[2 * bucket_number], self._parameters[2 * bucket_number + 1])
+        return bucket_start + self._universal_hash(key, parameters, self._prime, bucket_end - bucket_start)
+
+    def __getitem__(self, word: str) -> memoryview:
+        """Zero-copy view of postings of the word"""
+        if not self._words_count:
+            raise KeyError(word)
+        word_offset, word_length, postings_offset, postings_count = self._entry(self._find_slot(word))
+        if not postings_count or self._mmap[word_offset:word_offset + word_length] != word.encode():
+            raise KeyError(word)
+        postings_end = postings_offset + postings_count * calcsize(POSTINGS_TYPECODE)
+        return self._view[postings_offset:postings_end].cast(POSTINGS_TYPECODE)
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over words in slot order"""
+        for slot in range(self._offsets[-1] if self._words_count else 0):
+            word_offset, word_length, _, postings_count = self._entry(slot)
+            if postings_count:
+                yield self._mmap[word_offset:word_offset + word_length].decode()
+
+    def __len__(self) -> int:
+        return self._words_count
+
+    def close(self) -> None:
+        """Unmap file, postings views returned before must be released"""
+        self._offsets.release()
+        self._parameters.release()
+        self._view.release()
+        self._mmap.close()
+
+def append_varint(payload: bytearray, value: int) -> None:
+    """Append non-negative integer as variable-byte code (7 bits per byte)"""
+    while value >= 0x80:
+        payload.append(value & 0x7F | 0x80)
+        value >>= 7
+    payload.append(value)
+
+
+def read_varint(payload: Sequence[int], position: int) -> Tuple[int, int]:
+    """Decode variable-byte code at position, return value and next position"""
+    value, shift = 0, 0
+    while True:
+        byte = payload[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def encode_postings(postings: Iterable[int]) -> bytes:
+    """Compress sorted postings into skip table and delta + varint encoded blocks
+
+    Layout: the last document index of every block, end offset of every block
+    in payload (both array('I')) and the payload. Deltas of each block are taken
+    from the last document index of the previous block.
+    """
+    postings = sorted(postings)
+    block_max, block_end = array(POSTINGS_TYPECODE), array(POSTINGS_TYPECODE)
+    payload = bytearray()
+    previous = 0
+    for block_start in range(0, len(postings), COMPRESSED_BLOCK_SIZE):
+        for document_index in postings[block_start:block_start + COMPRESSED_BLOCK_SIZE]:
+            append_varint(payload, document_index - previous)
+            previous = document_index
+        block_max.append(previous)
+        block_end.append(len(payload))
+    return block_max.tobytes() + block_end.tobytes() + payload
+
+
+class CompressedPostings:
+    """Sorted postings encoded by encode_postings, decoded lazily block by block"""
+    __slots__ = ("_count", "_block_max", "_block_end", "_payload")
+
+    def __init__(self, count: int, encoded: memoryview):
+        """Split encoded buffer into skip table and payload without copying"""
+        blocks_count = -(-count // COMPRESSED_BLOCK_SIZE)
+        skip_table_size = blocks_count * calcsize(POSTINGS_TYPECODE)
+        self._count = count
+        self._block_max = encoded[:skip_table_size].cast(POSTINGS_TYPECODE)
+        self._block_end = encoded[skip_table_size:2 * skip_table_size].cast(POSTINGS_TYPECODE)
+        self._payload = encoded[2 * skip_table_size:]
+
+    def decode_block(self, block_number: int) -> array:
+        """Decode one block of postings"""
+        previous = self._block_max[block_number - 1] if block_number else 0
+        position = self._block_end[block_number - 1] if block_number else 0
+        block_end = self._block_end[block_number]
+        block = array(POSTINGS_TYPECODE)
+        payload = self._payload
+        while position < block_end:
+            delta, position = read_varint(payload, position)
+            previous += delta
+            block.append(previous)
+        return block
+
+    def make_cursor(self) -> Callable[[int], Optional[int]]:
+        """Cursor for intersect_postings decoding only blocks it lands in"""
+        blocks_count = len(self._block_max)
+        block_number, block, position = -1, array(POSTINGS_TYPECODE), 0
+
+        def advance(target: int) -> Optional[int]:
+            nonlocal block_number, block, position
+            if not block or block[-1] < target:
+                next_block_number = bisect_left(self._block_max, target, max(block_number, 0))
+                if next_block_number == blocks_count:
+                    return None
+                block_number, position = next_block_number, 0
+                block = self.decode_block(block_number)
+            position = bisect_left(block, target, position)
+            return block[position]
+        return advance
+
+    def __iter__(self) -> Iterator[int]:
+        for block_number in range(len(self._block_max)):
+            yield from self.decode_block(block_number)
+
+    def __len__(self) -> int:
+        return self._count
+
+
+def dump_compressed_index(index_as_dict: Mapping[str, Iterable[int]], filepath: str) -> None:
+    """Save index as json header [word, postings count, encoded size] and encoded postings"""
+    pairs, encoded_postings = [], []
+    for word, postings in index_as_dict.items():
+        encoded = encode_postings(postings)
+        pairs.append([word, len(postings), len(encoded)])
+        encoded_postings.append(encoded)
+    header = json.dumps(pairs).encode()
+    with open(filepath, "wb") as fout:
+        fout.write(pack('I', len(header)))
+        fout.write(header)
+        for encoded in encoded_postings:
+            fout.write(encoded)
+
+def load_compressed_index(filepath: str) -> Dict[str, CompressedPostings]:
+    """Load index saved by dump_compressed_index, postings stay encoded"""
+    with open(filepath, "rb") as fin:
+        file_content = memoryview(fin.read())
+    header_size, = unpack_from('I', file_content)
+    body_offset = calcsize('I') + header_size
+    pairs = json.loads(bytes(file_content[calcsize('I'):body_offset]).decode())
+    loaded_dict = {}
+    for word, postings_count, encoded_size in pairs:
+        loaded_dict[word] = CompressedPostings(
+            postings_count, file_content[body_offset:body_offset + encoded_size]
+        )
+        body_offset += encoded_size
+    return loaded_dict
+
+
+@register_storage_policy("mmap")
+class MappedStoragePolicy(StoragePolicy):
+    """Sorted directory with offsets, postings are read from memory-mapped file"""
+    dump = staticmethod(dump_mapped_index)
+    load = staticmethod(MappedPostings)
+
+
+@register_storage_policy("compressed")
+class CompressedStoragePolicy(StoragePolicy):
+    """Delta + varint encoded postings blocks with skip table"""
+    dump = staticmethod(dump_compressed_index)
+    load = staticmethod(load_compressed_index)
+
+
+@register_storage_policy("perfect")
+class PerfectHashStoragePolicy(StoragePolicy):
+    """Perfect hash directory over string keys, postings are read from memory-mapped file"""
+    dump = staticmethod(dump_perfect_index)
+    load = staticmethod(PerfectHashPostings)
+
+
+def get_storage_policy(name: str) -> Optional[Type[StoragePolicy]]:
+    """Return registered storage policy by its name"""
+    return STORAGE_POLICIES.get(name)
@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 # from argparse import ArgumentParser, FileType
 # import sys
+import csv
+import json
 import logging
 import logging.config
-from typing import Dict, List
+import math
+import threading
+import time
+from array import array
+from operator import attrgetter
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
+from lxml import etree
+import numpy as np
 import requests
 from flask import Flask, jsonify, request, abort
 
@@ -17,6 +27,11 @@ WARN_PERIOD_THRESHOLD = 5
 logger = logging.getLogger("asset")
 CBR_DAILY_HTML = "https://www.cbr.ru/eng/currency_base/daily/"
 CBR_KEY_INDICATOR_HTML = "https://www.cbr.ru/eng/key-indicators/"
+CBR_RATES_TTL = 600
+ASSET_FIELDS = ("char_code", "name", "capital", "interest")
+BULK_FORMATS = ("jsonl", "csv")
+JSON_RESPONSE_CACHE_SIZE = 128
+ASSET_SORT_KEY = attrgetter("char_code", "name")
 
 
 
@@ -49,33 +64,213 @@ def download_cbr_key_indicator() -> str:
     return downloaded_text
 
 
+class CbrRatesCache:
+    """Daily rates and key indicators of CBR cached for ttl seconds
+
+    Both pages are downloaded concurrently. Once the value is older than ttl
+    it is still served while one background thread revalidates it
+    (stale-while-revalidate), so slow CBR delays only the very first request.
+    With refresh_interval the value is also refreshed by a daemon thread.
+    """
+    def __init__(self, ttl: float = CBR_RATES_TTL, refresh_interval: float = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._rates: Optional[Tuple[Dict[str, float], Dict[str, float]]] = None
+        self._updated_at = None
+        self._revalidation: Optional[threading.Thread] = None
+        self._refresher: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def fetch() -> Tuple[Dict[str, float], Dict[str, float]]:
+        """Download and parse both CBR pages concurrently"""
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            daily_rate = executor.submit(return_cbr_daily)
+            key_indicators = executor.submit(return_cbr_key_indicators)
+            return daily_rate.result(), key_indicators.result()
+
+    def refresh(self) -> Tuple[Dict[str, float], Dict[str, float]]:
+        """Fetch rates and store them"""
+        rates = self.fetch()
+        with self._lock:
+            self._rates, self._updated_at = rates, self._clock()
+        return rates
+
+    def get(self) -> Tuple[Dict[str, float], Dict[str, float]]:
+        """Return daily rates and key indicators, fetching them only if never fetched"""
+        with self._lock:
+            rates = self._rates
+            is_stale = rates is not None and self._clock() - self._updated_at >= self.ttl
+            if is_stale and self._revalidation is None:
+                self._revalidation = threading.Thread(target=self._revalidate, daemon=True)
+                self._revalidation.start()
+        if rates is not None:
+            return rates
+        with self._fetch_lock:
+            rates = self._rates or self.refresh()
+        self._start_refresher()
+        return rates
+
+    def _refresh_quietly(self) -> None:
+        """Refresh rates, keep serving the old ones if CBR is unavailable"""
+        try:
+            self.refresh()
+        except Exception:  # pylint: disable=broad-except
+            logger.warning("cannot refresh CBR rates, stale ones are served", exc_info=True)
+
+    def _revalidate(self) -> None:
+        """Refresh stale rates and allow the next revalidation"""
+        try:
+            self._refresh_quietly()
+        finally:
+            with self._lock:
+                self._revalidation = None
+
+    def _start_refresher(self) -> None:
+        """Start periodic refresh thread once"""
+        with self._lock:
+            if self.refresh_interval is None or self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_periodically, args=(self._stopped,),
+                                               daemon=True)
+            self._refresher.start()
+
+    def _refresh_periodically(self, stopped: threading.Event) -> None:
+        while not stopped.wait(self.refresh_interval):
+            self._refresh_quietly()
+
+    def wait_for_revalidation(self, timeout: float = None) -> None:
+        """Wait until running revalidation is finished"""
+        revalidation = self._revalidation
+        if revalidation is not None:
+            revalidation.join(timeout)
+
+    def clear(self) -> None:
+        """Drop cached rates"""
+        with self._lock:
+            self._rates, self._updated_at = None, None
+
+    def stop(self) -> None:
+        """Stop periodic refresh thread and wait for it, the next fetch starts it again"""
+        with self._lock:
+            refresher, self._refresher = self._refresher, None
+            stopped, self._stopped = self._stopped, threading.Event()
+        stopped.set()
+        if refresher is not None:
+            refresher.join()
+
+CBR_RATES_CACHE = CbrRatesCache(refresh_interval=CBR_RATES_TTL)
+
+
 @app.route("/api/asset/add/<string:char_code>/<string:name>/<capital>/<float:interest>")
 def add_asset_from_web(char_code, name, capital, interest):
     """Add asset with provided parameters to the bank"""
-    if ASSET_COLLECTION.asset_with_provided_name_is_already_exists(name):
+    asset = Asset(name, float(capital), interest, char_code)
+    try:
+        ASSET_COLLECTION.add(asset)
+    except ValueError:
         return f"Asset '{name}' is already exists!", 403
-    ASSET_COLLECTION.add_by_params(name, float(capital), interest, char_code)
     return f"Asset '{name}' was successfully added", 200
 
+@app.route("/api/asset/bulk_add", methods=["POST"])
+def bulk_add_assets_from_web():
+    """Add assets from JSONL or CSV body (fields: char_code, name, capital, interest)
+
+    Rows are parsed from the streamed body one by one, valid assets are
+    inserted in one batch, invalid rows and duplicate names are reported
+    with their line numbers. Body which is not valid UTF-8 is rejected
+    as a whole.
+    """
+    data_format = request.args.get("format") or ("csv" if request.mimetype == "text/csv" else "jsonl")
+    if data_format not in BULK_FORMATS:
+        return f"Format '{data_format}' is not supported", 415
+    lines = (raw_line.decode("utf-8") for raw_line in request.stream)
+    assets, errors = [], []
+    try:
+        for line_number, asset_or_error in parse_bulk_assets(lines, data_format):
+            if isinstance(asset_or_error, Asset):
+                assets.append((line_number, asset_or_error))
+            else:
+                errors.append({"line": line_number, "error": asset_or_error})
+    except UnicodeDecodeError as error:
+        return f"Body is not valid UTF-8: {error.reason}", 400
+    rejected = ASSET_COLLECTION.add_many(assets)
+    errors.extend(
+        {"line": line_number, "error": f"Asset '{asset.name}' is already exists!"}
+        for line_number, asset in rejected
+    )
+    errors.sort(key=lambda error: error["line"])
+    return jsonify({"added": len(assets) - len(rejected), "errors": errors}), 200
+
+def parse_bulk_assets(lines: Iterable[str], data_format: str) -> Iterator[Tuple[int, Union["Asset", str]]]:
+    """Yield line number and parsed asset or error message for every non-empty row"""
+    if data_format == "csv":
+        reader = csv.reader(lines)
+        for row in reader:
+            if not row or row == list(ASSET_FIELDS):
+                continue
+            yield reader.line_num, build_asset_from_row(row)
+        return
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, f"invalid json: {error}"
+            continue
+        yield line_number, build_asset_from_row(row)
+
+def build_asset_from_row(row) -> Union["Asset", str]:
+    """Validate row (object with ASSET_FIELDS or list of them) and build asset or error message"""
+    if isinstance(row, dict):
+        missing_fields = [field for field in ASSET_FIELDS if field not in row]
+        if missing_fields:
+            return f"missing fields: {', '.join(missing_fields)}"
+        row = [row[field] for field in ASSET_FIELDS]
+    if not isinstance(row, list) or len(row) != len(ASSET_FIELDS):
+        return f"expected {len(ASSET_FIELDS)} fields: {', '.join(ASSET_FIELDS)}"
+    char_code, name, capital, interest = row
+    if isinstance(capital, bool) or isinstance(interest, bool):
+        return "capital and interest must be numbers"
+    if not isinstance(char_code, str) or not char_code:
+        return "char_code must be non-empty string"
+    if not isinstance(name, str) or not name:
+        return "name must be non-empty string"
+    try:
+        capital, interest = float(capital), float(interest)
+    except (TypeError, ValueError):
+        return "capital and interest must be numbers"
+    if not math.isfinite(capital) or not math.isfinite(interest):
+        return "capital and interest must be finite"
+    return Asset(name, capital, interest, char_code)
+
+def serialize_json_response(data) -> str:
+    """Body of jsonify response with the data, honours JSON settings of the app"""
+    return jsonify(data).get_data(as_text=True)
+
 @app.route("/api/asset/list")
 def print_asset_collection():
     """Print json from all assets"""
-    sorted_collection = ASSET_COLLECTION.return_to_request(None)
-    return jsonify(sorted_collection), 200
+    return app.response_class(ASSET_COLLECTION.return_to_request_json(None), mimetype="application/json"), 200
 
 @app.route("/api/asset/get")
 def print_selected_asset():
-    """Print json from required assets"""
+    """Print json from required assets (by names and/or char_codes)"""
     requested_assets = request.args.getlist("name")
-    sorted_collection = ASSET_COLLECTION.return_to_request(requested_assets)
-    return jsonify(sorted_collection), 200
+    requested_char_codes = request.args.getlist("char_code")
+    json_response = ASSET_COLLECTION.return_to_request_json(requested_assets, requested_char_codes)
+    return app.response_class(json_response, mimetype="application/json"), 200
 
 @app.route("/api/asset/calculate_revenue")
 def calculate_revenue_for_period():
     """Return revenue in json format"""
     requested_periods = request.args.getlist("period")
-    daily_rate = return_cbr_daily()
-    key_indicators = return_cbr_key_indicators()
+    daily_rate, key_indicators = CBR_RATES_CACHE.get()
 
     def exchange_rate(char_code: str) -> float:
         if "RUB" == char_code:
@@ -86,13 +281,13 @@ def calculate_revenue_for_period():
             return daily_rate[char_code]
         abort(501)
 
-    revenues_for_period = {}
-
-    for period in requested_periods:
-        precise_answer = sum(asset.calculate_revenue(float(period))
-                             * exchange_rate(asset.char_code)
-                             for asset in ASSET_COLLECTION._asset_collection)
-        revenues_for_period[period] = round(precise_answer, 8)
+    revenues = ASSET_COLLECTION.calculate_revenue(
+        [float(period) for period in requested_periods], exchange_rate
+    )
+    revenues_for_period = {
+        period: round(float(precise_answer), 8)
+        for period, precise_answer in zip(requested_periods, revenues)
+    }
     return jsonify(revenues_for_period), 200
 
 @app.route("/api/asset/cleanup")
@@ -128,14 +323,35 @@ def download_page_from_url(url: str) -> str:
         abort(503)
 
 def parse_cbr_currency_base_daily(html_data: str) -> Dict[str, float]:
-    """Parse currency from text"""
+    """Parse currency from text with lxml (cells: num code, char code, unit, currency, rate)"""
+    root = etree.fromstring(html_data, etree.HTMLParser())
+    currency_dict = {}
+    for tr in root.xpath("//tr")[1:]:
+        cells = tr.xpath("td")
+        currency_dict[cells[1].text] = float(cells[4].text) / float(cells[2].text)
+    return currency_dict
+
+def parse_cbr_key_indicators(html_data: str) -> Dict[str, float]:
+    """Parse key_indicators from text with lxml"""
+    root = etree.fromstring(html_data, etree.HTMLParser())
+    asset_dict = {}
+    div_collection = root.xpath("//div[@class='table key-indicator_table']")
+    for div in div_collection[0:2]:
+        for asset in div.xpath(".//tr")[1:]:
+            cells = asset.xpath(".//td")
+            char_code = cells[0].xpath(".//div")[2].text
+            asset_dict[char_code] = float(cells[-1].text.replace(",", ""))
+    return asset_dict
+
+def parse_cbr_currency_base_daily_bs4(html_data: str) -> Dict[str, float]:
+    """Parse currency from text with BeautifulSoup (reference for parse_cbr_currency_base_daily)"""
     soup = BeautifulSoup(html_data, features="html.parser")
     return dict((tr.contents[3].contents[0], float(tr.contents[9].contents[0]) /
                  float(tr.contents[5].contents[0])) for
                 tr in soup.find_all("tr")[1:])
 
-def parse_cbr_key_indicators(html_data: str) -> Dict[str, float]:
-    """Parse key_indicators from text"""
+def parse_cbr_key_indicators_bs4(html_data: str) -> Dict[str, float]:
+    """Parse key_indicators from text with BeautifulSoup (reference for parse_cbr_key_indicators)"""
     soup = BeautifulSoup(html_data, features="html.parser")
     asset_dict = {}
     div_collection = soup.find_all("div", class_="table key-indicator_table")
@@ -154,14 +370,83 @@ class Component(ABC):
     def return_to_request(self):
         """Abstract method for printing assets"""
 
+class CompositeState(NamedTuple):
+    """State of Composite: assets in insertion order, indexes and columns
+
+    State is append-only: appended assets are never changed nor removed (it is
+    replaced as a whole on clear), so the first `count` items of its lists and
+    arrays stay the same once the state has `count` assets.
+    """
+    assets: List[Component]
+    assets_by_name: Dict[str, Component]
+    assets_by_char_code: Dict[str, Dict[str, Component]]
+    capitals: array
+    interests: array
+    currency_numbers: array
+    char_codes: Dict[str, int]
+
+    @classmethod
+    def empty(cls) -> "CompositeState":
+        """State without assets"""
+        return cls([], {}, {}, array("d"), array("d"), array("q"), {})
+
+    def append(self, component: Component) -> None:
+        """Add asset to all indexes and columns, names are unique"""
+        if component.name in self.assets_by_name:
+            raise ValueError(f"Asset '{component.name}' is already exists!")
+        self.assets.append(component)
+        self.assets_by_name[component.name] = component
+        self.assets_by_char_code.setdefault(component.char_code, {})[component.name] = component
+        self.capitals.append(component.capital)
+        self.interests.append(component.interest)
+        self.currency_numbers.append(self.char_codes.setdefault(component.char_code, len(self.char_codes)))
+
+
+class SortedSnapshot(NamedTuple):
+    """First `count` assets of the state ordered by (char_code, name)"""
+    state: CompositeState
+    count: int
+    assets: Tuple[Component, ...]
+
+
 class Composite(Component):
-    """Parent object of composite pattern"""
+    """Parent object of composite pattern
+
+    Assets are kept in insertion order together with the hash index by name
+    and the secondary index by char_code (char_code -> {name: asset}), so
+    adding, lookup by name and filtering by names or char_codes do not scan
+    the whole collection. Capitals, interests and currency numbers are also
+    kept as columns for vectorized revenue calculation.
+
+    Writers append to the state in place under the lock and remove_all
+    replaces it with empty one. Readers hold the lock only to take the state,
+    its version and number of assets (or a small selection of them), and read
+    the unchanging prefix of the state outside of the lock. The sorted
+    snapshot is rebuilt lazily once per version, serialized JSON responses are
+    cached per version under their own lock.
+    """
     def __init__(self) -> None:
-        self._asset_collection: List[Component] = []
+        self._state = CompositeState.empty()
+        self._version = 0
+        self._lock = threading.Lock()
+        self._sorted_snapshot = SortedSnapshot(self._state, 0, ())
+        self._json_cache_lock = threading.Lock()
+        self._json_cache: Tuple[int, Dict[tuple, str]] = (self._version, {})
+
+    @property
+    def _asset_collection(self) -> List[Component]:
+        return self._state.assets
+
+    def _current(self) -> Tuple[CompositeState, int, int]:
+        """State, its version and number of its assets"""
+        with self._lock:
+            return self._state, self._version, len(self._state.assets)
 
     def add(self, component: Component) -> None:
-        """Add one asset"""
-        self._asset_collection.append(component)
+        """Add one asset, names are unique"""
+        with self._lock:
+            self._state.append(component)
+            self._version += 1
 
     def add_by_params(self, name: str, capital: float,
                       interest: float, char_code: str = "RUB") -> None:
@@ -169,48 +454,147 @@ class Composite(Component):
         asset = Asset(name, capital, interest, char_code)
         self.add(asset)
 
+    def add_many(self, numbered_assets: Iterable[Tuple[int, Component]]) -> List[Tuple[int, Component]]:
+        """Add batch of numbered assets under one lock, return rejected duplicates"""
+        rejected = []
+        with self._lock:
+            for number, asset in numbered_assets:
+                if asset.name in self._state.assets_by_name:
+                    rejected.append((number, asset))
+                else:
+                    self._state.append(asset)
+            self._version += 1
+        return rejected
+
     # def remove(self, component: Component) -> None:
     #     """Remove one asset"""
     #     self._asset_collection.remove(component)
 
     def remove_all(self) -> None:
-        """Clear collection"""
-        for asset in self._asset_collection:
-            self._asset_collection.remove(asset)
+        """Clear collection and its indexes by replacing state with empty one"""
+        with self._lock:
+            self._state = CompositeState.empty()
+            self._version += 1
+
+    def calculate_revenue(self, periods: Sequence[float],
+                          exchange_rate: Callable[[str], float]) -> np.ndarray:
+        """Revenue of all assets in rubles for every period
+
+        Computed as capital * ((1 + interest) ** periods - 1) * rates in one
+        broadcast over asset columns and summed over assets in insertion order
+        (cumsum is sequential), so the result is the same as the per-asset sum.
+        Powers are taken with builtin pow once per distinct interest and period,
+        because vectorized np.power may differ from it in the last bit.
+        exchange_rate is called once per currency and only if there are periods.
+        """
+        if not len(periods):
+            return np.zeros(0, dtype=np.float64)
+        with self._lock:
+            state, count = self._state, len(self._state.assets)
+            char_codes = list(state.char_codes)
+        if not count:
+            return np.zeros(len(periods), dtype=np.float64)
+        capitals = np.array(state.capitals[:count], dtype=np.float64)
+        interests = np.array(state.interests[:count], dtype=np.float64)
+        currency_numbers = np.array(state.currency_numbers[:count], dtype=np.intp)
+        rates = np.array([exchange_rate(char_code) for char_code in char_codes], dtype=np.float64)
+        bases, base_numbers = np.unique(1.0 + interests, return_inverse=True)
+        periods = [float(period) for period in periods]
+        growths = np.fromiter(
+            map(pow, np.repeat(bases, len(periods)).tolist(), periods * len(bases)),
+            dtype=np.float64, count=len(bases) * len(periods),
+        ).reshape(len(bases), len(periods))
+        revenues = capitals[:, np.newaxis] * (growths[base_numbers] - 1.0)
+        return np.cumsum(rates[currency_numbers][:, np.newaxis] * revenues, axis=0)[-1]
+
+    def get(self, name: str) -> Optional[Component]:
+        """Find asset by name"""
+        with self._lock:
+            return self._state.assets_by_name.get(name)
+
+    def get_by_char_code(self, char_code: str) -> List[Component]:
+        """Find assets in the currency"""
+        with self._lock:
+            return list(self._state.assets_by_char_code.get(char_code, {}).values())
 
     def asset_with_provided_name_is_already_exists(self, name: str) -> bool:
         """Check whether asset exists"""
-        return any(name == asset.name for asset in self._asset_collection)
+        with self._lock:
+            return name in self._state.assets_by_name
 
-    def return_to_request(self, required_assets) -> str:
-        """Build ordered list from asset collection"""
+    @staticmethod
+    def _select(state: CompositeState, required_assets, required_char_codes) -> List[Component]:
+        """New list of assets with any of required names and any of required char_codes"""
         if required_assets:
-            asset_collection = [asset.return_to_request() for asset in self._asset_collection if
-                                asset.name in required_assets]
+            selected = [state.assets_by_name[name] for name in dict.fromkeys(required_assets)
+                        if name in state.assets_by_name]
+            if required_char_codes:
+                required_char_codes = set(required_char_codes)
+                selected = [asset for asset in selected if asset.char_code in required_char_codes]
+            return selected
+        if required_char_codes:
+            return [asset for char_code in dict.fromkeys(required_char_codes)
+                    for asset in state.assets_by_char_code.get(char_code, {}).values()]
+        return list(state.assets)
+
+    def _sorted_assets(self, state: CompositeState, count: int) -> Tuple[Component, ...]:
+        """First `count` assets of the state ordered by char_code and name
+
+        The snapshot of the previous version is reused: assets appended since
+        then are concatenated to it and timsort merges these two runs in linear
+        time. Concurrent readers may rebuild it twice, but never see it changing.
+        """
+        snapshot = self._sorted_snapshot
+        if snapshot.state is state and snapshot.count == count:
+            return snapshot.assets
+        if snapshot.state is state and snapshot.count < count:
+            assets = snapshot.assets + tuple(state.assets[snapshot.count:count])
+        else:
+            assets = state.assets[:count]
+        snapshot = SortedSnapshot(state, count, tuple(sorted(assets, key=ASSET_SORT_KEY)))
+        self._sorted_snapshot = snapshot
+        return snapshot.assets
+
+    def _ordered(self, required_assets, required_char_codes) -> Tuple[int, List[list]]:
+        """Version of the state and rows of required assets ordered by char_code and name"""
+        if not required_assets and not required_char_codes:
+            state, version, count = self._current()
+            assets = self._sorted_assets(state, count)
         else:
-            asset_collection = [asset.return_to_request() for asset in self._asset_collection]
-
-        def sort_by_char_code(list_input):
-            """Sort by char_code"""
-            return list_input[0]
-        def sort_by_name(list_input):
-            """Sort by name"""
-            return list_input[1]
-        def sort_by_capital(list_input):
-            """Sort by capital"""
-            return list_input[2]
-        def sort_by_interest(list_input):
-            """Sort by interest"""
-            return list_input[3]
-
-        return sorted(
-            sorted(
-                sorted(
-                    sorted(asset_collection,
-                           key=sort_by_interest),
-                    key=sort_by_capital),
-                key=sort_by_name),
-            key=sort_by_char_code)
+            with self._lock:
+                version = self._version
+                assets = self._select(self._state, required_assets, required_char_codes)
+            assets.sort(key=ASSET_SORT_KEY)
+        return version, [asset.return_to_request() for asset in assets]
+
+    def return_to_request(self, required_assets, required_char_codes=None) -> List[list]:
+        """Build list ordered by char_code and name from asset collection"""
+        return self._ordered(required_assets, required_char_codes)[1]
+
+    def return_to_request_json(self, required_assets, required_char_codes=None,
+                               serialize: Callable[[list], str] = serialize_json_response) -> str:
+        """Serialized return_to_request, cached until the next mutation
+
+        Responses are built and serialized outside of both locks and stored
+        only if no newer version has been cached meanwhile.
+        """
+        request_key = (tuple(required_assets or ()), tuple(required_char_codes or ()))
+        _, version, _ = self._current()
+        with self._json_cache_lock:
+            cached_version, cache = self._json_cache
+            if cached_version == version and request_key in cache:
+                return cache[request_key]
+        version, rows = self._ordered(required_assets, required_char_codes)
+        json_response = serialize(rows)
+        with self._json_cache_lock:
+            if self._json_cache[0] < version:
+                self._json_cache = (version, {})
+            cached_version, cache = self._json_cache
+            if cached_version == version:
+                if len(cache) >= JSON_RESPONSE_CACHE_SIZE:
+                    cache.clear()
+                cache[request_key] = json_response
+        return json_response
 
 ASSET_COLLECTION = Composite()
 
@@ -1,102 +1,814 @@
 """Module for Inverted Index"""
 from __future__ import annotations
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType
-from typing import Dict, List
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, TextIO, Tuple
 from io import TextIOWrapper
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, groupby, repeat
+from operator import itemgetter, sub
+from collections import Counter, OrderedDict, deque
+from time import perf_counter
+from uuid import uuid4
+from contextlib import contextmanager, suppress
+import asyncio
+import fcntl
+import heapq
+import json
+import math
+import mmap
+import os
+import struct
 import sys
+import threading
 import re
-import json
 import pathlib
-from struct import pack, unpack, calcsize
+
+from storage_policy import (
+    POSTINGS_TYPECODE, STORAGE_POLICIES, MappedPostings, StoragePolicy, StoragePolicyReport, append_varint,
+    get_storage_policy, read_varint, write_mapped_index,
+)
 
 DEFAULT_DATASET_PATH = "./wikipedia_sample"
 DEFAULT_OUTPUT_PATH = "./inverted_index"
 DEFAULT_STORAGE_POLICY = "struct"
+DEFAULT_SOCKET_PATH = "./inverted_index.sock"
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_BATCH_DELAY = 0.001
+LATENCY_WINDOW = 10_000
+LATENCY_REPORT_PERIOD = 1000
+DEFAULT_CACHE_SIZE = 10_000
+OUTPUT_BUFFER_LINES = 1000
+SEGMENTS_MANIFEST_SUFFIX = ".segments.json"
+WRITER_LOCK_SUFFIX = ".lock"
+DEFAULT_COMPACTION_NICENESS = 10
+RANKING_DATA_SUFFIX = ".frequencies"
+RANKING_DATA_MAGIC = b"RANK"
+RANKING_DATA_HEADER = struct.Struct("=4sIdQ")
+UPPER_BOUNDS_TYPECODE = "d"
+POSITIONS_SUFFIX = ".positions"
+POSITIONS_MAGIC = b"POSI"
+POSITIONS_HEADER = struct.Struct("=4sQ")
+POSITIONS_TYPECODE = "B"
+DEFAULT_TOP_K = 10
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def gallop_to(postings: Sequence[int], target: int, low: int = 0) -> int:
+    """Return the first position >= low where sorted postings are >= target
+
+    Probes positions with exponentially growing steps and finishes with binary
+    search inside the last step, so short jumps cost O(log(jump)).
+    """
+    size = len(postings)
+    high, step = low, 1
+    while high < size and postings[high] < target:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(postings, target, low, min(high, size))
+
+def make_postings_cursor(postings: Sequence[int]) -> Callable[[int], Optional[int]]:
+    """Return function advancing over sorted postings to the first item >= target
+
+    Targets must not decrease between calls. None means postings are exhausted.
+    Postings may provide their own cursor via `make_cursor` method.
+    """
+    if hasattr(postings, "make_cursor"):
+        return postings.make_cursor()
+    size = len(postings)
+    position = 0
+
+    def advance(target: int) -> Optional[int]:
+        nonlocal position
+        position = gallop_to(postings, target, position)
+        return postings[position] if position < size else None
+    return advance
+
+def intersect_postings(postings_lists: List[Sequence[int]]) -> List[int]:
+    """Intersect sorted posting lists processing them from rarest to most common
+
+    Candidates from the rarest list are looked up in every other list with a
+    galloping cursor, result is sorted in ascending order.
+    """
+    if not postings_lists:
+        return []
+    rarest_postings, *other_postings = sorted(postings_lists, key=len)
+    found_documents = list(rarest_postings)
+    for postings in other_postings:
+        if not found_documents:
+            break
+        advance = make_postings_cursor(postings)
+        found_documents = [
+            document_index for document_index in found_documents
+            if advance(document_index) == document_index
+        ]
+    return found_documents
+
+def intersect_postings_with_sets(postings_lists: List[Sequence[int]]) -> List[int]:
+    """Reference set-based intersection, the order of the result is arbitrary"""
+    if not postings_lists:
+        return []
+    found_documents = list(postings_lists[0])
+    for postings in postings_lists[1:]:
+        found_documents = list(set(found_documents) & set(postings))
+    return found_documents
+
+class Tokenizer:
+    """Split text into words with precompiled pattern
+
+    Empty words and stop words are dropped. With interning, equal words share
+    one string object, which saves memory of long-living structures.
+    """
+    split_pattern = re.compile(r"\W+")
+
+    def __init__(self, stop_words: Iterable[str] = (), intern_words: bool = False):
+        """Initialization by stop words and interning flag"""
+        self.stop_words = frozenset(stop_words)
+        self._intern_table = {} if intern_words else None
+
+    @classmethod
+    def from_stop_words_file(cls, filepath: str = None, intern_words: bool = False) -> Tokenizer:
+        """Load stop words (one per line) from file, no stop words without file"""
+        if filepath is None:
+            return cls(intern_words=intern_words)
+        with open(filepath, encoding="utf-8") as fin:
+            return cls((line.strip() for line in fin if line.strip()), intern_words)
+
+    def filter(self, words: Iterable[str]) -> List[str]:
+        """Drop empty words and stop words, intern the rest if required"""
+        stop_words, intern_table = self.stop_words, self._intern_table
+        filtered_words = [word for word in words if word and word not in stop_words]
+        if intern_table is not None:
+            filtered_words = [intern_table.setdefault(word, word) for word in filtered_words]
+        return filtered_words
+
+    def tokenize(self, text: str) -> List[str]:
+        """Split text into filtered words"""
+        return self.filter(self.split_pattern.split(text))
+
+    def __call__(self, text: str) -> List[str]:
+        return self.tokenize(text)
+
+DEFAULT_TOKENIZER = Tokenizer()
+
+class RankingData:
+    """Term frequencies and document lengths for BM25 ranking
+
+    Frequencies of every word are aligned with its base postings. The upper
+    bound of every word is the maximal BM25 term weight (without idf) over its
+    postings, computed once at build time for early termination.
+    """
+    def __init__(self, frequencies: Mapping[str, Sequence[int]], document_lengths: Mapping[int, int],
+                 upper_bounds: Mapping[str, float] = None, average_length: float = None):
+        """Initialization by frequencies and lengths, average length is computed if absent"""
+        self.frequencies = frequencies
+        self.document_lengths = document_lengths
+        if average_length is None:
+            average_length = (
+                sum(document_lengths.values()) / len(document_lengths) if document_lengths else 0.0
+            )
+        self.average_length = average_length
+        self.upper_bounds = upper_bounds
+
+    def term_weight(self, frequency: int, document_index: int) -> float:
+        """BM25 weight of word occurring `frequency` times in document, without idf"""
+        normalized_length = self.document_lengths[document_index] / self.average_length
+        return frequency * (BM25_K1 + 1) / (
+            frequency + BM25_K1 * (1 - BM25_B + BM25_B * normalized_length)
+        )
+
+    def idf(self, document_frequency: int) -> float:
+        """BM25 inverse document frequency"""
+        documents_count = len(self.document_lengths)
+        return math.log(1 + (documents_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def compute_upper_bounds(self, index_as_dict: Dict[str, Sequence[int]]) -> None:
+        """Find maximal term weight of every word"""
+        self.upper_bounds = {
+            word: max(map(self.term_weight, self.frequencies[word], postings))
+            for word, postings in index_as_dict.items()
+        }
+
+    def dump(self, filepath: str) -> None:
+        """Save ranking data in the format which is memory-mapped by load
+
+        Layout: header (magic, documents count, average length, start of
+        frequencies), sorted document indexes and their lengths, upper bounds
+        in the order of utf-8 encoded words and 8-byte aligned frequencies
+        written by write_mapped_index.
+        """
+        document_indexes = array(POSTINGS_TYPECODE, sorted(self.document_lengths))
+        document_lengths = array(POSTINGS_TYPECODE, map(self.document_lengths.__getitem__, document_indexes))
+        upper_bounds = array(UPPER_BOUNDS_TYPECODE, [
+            self.upper_bounds[word] for word in sorted(self.frequencies, key=str.encode)
+        ])
+        upper_bounds_start = RANKING_DATA_HEADER.size + 2 * len(document_indexes) * document_indexes.itemsize
+        upper_bounds_start += -upper_bounds_start % upper_bounds.itemsize
+        frequencies_start = upper_bounds_start + len(upper_bounds) * upper_bounds.itemsize
+        with open(filepath, "wb") as fout:
+            fout.write(RANKING_DATA_HEADER.pack(
+                RANKING_DATA_MAGIC, len(document_indexes), self.average_length, frequencies_start
+            ))
+            document_indexes.tofile(fout)
+            document_lengths.tofile(fout)
+            fout.write(bytes(upper_bounds_start - fout.tell()))
+            upper_bounds.tofile(fout)
+            write_mapped_index(self.frequencies, fout)
+
+    @classmethod
+    def load(cls, filepath: str) -> RankingData:
+        """Memory-map ranking data saved by dump, nothing is parsed but the header"""
+        with open(filepath, "rb") as fin:
+            view = memoryview(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, documents_count, average_length, frequencies_start = RANKING_DATA_HEADER.unpack_from(view)
+        if magic != RANKING_DATA_MAGIC:
+            raise ValueError(f"{filepath} is not a ranking data file")
+        lengths_start = RANKING_DATA_HEADER.size + documents_count * struct.calcsize(POSTINGS_TYPECODE)
+        lengths_end = lengths_start + documents_count * struct.calcsize(POSTINGS_TYPECODE)
+        upper_bounds_start = lengths_end + -lengths_end % struct.calcsize(UPPER_BOUNDS_TYPECODE)
+        frequencies = MappedPostings(filepath, start=frequencies_start)
+        document_lengths = SortedArrayMapping(
+            view[RANKING_DATA_HEADER.size:lengths_start].cast(POSTINGS_TYPECODE),
+            view[lengths_start:lengths_end].cast(POSTINGS_TYPECODE),
+        )
+        upper_bounds = MappedWordValues(
+            frequencies, view[upper_bounds_start:frequencies_start].cast(UPPER_BOUNDS_TYPECODE)
+        )
+        return cls(frequencies, document_lengths, upper_bounds, average_length)
+
+class SortedArrayMapping(Mapping):
+    """Read-only mapping over sorted keys and values parallel to them, found by binary search"""
+    def __init__(self, keys: Sequence[int], values: Sequence):
+        self._keys, self._values = keys, values
+
+    def __getitem__(self, key: int):
+        position = bisect_left(self._keys, key)
+        if position == len(self._keys) or self._keys[position] != key:
+            raise KeyError(key)
+        return self._values[position]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+class MappedWordValues(Mapping):
+    """Read-only mapping of words of MappedPostings to values in the order of its directory"""
+    def __init__(self, words: MappedPostings, values: Sequence):
+        self._words, self._values = words, values
+
+    def __getitem__(self, word: str):
+        return self._values[self._words.find(word)]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._words)
+
+    def __len__(self) -> int:
+        return len(self._words)
+
+def maxscore_top_k(terms: List[Tuple[Sequence[int], Callable[[int], float], float]],
+                   top_k: int, is_deleted: Callable[[int], bool] = None) -> List[int]:
+    """Disjunctive top-k retrieval with MaxScore early termination
+
+    Every term is (sorted postings, score of posting by its position, upper
+    bound of score). Terms whose summed upper bounds cannot beat the k-th best
+    score are not used to generate candidates, only to complete their scores,
+    and are skipped as soon as a candidate cannot make it into the heap.
+    Returns documents by descending score, ties by ascending document index.
+    """
+    if top_k <= 0 or not terms:
+        return []
+    terms = sorted(terms, key=itemgetter(2))
+    cumulative_bounds = list(accumulate(upper_bound for _, _, upper_bound in terms))
+    positions = [0] * len(terms)
+    heap, threshold, first_essential = [], 0.0, 0
+    while first_essential < len(terms):
+        candidate = min(
+            (terms[term][0][positions[term]] for term in range(first_essential, len(terms))
+             if positions[term] < len(terms[term][0])),
+            default=None,
+        )
+        if candidate is None:
+            break
+        score = 0.0
+        for term in range(first_essential, len(terms)):
+            postings, term_score, _ = terms[term]
+            if positions[term] < len(postings) and postings[positions[term]] == candidate:
+                score += term_score(positions[term])
+                positions[term] += 1
+        for term in range(first_essential - 1, -1, -1):
+            if score + cumulative_bounds[term] < threshold:
+                break
+            postings, term_score, _ = terms[term]
+            positions[term] = gallop_to(postings, candidate, positions[term])
+            if positions[term] < len(postings) and postings[positions[term]] == candidate:
+                score += term_score(positions[term])
+        if is_deleted is not None and is_deleted(candidate):
+            continue
+        if len(heap) < top_k:
+            heapq.heappush(heap, (score, -candidate))
+        elif (score, -candidate) > heap[0]:
+            heapq.heapreplace(heap, (score, -candidate))
+        if len(heap) == top_k:
+            threshold = heap[0][0]
+            while first_essential < len(terms) and cumulative_bounds[first_essential] < threshold:
+                first_essential += 1
+    return [-negative_document for _, negative_document in sorted(heap, reverse=True)]
+
+class PositionalIndex:
+    """Delta-encoded positions of words in documents, aligned with base postings
+
+    Positions of a word are kept in one bytearray: for every posting there is
+    varint number of occurrences followed by varint gaps between positions.
+    Byte offsets of the entries are kept in array('I') parallel to postings.
+    """
+    def __init__(self, positions: Mapping[str, Sequence[int]] = None,
+                 offsets: Mapping[str, Sequence[int]] = None):
+        """Initialization by encoded positions and offsets of entries"""
+        self.positions = positions if positions is not None else {}
+        self.offsets = offsets if offsets is not None else {}
+
+    def add_document(self, words: Iterable[str]) -> None:
+        """Append entries of the next document for every word it contains"""
+        document_positions = {}
+        for position, word in enumerate(words):
+            word_positions = document_positions.get(word)
+            if word_positions is None:
+                document_positions[word] = array(POSTINGS_TYPECODE, [position])
+            else:
+                word_positions.append(position)
+        for word, word_positions in document_positions.items():
+            payload = self.positions.get(word)
+            if payload is None:
+                payload = self.positions[word] = bytearray()
+                self.offsets[word] = array(POSTINGS_TYPECODE)
+            self.offsets[word].append(len(payload))
+            append_varint(payload, len(word_positions))
+            previous = 0
+            for position in word_positions:
+                append_varint(payload, position - previous)
+                previous = position
+
+    def reorder(self, word: str, order: Sequence[int]) -> None:
+        """Permute entries of the word the same way as its postings were sorted"""
+        payload, offsets = self.positions[word], self.offsets[word]
+        ends = offsets[1:].tolist() + [len(payload)]
+        reordered_payload, reordered_offsets = bytearray(), array(POSTINGS_TYPECODE)
+        for entry in order:
+            reordered_offsets.append(len(reordered_payload))
+            reordered_payload += payload[offsets[entry]:ends[entry]]
+        self.positions[word], self.offsets[word] = reordered_payload, reordered_offsets
+
+    def iterate_positions(self, word: str, posting_position: int) -> Iterator[int]:
+        """Lazily decode positions of the word in the posting_position-th document"""
+        payload = self.positions[word]
+        count, offset = read_varint(payload, self.offsets[word][posting_position])
+        position = 0
+        for _ in range(count):
+            gap, offset = read_varint(payload, offset)
+            position += gap
+            yield position
+
+    def dump(self, filepath: str) -> None:
+        """Save positions in the format which is memory-mapped by load
+
+        Layout: header (magic, start of offsets), encoded positions and
+        4-byte aligned offsets, both written by write_mapped_index.
+        """
+        with open(filepath, "wb") as fout:
+            fout.write(bytes(POSITIONS_HEADER.size))
+            write_mapped_index(self.positions, fout, POSITIONS_TYPECODE)
+            fout.write(bytes(-fout.tell() % struct.calcsize(POSTINGS_TYPECODE)))
+            offsets_start = fout.tell()
+            write_mapped_index(self.offsets, fout)
+            fout.seek(0)
+            fout.write(POSITIONS_HEADER.pack(POSITIONS_MAGIC, offsets_start))
+
+    @classmethod
+    def load(cls, filepath: str) -> PositionalIndex:
+        """Memory-map positions saved by dump, nothing is parsed but the header"""
+        with open(filepath, "rb") as fin:
+            magic, offsets_start = POSITIONS_HEADER.unpack(fin.read(POSITIONS_HEADER.size))
+        if magic != POSITIONS_MAGIC:
+            raise ValueError(f"{filepath} is not a word positions file")
+        return cls(
+            MappedPostings(filepath, POSITIONS_TYPECODE, POSITIONS_HEADER.size),
+            MappedPostings(filepath, start=offsets_start),
+        )
+
+def has_common_value(iterators: List[Iterator[int]]) -> bool:
+    """Check whether sorted iterators share any value, consuming them lazily"""
+    current = []
+    for iterator in iterators:
+        value = next(iterator, None)
+        if value is None:
+            return False
+        current.append(value)
+    target = max(current)
+    while True:
+        for number, iterator in enumerate(iterators):
+            while current[number] < target:
+                value = next(iterator, None)
+                if value is None:
+                    return False
+                current[number] = value
+            if current[number] > target:
+                target = current[number]
+                break
+        else:
+            return True
 
 class InvertedIndex:
-    """Class for realization of Inverted Index (and relevant methods)"""
-    def __init__(self, index_as_dict: Dict[str, list]):
-        """Initialization by data as a dict"""
+    """Class for realization of Inverted Index (and relevant methods)
+
+    Besides the base data the index may have delta segments with newly added
+    documents and tombstones of deleted documents. Tombstone maps document
+    index to the number of segments at the moment of deletion: postings of the
+    base (generation 0) and of segments up to that generation are hidden.
+    Queries intersect base postings as usual and apply segments and
+    tombstones to the result afterwards.
+    """
+    def __init__(self, index_as_dict: Dict[str, list],
+                 segments: List[Dict[str, array]] = None,
+                 deleted_documents: Dict[int, int] = None,
+                 ranking_data: RankingData = None,
+                 positional_index: PositionalIndex = None):
+        """Initialization by data as a dict, delta segments, tombstones, frequencies and positions"""
         self.data = index_as_dict
+        self.segments = segments if segments is not None else []
+        self.deleted_documents = deleted_documents if deleted_documents is not None else {}
+        self.ranking_data = ranking_data
+        self.positional_index = positional_index
+
+    def postings(self, word: str) -> Optional[Sequence[int]]:
+        """Return sorted postings of the word merged over base and delta segments
+
+        Base postings are decoded and merged completely if there are any
+        segments or tombstones, so queries use apply_updates instead.
+        """
+        base_postings = self.data.get(word)
+        if not self.segments and not self.deleted_documents:
+            return base_postings
+        generations = [
+            zip(postings, repeat(generation))
+            for generation, postings in enumerate(
+                [base_postings] + [segment.get(word) for segment in self.segments]
+            )
+            if postings is not None
+        ]
+        merged_postings = array(POSTINGS_TYPECODE)
+        for document_index, generation in heapq.merge(*generations):
+            if self.deleted_documents.get(document_index, -1) >= generation:
+                continue
+            if merged_postings and merged_postings[-1] == document_index:
+                continue
+            merged_postings.append(document_index)
+        return merged_postings or None
 
     def query(self, words: List[str]) -> List[int]:
-        """Return the list of relevant documents for the given query"""
+        """Return the sorted list of relevant documents for the given query"""
         # from pdb import set_trace; set_trace()
         assert isinstance(words, list)
-        if len(words) == 0:
-            found_documents = []
-        else:
-            found_documents = self.data.get(words[0], [])
-            for word in words[1:]:
-                list_for_word = self.data.get(word, [])
-                found_documents = list(set(found_documents) & set(list_for_word))
+        postings_lists = [self.data.get(word) for word in words]
+        if None in postings_lists:
+            return self.apply_updates(words, [])
+        return self.apply_updates(words, intersect_postings(postings_lists))
+
+    def visible_segment_documents(self, word: str) -> set:
+        """Documents of delta segments containing the word and not tombstoned later"""
+        return {
+            document_index
+            for generation, segment in enumerate(self.segments, 1)
+            for document_index in segment.get(word, ())
+            if self.deleted_documents.get(document_index, -1) < generation
+        }
+
+    def apply_updates(self, words: List[str], base_documents: Sequence[int]) -> Sequence[int]:
+        """Correct intersection of base postings of words by tombstones and segments
+
+        Tombstoned documents are dropped from the base result. Documents of
+        delta segments are few, so every one of them is checked word by word:
+        it must be in the visible segment documents of the word or in its base
+        postings (found by galloping cursor) without tombstone.
+        """
+        if not self.segments and not self.deleted_documents:
+            return base_documents
+        found_documents = [
+            document_index for document_index in base_documents
+            if document_index not in self.deleted_documents
+        ]
+        segment_documents = [self.visible_segment_documents(word) for word in words]
+        candidates = set().union(*segment_documents).difference(found_documents)
+        if not candidates:
+            return found_documents
+        cursors = []
+        for word in words:
+            postings = self.data.get(word)
+            cursors.append(make_postings_cursor(postings) if postings is not None else None)
+        added_documents = [
+            document_index for document_index in sorted(candidates)
+            if all(
+                document_index in documents
+                or (cursor is not None and document_index not in self.deleted_documents
+                    and cursor(document_index) == document_index)
+                for documents, cursor in zip(segment_documents, cursors)
+            )
+        ]
+        return list(heapq.merge(found_documents, added_documents))
+
+    def rank_query(self, words: List[str], top_k: int = DEFAULT_TOP_K) -> List[int]:
+        """Return top_k documents containing any of words ranked by BM25
+
+        Ranking uses the base index only: documents of delta segments are not
+        ranked, tombstoned documents are skipped.
+        """
+        if self.ranking_data is None:
+            raise ValueError("index has no term frequencies, build it with --with-frequencies")
+        terms = []
+        for word in set(words):
+            postings = self.data.get(word)
+            if postings is None:
+                continue
+            if not hasattr(postings, "__getitem__"):
+                postings = array(POSTINGS_TYPECODE, postings)
+            frequencies = self.ranking_data.frequencies[word]
+            idf = self.ranking_data.idf(len(postings))
+
+            def term_score(position, postings=postings, frequencies=frequencies, idf=idf):
+                return idf * self.ranking_data.term_weight(frequencies[position], postings[position])
+            terms.append((postings, term_score, idf * self.ranking_data.upper_bounds[word]))
+        return maxscore_top_k(terms, top_k, self.deleted_documents.__contains__)
+
+    def phrase_query(self, words: List[str]) -> List[int]:
+        """Return the sorted list of documents containing words one right after another
+
+        Candidates are found by intersection of base postings, then positions of
+        every word shifted by its place in the phrase are merged lazily until a
+        common start is found. Documents of delta segments are not searched,
+        tombstoned documents are skipped.
+        """
+        if self.positional_index is None:
+            raise ValueError("index has no word positions, build it with --with-positions")
+        if not words:
+            return []
+        postings_lists = []
+        for word in words:
+            postings = self.data.get(word)
+            if postings is None:
+                return []
+            if not hasattr(postings, "__getitem__"):
+                postings = array(POSTINGS_TYPECODE, postings)
+            postings_lists.append(postings)
+        cursors = [0] * len(words)
+        found_documents = []
+        for document_index in intersect_postings(postings_lists):
+            if document_index in self.deleted_documents:
+                continue
+            shifted_positions = []
+            for shift, (word, postings) in enumerate(zip(words, postings_lists)):
+                cursors[shift] = gallop_to(postings, document_index, cursors[shift])
+                shifted_positions.append(map(
+                    sub, self.positional_index.iterate_positions(word, cursors[shift]), repeat(shift)
+                ))
+            if has_common_value(shifted_positions):
+                found_documents.append(document_index)
         return found_documents
 
+    def add_documents(self, documents: Iterable[Tuple[int, Iterable[str]]]) -> Dict[str, array]:
+        """Index documents into new delta segment and return it"""
+        segment = build_inverted_index_from_stream(documents).data
+        self.segments.append(segment)
+        return segment
+
+    def delete_documents(self, document_indexes: Iterable[int]) -> None:
+        """Tombstone documents in the base and all existing segments"""
+        for document_index in document_indexes:
+            self.deleted_documents[document_index] = len(self.segments)
+
+    def compact(self) -> InvertedIndex:
+        """Fold delta segments and tombstones into new base index"""
+        words = dict.fromkeys(self.data)
+        for segment in self.segments:
+            words.update(dict.fromkeys(segment))
+        index_as_dict = {}
+        for word in words:
+            postings = self.postings(word)
+            if postings is not None:
+                index_as_dict[word] = array(POSTINGS_TYPECODE, postings)
+        return InvertedIndex(index_as_dict)
+
     def dump(self, filepath: str, strategy: str) -> None:
-        """Save data into json"""
+        """Save data with registered storage policy, drop delta segments of the previous base"""
         print(f"Dumping inverted index into {filepath}...", file=sys.stderr)
+        storage_policy = get_storage_policy(strategy)
+        if storage_policy is None:
+            print(f"{strategy} strategy is not implemeted yet", file=sys.stderr)
+            return
 
         pathlib_filepath = pathlib.Path(filepath)
         pathlib_filepath.parent.mkdir(parents=True, exist_ok=True)
-
-        # from pdb import set_trace; set_trace()
-        if strategy == 'json':
-            with open(filepath, 'w') as fout:
-                json.dump(self.data, fout)
-        elif strategy == 'struct':
-            pairs, values = [], []
-
-            for key, value in self.data.items():
-                pairs.append([key, len(value)])
-                values.extend(value)  # List[int]
-            header = json.dumps(pairs).encode()
-            meta = len(header)
-
-            with open(filepath, "wb") as fout:
-                fout.write(pack('I', meta))
-                fout.write(pack(f'{meta}s', header))
-                fout.write(pack(f'{len(values)}H', *values))
-        else:
-            print(f"{strategy} strategy is not implemeted yet", file=sys.stderr)
+        with index_writer_lock(filepath):
+            drop_segments(filepath)
+            storage_policy.dump(self.data, filepath)
+        if self.ranking_data is not None:
+            self.ranking_data.dump(f"{filepath}{RANKING_DATA_SUFFIX}")
+        if self.positional_index is not None:
+            self.positional_index.dump(f"{filepath}{POSITIONS_SUFFIX}")
 
     @classmethod
-    def load(cls, filepath: str, strategy: str) -> InvertedIndex:
-        """Load data from file"""
-        if strategy == "json":
-            with open(filepath, 'r') as fin:
-                loaded_dict = json.load(fin)
-            return InvertedIndex(loaded_dict)
-        elif strategy == "struct":
-            with open(filepath, 'rb') as fin:
-                fileContent = fin.read()
-                meta_size = calcsize('I')
-                header_size, = unpack('I', fileContent[:meta_size])
-                header, = unpack(f'{header_size}s', fileContent[meta_size:(header_size+meta_size)])
-                pairs = json.loads(header.decode())
-                body = fileContent[(header_size+meta_size):]
-                loaded_dict = {}
-                for pair in pairs:
-                    uns_short_size = 2
-                    if pair[1] == 1:
-                        element, = unpack(f"{pair[1]}H", body[:uns_short_size*pair[1]])
-                        loaded_dict[pair[0]] = [element]
-                    else:
-                        element = unpack(f"{pair[1]}H", body[:uns_short_size*pair[1]])
-                        loaded_dict[pair[0]] = list(element)
-                    body = body[uns_short_size*pair[1]:]
-                # from pdb import set_trace; set_trace()
-            return InvertedIndex(loaded_dict)
-        else:
+    def load(cls, filepath: str, strategy: str, manifest: dict = None) -> InvertedIndex:
+        """Load data with registered storage policy, together with delta segments
+
+        The base and segments are taken from the manifest. If it is not
+        provided, it is read from disk and reread when its files have been
+        removed by compaction meanwhile.
+        """
+        storage_policy = get_storage_policy(strategy)
+        if storage_policy is None:
             print(f"{strategy} strategy is not implemeted yet", file=sys.stderr)
             return None
+        if manifest is not None:
+            return cls.load_with_manifest(filepath, storage_policy, manifest)
+        manifest = load_segments_manifest(filepath)
+        while True:
+            try:
+                return cls.load_with_manifest(filepath, storage_policy, manifest)
+            except FileNotFoundError:
+                current_manifest = load_segments_manifest(filepath)
+                if current_manifest == manifest:
+                    raise
+                manifest = current_manifest
+
+    @classmethod
+    def load_with_manifest(cls, filepath: str, storage_policy: StoragePolicy,
+                           manifest: dict) -> InvertedIndex:
+        """Load base and delta segments named in the manifest"""
+        segments = [
+            storage_policy.load(segment_path(filepath, segment_name))
+            for segment_name in manifest["segments"]
+        ]
+        ranking_data_path = f"{filepath}{RANKING_DATA_SUFFIX}"
+        ranking_data = RankingData.load(ranking_data_path) if os.path.exists(ranking_data_path) else None
+        positions_path = f"{filepath}{POSITIONS_SUFFIX}"
+        positional_index = PositionalIndex.load(positions_path) if os.path.exists(positions_path) else None
+        return InvertedIndex(storage_policy.load(base_path(filepath, manifest)), segments,
+                             manifest["deleted"], ranking_data, positional_index)
 
     def __eq__(self, rhs):
-        """Compare objects by stored data"""
+        """Compare objects by stored data (postings may be lists or arrays)"""
         outcome = (
-            self.data == rhs.data
+            self.data.keys() == rhs.data.keys()
+            and all(list(postings) == list(rhs.data[word])
+                    for word, postings in self.data.items())
         )
         return outcome
 
+def segment_path(index_path: str, segment_name: str) -> str:
+    """Path of delta segment file stored next to the base index"""
+    return os.path.join(os.path.dirname(index_path), segment_name)
+
+def base_path(index_path: str, manifest: dict) -> str:
+    """Path of the base data: compacted base named in manifest or the index itself"""
+    if "base" in manifest:
+        return segment_path(index_path, manifest["base"])
+    return index_path
+
+@contextmanager
+def index_writer_lock(index_path: str) -> Iterator[None]:
+    """Hold exclusive lock file of index, serialising writers of its manifest"""
+    with open(f"{index_path}{WRITER_LOCK_SUFFIX}", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def drop_segments(index_path: str) -> None:
+    """Remove manifest with delta segments, compacted base and obsolete files of index (under writer lock)"""
+    manifest = load_segments_manifest(index_path)
+    save_segments_manifest(index_path, {"segments": [], "deleted": {}})
+    remove_index_files(index_path, manifest["segments"] + [manifest.get("base")] + manifest.get("obsolete", []))
+
+def remove_index_files(index_path: str, file_names: Iterable[Optional[str]]) -> None:
+    """Remove existing files stored next to the base index"""
+    for file_name in file_names:
+        if file_name is not None and os.path.exists(segment_path(index_path, file_name)):
+            os.remove(segment_path(index_path, file_name))
+
+def load_segments_manifest(index_path: str) -> dict:
+    """Read compacted base name, delta segments and tombstones of index (empty if absent)"""
+    manifest_path = f"{index_path}{SEGMENTS_MANIFEST_SUFFIX}"
+    if not os.path.exists(manifest_path):
+        return {"segments": [], "deleted": {}}
+    with open(manifest_path, encoding="utf-8") as fin:
+        manifest = json.load(fin)
+    manifest["deleted"] = {
+        int(document_index): generation
+        for document_index, generation in manifest["deleted"].items()
+    }
+    return manifest
+
+def save_segments_manifest(index_path: str, manifest: dict) -> None:
+    """Atomically replace manifest of index, remove it if there is nothing to store"""
+    manifest_path = f"{index_path}{SEGMENTS_MANIFEST_SUFFIX}"
+    if not manifest["segments"] and not manifest["deleted"] and "base" not in manifest \
+            and not manifest.get("obsolete"):
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        return
+    temporary_path = f"{manifest_path}.{uuid4().hex}"
+    with open(temporary_path, "w", encoding="utf-8") as fout:
+        json.dump(manifest, fout)
+    os.replace(temporary_path, manifest_path)
+
+def update_index(index_path: str, strategy: str,
+                 documents: Iterable[Tuple[int, Iterable[str]]] = (),
+                 deleted_document_indexes: Iterable[int] = ()) -> None:
+    """Tombstone deleted documents and store added ones as a new delta segment
+
+    Documents which are both deleted and added are replaced by the new version.
+    The base index is not rewritten, so the cost depends on changes only. The
+    segment is written aside, the manifest is changed under the writer lock.
+    """
+    storage_policy = get_storage_policy(strategy)
+    deleted_document_indexes = list(deleted_document_indexes)
+    segment = build_inverted_index_from_stream(documents).data
+    segment_name = None
+    if segment:
+        segment_name = f"{os.path.basename(index_path)}.segment-{uuid4().hex}"
+        print(f"Dumping delta segment {segment_name}...", file=sys.stderr)
+        storage_policy.dump(segment, segment_path(index_path, segment_name))
+    with index_writer_lock(index_path):
+        manifest = load_segments_manifest(index_path)
+        for document_index in deleted_document_indexes:
+            manifest["deleted"][document_index] = len(manifest["segments"])
+        if segment_name is not None:
+            manifest["segments"].append(segment_name)
+        save_segments_manifest(index_path, manifest)
+
+def compaction_error(index_path: str) -> Optional[str]:
+    """Reason why index cannot be compacted, None if it can"""
+    sidecar_names = [
+        name for suffix, name in [(RANKING_DATA_SUFFIX, "term frequencies"), (POSITIONS_SUFFIX, "word positions")]
+        if os.path.exists(f"{index_path}{suffix}")
+    ]
+    if sidecar_names:
+        return (f"{index_path} has {' and '.join(sidecar_names)} which compaction cannot rebuild, "
+                "rebuild the index with build instead")
+    return None
+
+def compact_index(index_path: str, strategy: str) -> None:
+    """Fold delta segments into the base index
+
+    The new base is written aside under a new name, then the manifest naming
+    it is published under the writer lock, so readers see either the old base
+    with its segments and tombstones or the new one. Segments and tombstones
+    which appeared while compacting are kept in the manifest. The old base and
+    segments are listed as obsolete and removed by the next compaction, so
+    readers of the old manifest can still load them. Indexes with term
+    frequencies or word positions are not compacted, since delta segments
+    have neither of them.
+    """
+    error = compaction_error(index_path)
+    if error is not None:
+        raise ValueError(error)
+    compacted_manifest = load_segments_manifest(index_path)
+    if not compacted_manifest["segments"] and not compacted_manifest["deleted"]:
+        print("Nothing to compact", file=sys.stderr)
+        return
+    compacted_index = InvertedIndex.load(index_path, strategy, compacted_manifest).compact()
+    compacted_base_name = f"{os.path.basename(index_path)}.base-{uuid4().hex}"
+    storage_policy = get_storage_policy(strategy)
+    print(f"Dumping compacted base {compacted_base_name}...", file=sys.stderr)
+    storage_policy.dump(compacted_index.data, segment_path(index_path, compacted_base_name))
+
+    compacted_segments_count = len(compacted_manifest["segments"])
+    with index_writer_lock(index_path):
+        current_manifest = load_segments_manifest(index_path)
+        save_segments_manifest(index_path, {
+            "base": compacted_base_name,
+            "segments": current_manifest["segments"][compacted_segments_count:],
+            "deleted": {
+                document_index: max(generation - compacted_segments_count, 0)
+                for document_index, generation in current_manifest["deleted"].items()
+                if compacted_manifest["deleted"].get(document_index) != generation
+            },
+            "obsolete": [compacted_manifest.get("base", os.path.basename(index_path))]
+                        + compacted_manifest["segments"],
+        })
+        remove_index_files(index_path, current_manifest.get("obsolete", []))
+
+def start_background_compaction(index_path: str, strategy: str) -> threading.Thread:
+    """Run compact_index in a separate thread of the current process"""
+    compaction = threading.Thread(target=compact_index, args=(index_path, strategy),
+                                  name="inverted-index-compaction")
+    compaction.start()
+    return compaction
+
 def load_documents(filepath: str) -> Dict[int, str]:
     """Read documnets from .txt file"""
     print(f"Loading documents from {filepath}...", file=sys.stderr)
@@ -108,19 +820,182 @@ def load_documents(filepath: str) -> Dict[int, str]:
             loaded_dict[int(document_index)] = document_text #re.split(r"\W+", document_text)
     return loaded_dict
 
-def build_inverted_index(documents: Dict[int, str]) -> InvertedIndex:
-    """Build InvertedIndex object from list of documents"""
+def iterate_documents(filepath: str, start: int = 0, end: int = None,
+                      tokenizer: Tokenizer = DEFAULT_TOKENIZER) -> Iterator[Tuple[int, List[str]]]:
+    """Lazily read documents from .txt file line by line and yield (index, words)
+
+    Only lines beginning inside the byte range [start, end) are read, start is
+    expected to point to the beginning of a line.
+    """
+    print(f"Streaming documents from {filepath}[{start}:{end}]...", file=sys.stderr)
+    with open(filepath, 'rb') as fin:
+        fin.seek(start)
+        position = start
+        while end is None or position < end:
+            raw_line = fin.readline()
+            if not raw_line:
+                break
+            position += len(raw_line)
+            line = raw_line.decode('utf-8').rstrip('\r\n')
+            if not line.strip():
+                continue
+            document_index, document_text = line.lower().split('\t', 1)
+            yield int(document_index), tokenizer.tokenize(document_text)
+
+def split_dataset_into_ranges(filepath: str, parts: int) -> List[Tuple[int, int]]:
+    """Split file into at most `parts` byte ranges aligned to line boundaries"""
+    file_size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as fin:
+        for part in range(1, parts):
+            position = max(file_size * part // parts, boundaries[-1])
+            if position > 0:
+                fin.seek(position - 1)
+                fin.readline()
+                position = fin.tell()
+            boundaries.append(min(position, file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+def build_inverted_index(documents: Dict[int, str],
+                         tokenizer: Tokenizer = DEFAULT_TOKENIZER,
+                         with_positions: bool = False) -> InvertedIndex:
+    """Build InvertedIndex object from list of documents, optionally with word positions"""
+    if with_positions:
+        return build_inverted_index_from_stream(
+            ((document_index, tokenizer.tokenize(document_text))
+             for document_index, document_text in documents.items()),
+            with_positions=True,
+        )
     print("Building Inverteed index...", file=sys.stderr)
     index_as_dict = {}
     for document_index in documents.keys():
-        words = list(set(re.split(r"\W+", documents[document_index])))
+        words = list(set(tokenizer.tokenize(documents[document_index])))
         for word in words:
             if index_as_dict.get(word) is None:
                 index_as_dict[word] = [document_index]
             else:
-                index_as_dict[word] = index_as_dict[word] + [document_index]
+                index_as_dict[word].append(document_index)
     return InvertedIndex(index_as_dict)
 
+def build_compact_inverted_index(documents: Dict[int, str],
+                                 tokenizer: Tokenizer = DEFAULT_TOKENIZER) -> InvertedIndex:
+    """Build InvertedIndex object with append-only array('I') posting lists"""
+    return build_inverted_index_from_stream(
+        (document_index, tokenizer.tokenize(document_text))
+        for document_index, document_text in documents.items()
+    )
+
+def build_inverted_index_from_stream(documents: Iterable[Tuple[int, Iterable[str]]],
+                                     with_frequencies: bool = False,
+                                     with_positions: bool = False) -> InvertedIndex:
+    """Build InvertedIndex object from (document_index, words) pairs
+
+    Every posting list is an array('I') growing in place, so build time is
+    linear in the number of (word, document) pairs, and only postings are kept
+    in memory while documents are consumed one by one. Words are visited in the
+    same order as in build_inverted_index, hence dumps are byte-identical.
+    Posting lists are sorted afterwards if documents came out of order.
+    With frequencies, RankingData for BM25 is collected as well, with positions
+    PositionalIndex for phrase queries.
+    """
+    print("Building compact Inverted index...", file=sys.stderr)
+    index_as_dict = {}
+    frequencies, document_lengths = {}, {}
+    positional_index = PositionalIndex() if with_positions else None
+    previous_document_index, is_sorted = -1, True
+    for document_index, words in documents:
+        is_sorted = is_sorted and previous_document_index < document_index
+        previous_document_index = document_index
+        if with_frequencies or with_positions:
+            words = list(words)
+        if with_positions:
+            positional_index.add_document(words)
+        if with_frequencies:
+            document_lengths[document_index] = len(words)
+            word_counts = Counter(words)
+        else:
+            word_counts = dict.fromkeys(set(words))
+        for word, count in word_counts.items():
+            postings = index_as_dict.get(word)
+            if postings is None:
+                index_as_dict[word] = array(POSTINGS_TYPECODE, [document_index])
+                if with_frequencies:
+                    frequencies[word] = array(POSTINGS_TYPECODE, [count])
+            else:
+                postings.append(document_index)
+                if with_frequencies:
+                    frequencies[word].append(count)
+    if not is_sorted:
+        for word, postings in index_as_dict.items():
+            order = sorted(range(len(postings)), key=postings.__getitem__)
+            index_as_dict[word] = array(POSTINGS_TYPECODE, map(postings.__getitem__, order))
+            if with_frequencies:
+                frequencies[word] = array(POSTINGS_TYPECODE, map(frequencies[word].__getitem__, order))
+            if with_positions:
+                positional_index.reorder(word, order)
+    ranking_data = None
+    if with_frequencies:
+        ranking_data = RankingData(frequencies, document_lengths)
+        ranking_data.compute_upper_bounds(index_as_dict)
+    return InvertedIndex(index_as_dict, ranking_data=ranking_data, positional_index=positional_index)
+
+def build_shard(dataset_path: str, start: int, end: int,
+                tokenizer: Tokenizer = DEFAULT_TOKENIZER) -> Tuple[List[str], array, array]:
+    """Build partial index for byte range of dataset and pack it into arrays
+
+    Returns sorted words, posting list lengths and all sorted posting lists
+    concatenated, so only flat arrays are pickled back to the parent process.
+    """
+    shard = build_inverted_index_from_stream(iterate_documents(dataset_path, start, end, tokenizer))
+    words = sorted(shard.data)
+    counts = array(POSTINGS_TYPECODE)
+    postings = array(POSTINGS_TYPECODE)
+    for word in words:
+        word_postings = shard.data[word]
+        counts.append(len(word_postings))
+        postings.extend(sorted(word_postings))
+    return words, counts, postings
+
+def _iterate_shard(shard: Tuple[List[str], array, array]) -> Iterator[Tuple[str, memoryview]]:
+    """Yield (word, postings) pairs of packed shard without copying postings"""
+    words, counts, postings = shard
+    postings_view = memoryview(postings)
+    offset = 0
+    for word, count in zip(words, counts):
+        yield word, postings_view[offset:offset + count]
+        offset += count
+
+def merge_shards(shards: List[Tuple[List[str], array, array]]) -> InvertedIndex:
+    """K-way merge of packed shards into one InvertedIndex with sorted postings"""
+    print(f"Merging {len(shards)} shards...", file=sys.stderr)
+    index_as_dict = {}
+    merged_words = heapq.merge(*map(_iterate_shard, shards), key=itemgetter(0))
+    for word, group in groupby(merged_words, key=itemgetter(0)):
+        index_as_dict[word] = array(
+            POSTINGS_TYPECODE, heapq.merge(*(postings for _, postings in group))
+        )
+    return InvertedIndex(index_as_dict)
+
+def build_inverted_index_in_parallel(dataset_path: str, workers: int,
+                                     tokenizer: Tokenizer = DEFAULT_TOKENIZER) -> InvertedIndex:
+    """Build shards of dataset in worker processes and merge them"""
+    ranges = split_dataset_into_ranges(dataset_path, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shards = list(executor.map(
+            build_shard, repeat(dataset_path),
+            (start for start, _ in ranges), (end for _, end in ranges), repeat(tokenizer),
+        ))
+    return merge_shards(shards)
+
+def add_stop_words_argument(parser) -> None:
+    """Add option with stop words file shared by build and query commands"""
+    parser.add_argument(
+        "--stop-words", dest="stop_words_path",
+        help="path to file with stop words (one per line) to drop from documents and queries",
+        default=None,
+    )
+
 def setup_parser(parser):
     """Determine the set of parameters for CLI"""
     subparsers = parser.add_subparsers(help="choose command")
@@ -133,7 +1008,7 @@ def setup_parser(parser):
     build_parser.add_argument(
         "-s", "--strategy",
         help="pick the storage strategy",
-        choices=['json', 'struct'],
+        choices=sorted(STORAGE_POLICIES),
         default=DEFAULT_STORAGE_POLICY
     )
     build_parser.add_argument(
@@ -146,7 +1021,21 @@ def setup_parser(parser):
         help="path to dump builded inverted index",
         default=DEFAULT_OUTPUT_PATH,
     )
-    build_parser.set_defaults(callback=callback_build)
+    build_parser.add_argument(
+        "-w", "--workers", type=int,
+        help="number of processes to build index shards in",
+        default=1,
+    )
+    build_parser.add_argument(
+        "--with-frequencies", action="store_true",
+        help="store term frequencies and document lengths for ranking (single worker only)",
+    )
+    build_parser.add_argument(
+        "--with-positions", action="store_true",
+        help="store positions of words for phrase queries (single worker only)",
+    )
+    add_stop_words_argument(build_parser)
+    build_parser.set_defaults(callback=callback_build, error=build_parser.error)
 
     query_parser = subparsers.add_parser(
         "query", help="query inverted index",
@@ -160,7 +1049,7 @@ def setup_parser(parser):
     query_parser.add_argument(
         "-s", "--strategy",
         help="pick the storage strategy",
-        choices=['json', 'struct'],
+        choices=sorted(STORAGE_POLICIES),
         default=DEFAULT_STORAGE_POLICY
     )
     query_source_group = query_parser.add_mutually_exclusive_group(required=True)
@@ -179,43 +1068,516 @@ def setup_parser(parser):
         type=FileType("r", encoding="utf-8"),
         help="file with queries in utf-8"
     )
+    query_parser.add_argument(
+        "--rank", choices=["bm25"],
+        help="return top documents containing any word ranked by the given model",
+    )
+    query_parser.add_argument(
+        "--phrase", action="store_true",
+        help="return documents containing query words one right after another",
+    )
+    query_parser.add_argument(
+        "--top-k", type=int, dest="top_k",
+        help="number of documents returned by ranked query",
+        default=DEFAULT_TOP_K,
+    )
+    query_parser.add_argument(
+        "--batch", action="store_true",
+        help="stream queries, cache repeated queries and shared word prefixes",
+    )
+    query_parser.add_argument(
+        "--cache-size", type=int,
+        help="maximal number of intersections cached in batch mode",
+        default=DEFAULT_CACHE_SIZE,
+    )
+    add_stop_words_argument(query_parser)
     query_parser.set_defaults(callback=callback_query)
 
+    update_parser = subparsers.add_parser(
+        "update", help="add and delete documents as delta segment of inverted index",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    update_parser.add_argument(
+        "-i", "--index", dest='input',
+        help="path to inverted index to update",
+        default=DEFAULT_OUTPUT_PATH,
+    )
+    update_parser.add_argument(
+        "-s", "--strategy",
+        help="pick the storage strategy",
+        choices=sorted(STORAGE_POLICIES),
+        default=DEFAULT_STORAGE_POLICY
+    )
+    update_parser.add_argument(
+        "-a", "--add", dest="dataset_path",
+        help="path to dataset with new (or changed) documents",
+    )
+    update_parser.add_argument(
+        "--delete", nargs="+", type=int, dest="deleted_document_indexes",
+        metavar="DOCUMENT_INDEX", default=[],
+        help="indexes of documents to delete",
+    )
+    add_stop_words_argument(update_parser)
+    update_parser.set_defaults(callback=callback_update)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="fold delta segments into inverted index with low priority",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    compact_parser.add_argument(
+        "-i", "--index", dest='input',
+        help="path to inverted index to compact",
+        default=DEFAULT_OUTPUT_PATH,
+    )
+    compact_parser.add_argument(
+        "-s", "--strategy",
+        help="pick the storage strategy",
+        choices=sorted(STORAGE_POLICIES),
+        default=DEFAULT_STORAGE_POLICY
+    )
+    compact_parser.add_argument(
+        "--niceness", type=int,
+        help="increment of process niceness while compacting",
+        default=DEFAULT_COMPACTION_NICENESS,
+    )
+    compact_parser.set_defaults(callback=callback_compact, error=compact_parser.error)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="load inverted index once and answer queries over Unix socket",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    serve_parser.add_argument(
+        "-i", "--index", dest='input',
+        help="path to read inverted index",
+        default=DEFAULT_OUTPUT_PATH,
+    )
+    serve_parser.add_argument(
+        "-s", "--strategy",
+        help="pick the storage strategy",
+        choices=sorted(STORAGE_POLICIES),
+        default=DEFAULT_STORAGE_POLICY
+    )
+    serve_parser.add_argument(
+        "--socket", dest="socket_path",
+        help="path to Unix socket to listen",
+        default=DEFAULT_SOCKET_PATH,
+    )
+    serve_parser.add_argument(
+        "--batch-size", type=int,
+        help="maximal number of queries answered in one batch",
+        default=DEFAULT_BATCH_SIZE,
+    )
+    add_stop_words_argument(serve_parser)
+    serve_parser.set_defaults(callback=callback_serve)
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark",
+        help="build inverted index and measure every storage strategy",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    benchmark_parser.add_argument(
+        "-d", "--dataset", dest="dataset_path",
+        help="path to dataset to load",
+        default=DEFAULT_DATASET_PATH,
+    )
+    benchmark_parser.add_argument(
+        "-o", "--output-dir", dest="output_dir",
+        help="directory to dump inverted index in every strategy",
+        default=".",
+    )
+    benchmark_parser.set_defaults(callback=callback_benchmark)
+
 
 def callback_build(arguments):
     """Determine behaviour for BUILD command"""
+    if arguments.workers > 1 and arguments.with_frequencies:
+        arguments.error("--with-frequencies is supported by single worker build only")
+    if arguments.workers > 1 and arguments.with_positions:
+        arguments.error("--with-positions is supported by single worker build only")
     print(f"call build subcommand with arguments= {arguments}", file=sys.stderr)
-    process_build(arguments.strategy, arguments.dataset_path, arguments.output_path)
+    process_build(arguments.strategy, arguments.dataset_path, arguments.output_path,
+                  arguments.workers, arguments.with_frequencies, arguments.stop_words_path,
+                  arguments.with_positions)
 
-def process_build(strategy, dataset_path, output_path):
+def process_build(strategy, dataset_path, output_path, workers=1, with_frequencies=False,
+                  stop_words_path=None, with_positions=False):
     """Method to run (and test) build functionality"""
-    documents = load_documents(dataset_path)
-    inverted_index = build_inverted_index(documents)
+    tokenizer = Tokenizer.from_stop_words_file(stop_words_path)
+    if workers > 1:
+        if with_frequencies:
+            raise ValueError("term frequencies can be stored by single worker build only")
+        if with_positions:
+            raise ValueError("word positions can be stored by single worker build only")
+        inverted_index = build_inverted_index_in_parallel(dataset_path, workers, tokenizer)
+    else:
+        inverted_index = build_inverted_index_from_stream(
+            iterate_documents(dataset_path, tokenizer=tokenizer), with_frequencies, with_positions
+        )
     inverted_index.dump(output_path, strategy)
 
 def callback_query(arguments) -> None:
     """Determine behaviour for QUERY command"""
     print(f"call query subcommand with arguments= {arguments}", file=sys.stderr)
-    process_query(arguments.input, arguments.strategy, arguments.queries, arguments.query_fileio)
+    process_query(arguments.input, arguments.strategy, arguments.queries, arguments.query_fileio,
+                  arguments.batch, arguments.cache_size, arguments.rank, arguments.top_k,
+                  arguments.stop_words_path, arguments.phrase)
 
 def process_query(input_path: str, strategy: str, queries_str: List[List[str]],
-                  query_fileio: TextIOWrapper) -> None:
+                  query_fileio: TextIOWrapper, batch: bool = False,
+                  cache_size: int = DEFAULT_CACHE_SIZE, rank: str = None,
+                  top_k: int = DEFAULT_TOP_K, stop_words_path: str = None,
+                  phrase: bool = False) -> None:
     """Method to run (and test) query functionality"""
     inverted_index = InvertedIndex.load(input_path, strategy)
+    tokenizer = Tokenizer.from_stop_words_file(stop_words_path, intern_words=batch)
+    if queries_str:
+        queries_str = [tokenizer.filter(query) for query in queries_str]
+    if phrase:
+        queries = queries_str or iterate_query_file(query_fileio, tokenizer, ordered=True)
+        for query in queries:
+            print(format_query_result(inverted_index.phrase_query(query)))
+        return
+    if rank:
+        queries = queries_str or iterate_query_file(query_fileio, tokenizer)
+        for query in queries:
+            print(format_query_result(inverted_index.rank_query(query, top_k)))
+        return
+    if batch:
+        queries = queries_str or iterate_query_file(query_fileio, tokenizer)
+        cache = QueryResultCache(cache_size)
+        make_batch_query_for_requested_words(inverted_index, queries, cache)
+        print(f"cache hit ratio {cache.hit_ratio:.3f} "
+              f"({cache.hits} of {cache.hits + cache.misses} queries), "
+              f"{cache.prefix_hits} reused prefixes", file=sys.stderr)
+        return
     if queries_str:
         queries = queries_str
     else:
         lines = query_fileio.read().strip().split('\n')
         queries = []
         for line in lines:
-            queries.append(list(set(re.split(r"\W+", line))))
+            queries.append(parse_query_line(line, tokenizer))
     make_query_for_requested_words(inverted_index, queries)
 
-def make_query_for_requested_words(inverted_index: InvertedIndex, queries: List[List[str]]) -> None:
-    """Run queries against Index and print output to console"""
+def parse_query_line(line: str, tokenizer: Tokenizer = DEFAULT_TOKENIZER) -> List[str]:
+    """Split one line of query file into unique words"""
+    return list(set(tokenizer.tokenize(line)))
+
+def format_query_result(document_ids: Iterable[int]) -> str:
+    """Represent found documents as one line of output"""
+    return ",".join(map(str, document_ids))
+
+def make_query_for_requested_words(inverted_index: InvertedIndex, queries: List[List[str]],
+                                   fileio: TextIO = None) -> None:
+    """Run queries against Index and print output to console (or fileio)"""
     for query in queries:
         document_ids = inverted_index.query(query)
-        print(",".join(map(str, document_ids)))
+        print(format_query_result(document_ids), file=fileio)
+
+def iterate_query_file(query_fileio: TextIO, tokenizer: Tokenizer = DEFAULT_TOKENIZER,
+                       ordered: bool = False) -> Iterator[List[str]]:
+    """Lazily parse query file line by line
+
+    Queries are the same as of the whole file read and stripped: leading blank
+    lines are dropped, blank lines are yielded only if some query follows them,
+    and a file without queries gives one empty query. Ordered queries keep all
+    words in their order, as phrase queries need.
+    """
+    pending_blank_lines = 0
+    has_queries = False
+    for line in query_fileio:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if has_queries:
+                pending_blank_lines += 1
+            continue
+        for _ in range(pending_blank_lines):
+            yield []
+        pending_blank_lines = 0
+        has_queries = True
+        yield tokenizer.tokenize(line) if ordered else parse_query_line(line, tokenizer)
+    if not has_queries:
+        yield []
+
+class QueryResultCache:
+    """Bounded LRU cache of intersections keyed by the tuple of query words"""
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        """Initialization by maximal number of stored intersections"""
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.prefix_hits = 0
+        self._results = OrderedDict()
+
+    @property
+    def hit_ratio(self) -> float:
+        """Share of queries answered from cache without intersection"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, words: Tuple[str, ...]) -> Optional[Tuple[int, ...]]:
+        """Return cached intersection and mark it as recently used"""
+        result = self._results.get(words)
+        if result is not None:
+            self._results.move_to_end(words)
+        return result
+
+    def put(self, words: Tuple[str, ...], result: Tuple[int, ...]) -> None:
+        """Store intersection evicting the least recently used one"""
+        self._results[words] = result
+        self._results.move_to_end(words)
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+def query_with_cache(inverted_index: InvertedIndex, words: Iterable[str],
+                     cache: QueryResultCache) -> Tuple[int, ...]:
+    """Answer query reusing cached intersections of the same query or its prefix
+
+    Unique words are ordered from rarest to most common (ties by word), so
+    queries sharing rare words share prefixes. Intersection starts from the
+    longest cached prefix, every new prefix is cached. Cache keeps
+    intersections of base postings, delta segments and tombstones are
+    applied to the result.
+    """
+    words = list(words)
+    return tuple(inverted_index.apply_updates(
+        words, intersect_base_postings_with_cache(inverted_index, words, cache)
+    ))
+
+def intersect_base_postings_with_cache(inverted_index: InvertedIndex, words: List[str],
+                                       cache: QueryResultCache) -> Tuple[int, ...]:
+    """Intersect base postings of words through query result cache"""
+    postings_by_word = {}
+    for word in set(words):
+        postings = inverted_index.data.get(word)
+        if postings is None:
+            return ()
+        postings_by_word[word] = postings
+    plan = tuple(sorted(postings_by_word, key=lambda word: (len(postings_by_word[word]), word)))
+    if not plan:
+        return ()
+
+    found_documents = cache.get(plan)
+    if found_documents is not None:
+        cache.hits += 1
+        return found_documents
+    cache.misses += 1
+
+    prefix_length = len(plan) - 1
+    while prefix_length > 0:
+        found_documents = cache.get(plan[:prefix_length])
+        if found_documents is not None:
+            cache.prefix_hits += 1
+            break
+        prefix_length -= 1
+    if found_documents is None:
+        prefix_length = 1
+        found_documents = tuple(postings_by_word[plan[0]])
+        cache.put(plan[:1], found_documents)
+    for prefix_length in range(prefix_length + 1, len(plan) + 1):
+        found_documents = tuple(intersect_postings(
+            [found_documents, postings_by_word[plan[prefix_length - 1]]]
+        ))
+        cache.put(plan[:prefix_length], found_documents)
+    return found_documents
+
+def make_batch_query_for_requested_words(inverted_index: InvertedIndex,
+                                         queries: Iterable[List[str]],
+                                         cache: QueryResultCache, fileio: TextIO = None) -> None:
+    """Run queries through cache and write output in chunks to console (or fileio)"""
+    fileio = fileio or sys.stdout
+    output_lines = []
+    for query in queries:
+        output_lines.append(format_query_result(query_with_cache(inverted_index, query, cache)))
+        if len(output_lines) >= OUTPUT_BUFFER_LINES:
+            fileio.write("\n".join(output_lines) + "\n")
+            output_lines.clear()
+    if output_lines:
+        fileio.write("\n".join(output_lines) + "\n")
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of values, 0 for empty values"""
+    if not values:
+        return 0.0
+    sorted_values = sorted(values)
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class QueryServer:
+    """Answer queries against loaded index over Unix socket
+
+    Every line received is one query (parsed as a line of query file), every
+    response is one line formatted like make_query_for_requested_words output.
+    Requests from all connections are answered in batches, identical queries of
+    a batch are run only once. A query which fails is answered with an error
+    line, requests of disconnected clients are skipped.
+    """
+    def __init__(self, inverted_index: InvertedIndex, batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_delay: float = DEFAULT_BATCH_DELAY,
+                 tokenizer: Tokenizer = DEFAULT_TOKENIZER):
+        """Initialization by loaded index, batching parameters and query tokenizer"""
+        self.inverted_index = inverted_index
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests_count = 0
+        self._requests = None
+        self._batches_task = None
+
+    def latency_percentiles(self) -> Tuple[float, float]:
+        """Return p50 and p99 of recent request latencies in seconds"""
+        return percentile(self.latencies, 0.5), percentile(self.latencies, 0.99)
+
+    def report_latency(self) -> None:
+        """Print latency percentiles to stderr"""
+        p50, p99 = self.latency_percentiles()
+        print(f"served {self.requests_count} queries: "
+              f"p50 {p50 * 1000:.3f} ms, p99 {p99 * 1000:.3f} ms", file=sys.stderr)
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """Read queries line by line and write responses in the same order"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = loop.create_future()
+                await self._requests.put((line.decode().strip(), response, perf_counter()))
+                try:
+                    answer = await response
+                except Exception as error:
+                    answer = f"error: {error!r}"
+                writer.write((answer + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _collect_batch(self) -> list:
+        """Wait for the first request and take more within batch_delay"""
+        batch = [await self._requests.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._requests.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def process_batches(self) -> None:
+        """Answer collected batches of requests forever"""
+        while True:
+            batch = await self._collect_batch()
+            answers = {}
+            for line, response, started in batch:
+                if response.done():
+                    continue
+                if line not in answers:
+                    try:
+                        answers[line] = format_query_result(
+                            self.inverted_index.query(parse_query_line(line, self.tokenizer))
+                        )
+                    except Exception as error:
+                        print(f"query {line!r} failed: {error!r}", file=sys.stderr)
+                        answers[line] = error
+                if isinstance(answers[line], Exception):
+                    response.set_exception(answers[line])
+                else:
+                    response.set_result(answers[line])
+                self.latencies.append(perf_counter() - started)
+                self.requests_count += 1
+                if self.requests_count % LATENCY_REPORT_PERIOD == 0:
+                    self.report_latency()
+
+    async def start(self, socket_path: str) -> asyncio.AbstractServer:
+        """Start listening Unix socket and processing batches"""
+        self._requests = asyncio.Queue()
+        self._batches_task = asyncio.create_task(self.process_batches())
+        return await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+
+    async def stop(self, server: asyncio.AbstractServer) -> None:
+        """Stop listening and processing, report latency"""
+        server.close()
+        await server.wait_closed()
+        self._batches_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._batches_task
+        self.report_latency()
+
+    async def serve(self, socket_path: str) -> None:
+        """Serve until cancelled"""
+        server = await self.start(socket_path)
+        print(f"serving inverted index on {socket_path}...", file=sys.stderr)
+        try:
+            await server.serve_forever()
+        finally:
+            await self.stop(server)
+
+def callback_update(arguments) -> None:
+    """Determine behaviour for UPDATE command"""
+    print(f"call update subcommand with arguments= {arguments}", file=sys.stderr)
+    tokenizer = Tokenizer.from_stop_words_file(arguments.stop_words_path)
+    documents = (
+        iterate_documents(arguments.dataset_path, tokenizer=tokenizer)
+        if arguments.dataset_path else ()
+    )
+    update_index(arguments.input, arguments.strategy, documents, arguments.deleted_document_indexes)
+
+def callback_compact(arguments) -> None:
+    """Determine behaviour for COMPACT command"""
+    print(f"call compact subcommand with arguments= {arguments}", file=sys.stderr)
+    error = compaction_error(arguments.input)
+    if error is not None:
+        arguments.error(error)
+    if arguments.niceness:
+        os.nice(arguments.niceness)
+    compact_index(arguments.input, arguments.strategy)
+
+def callback_serve(arguments) -> None:
+    """Determine behaviour for SERVE command"""
+    print(f"call serve subcommand with arguments= {arguments}", file=sys.stderr)
+    process_serve(arguments.input, arguments.strategy, arguments.socket_path, arguments.batch_size,
+                  arguments.stop_words_path)
+
+def process_serve(input_path: str, strategy: str, socket_path: str,
+                  batch_size: int = DEFAULT_BATCH_SIZE, stop_words_path: str = None) -> None:
+    """Load index once and serve queries until interrupted"""
+    inverted_index = InvertedIndex.load(input_path, strategy)
+    tokenizer = Tokenizer.from_stop_words_file(stop_words_path)
+    query_server = QueryServer(inverted_index, batch_size=batch_size, tokenizer=tokenizer)
+    try:
+        asyncio.run(query_server.serve(socket_path))
+    except KeyboardInterrupt:
+        pass
+
+def callback_benchmark(arguments) -> None:
+    """Determine behaviour for BENCHMARK command"""
+    print(f"call benchmark subcommand with arguments= {arguments}", file=sys.stderr)
+    process_benchmark(arguments.dataset_path, arguments.output_dir)
+
+def process_benchmark(dataset_path: str, output_dir: str) -> List[StoragePolicyReport]:
+    """Dump and load index with every registered strategy and print measurements"""
+    inverted_index = build_inverted_index_from_stream(iterate_documents(dataset_path))
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    reports = []
+    for name, storage_policy in sorted(STORAGE_POLICIES.items()):
+        filepath = os.path.join(output_dir, f"inverted_index.{name}")
+        try:
+            report = storage_policy.measure(inverted_index.data, filepath)
+        except struct.error as error:
+            print(f"{name} strategy cannot store this index: {error}", file=sys.stderr)
+            continue
+        reports.append(report)
+        print(f"{report.name:<12}dump {report.dump_time:8.3f}s  "
+              f"load {report.load_time:8.3f}s  size {report.file_size:>12} bytes")
+    return reports
 
 def main():
     """Main function"""
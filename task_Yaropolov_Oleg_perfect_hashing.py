@@ -1,13 +1,61 @@
-from typing import List
+from __future__ import annotations
+from typing import Callable, Iterable, List, NamedTuple, Sequence, Tuple
 import array
+import mmap
 import struct
-from random import randrange
+import sys
+from random import randrange, sample
+from time import perf_counter
+
+import numpy as np
+
+from total_size_recipe import getsize
 
 # https://docs.python.org/2/library/sys.html#sys.maxint
 LONG_SIZE_IN_BYTES = struct.calcsize('l')
 MIN_INT = -2 ** (8 * LONG_SIZE_IN_BYTES - 1)
 MAX_TRIALS = 4
+MAX_SECOND_LEVEL_TRIALS = 64
 HUGE_PRIME_NUMBER = 2147483647
+STRING_HASH_PRIME = 2 ** 61 - 1
+FNV_OFFSET_BASIS = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+FNV_MASK = 2 ** 64 - 1
+SLOT_TYPECODE = "q"
+OFFSET_TYPECODE = "q"
+PERFECT_HASH_MAGIC = b"PHSH"
+PERFECT_HASH_HEADER = struct.Struct("=4sQQQQ")
+FIBONACCI_MULTIPLIER = 11400714819323198485
+BENCHMARK_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+BENCHMARK_LOOKUPS = 100000
+
+
+def stable_string_hash(key: str) -> int:
+    """FNV-1a hash of utf-8 encoded string reduced modulo STRING_HASH_PRIME
+
+    Unlike builtin hash it does not depend on PYTHONHASHSEED, so tables built
+    over strings can be saved and probed by another process.
+    """
+    output = FNV_OFFSET_BASIS
+    for byte in key.encode():
+        output = ((output ^ byte) * FNV_PRIME) & FNV_MASK
+    return output % STRING_HASH_PRIME
+
+
+def universal_hash(key: int, parameters: Tuple[int, int], prime: int, m: int) -> int:
+    """Hash function ((a * key + b) mod prime) mod m from universal family"""
+    a, b = parameters
+    return ((a * key + b) % prime) % m
+
+
+def universal_hash_many(keys: np.ndarray, parameters: Tuple, prime: int, m) -> np.ndarray:
+    """Vectorized universal_hash, keys must be reduced modulo prime < 2^31
+
+    Parameters and m may be scalars or arrays aligned with keys, products of
+    reduced keys and parameters then fit into int64.
+    """
+    a, b = parameters
+    return ((a * keys + b) % prime) % m
 
 class HashTableChain:
     """classical hash table implementation (for comparison with perfect hash)"""
@@ -41,81 +89,356 @@ class HashTableChain:
             return output
 
 
-class HashTablePerfect:
-    """build static hash table with < 4n memory space with universal hash family"""
-    __slots__ = ("hash_first_level", "hash_second_level", "collection_size", "counts", "hash_table")
+class HashTableOpenAddressing:
+    """hash table with linear probing in one array('l') (for comparison with perfect hash)
+
+    Capacity is the power of two not less than 2n, so the load factor stays
+    below 1/2. Home slot is taken by Fibonacci hashing of hash_function output,
+    which spreads regular keys (like multiples of table size) over the table.
+    MIN_INT marks empty slots and cannot be stored.
+    """
+    __slots__ = ("hash_function", "collection_size", "shift", "mask", "hash_table")
 
-    def __init__(self, collection: List[int], max_trials=MAX_TRIALS):
+    def __init__(self, collection: List[int], hash_function=None):
         """Generate HashTable for collection"""
+        self.hash_function = hash_function or hash
         self.collection_size = len(collection)
         self.fill_hash_table(collection)
 
-    def get_random_hash_function(self):
-        a, b = randrange(1, HUGE_PRIME_NUMBER), randrange(0, HUGE_PRIME_NUMBER)
-        def hash_function(input: int, m: int) -> int:
-            output = ((a * input + b) % HUGE_PRIME_NUMBER) % m
-            return output
-        return hash_function
+    def _home_slot(self, item) -> int:
+        """First slot to probe for the item"""
+        return ((self.hash_function(item) * FIBONACCI_MULTIPLIER) & FNV_MASK) >> self.shift
 
     def fill_hash_table(self, collection: List[int]):
+        """Adding all elements to HashTable, collisions go to the next free slot"""
+        capacity_bits = max(1, (2 * self.collection_size - 1).bit_length())
+        self.shift = 64 - capacity_bits
+        self.mask = (1 << capacity_bits) - 1
+        self.hash_table = array.array("l", [MIN_INT]) * (1 << capacity_bits)
+        for element in collection:
+            if element == MIN_INT:
+                raise ValueError("%s is reserved for empty slots" % MIN_INT)
+            position = self._home_slot(element)
+            while self.hash_table[position] not in (MIN_INT, element):
+                position = (position + 1) & self.mask
+            self.hash_table[position] = element
+
+    def __contains__(self, item) -> bool:
+        """probing slots from the home one until the item or an empty slot"""
+        position = self._home_slot(item)
+        while True:
+            element = self.hash_table[position]
+            if element == MIN_INT:
+                return False
+            if element == item:
+                return True
+            position = (position + 1) & self.mask
+
+
+class HashTablePerfect:
+    """build static hash table with < 4n memory space with universal hash family
+
+    Elements are hashed by key_function (identity for ints, stable_string_hash
+    for strings) and the keys are stored. Hash functions are kept as their
+    (a, b) parameters, so the table can be saved and probed elsewhere: one pair
+    for the first level and one pair per bucket for the second level.
+
+    Memory layout is flat: all second-level tables are concatenated into one
+    `slots` array, bucket i owns slots[offsets[i]:offsets[i + 1]], and its
+    hash parameters are second_level_parameters[2 * i], [2 * i + 1].
+    """
+    __slots__ = ("key_function", "prime", "first_level_parameters", "second_level_parameters",
+                 "collection_size", "offsets", "slots", "_mmap")
+
+    def __init__(self, collection: List, max_trials=MAX_TRIALS,
+                 key_function: Callable[..., int] = None, prime: int = None, vectorized: bool = False):
+        """Generate HashTable for collection (list or NumPy array with vectorized build)"""
+        self.key_function = key_function
+        self.prime = prime or (HUGE_PRIME_NUMBER if key_function is None else STRING_HASH_PRIME)
+        self.collection_size = len(collection)
+        self._mmap = None
+        keys = collection if key_function is None else self.hash_elements(collection, key_function)
+        if vectorized:
+            self.fill_hash_table_vectorized(np.asarray(keys, dtype=np.int64), max_trials)
+        else:
+            self.fill_hash_table(keys, max_trials)
+
+    @staticmethod
+    def hash_elements(collection: List, key_function: Callable[..., int]) -> List[int]:
+        """Keys of elements, distinct elements with the same key cannot share a slot"""
+        element_by_key = {}
+        keys = []
+        for element in collection:
+            key = key_function(element)
+            if element_by_key.setdefault(key, element) != element:
+                raise ValueError("%r and %r have the same key %s"
+                                 % (element_by_key[key], element, key))
+            keys.append(key)
+        return keys
+
+    def get_random_hash_parameters(self) -> Tuple[int, int]:
+        """Pick random (a, b) of universal hash function"""
+        return randrange(1, self.prime), randrange(0, self.prime)
+
+    def first_level_hash(self, key: int) -> int:
+        """Bucket number of the key"""
+        return universal_hash(key, self.first_level_parameters, self.prime, self.collection_size)
+
+    def slot_position(self, key: int) -> int:
+        """Position in slots of the only slot the key may occupy, -1 for empty bucket"""
+        if self.collection_size == 0:
+            return -1
+        bucket_number = self.first_level_hash(key)
+        bucket_start, bucket_end = self.offsets[bucket_number], self.offsets[bucket_number + 1]
+        if bucket_start == bucket_end:
+            return -1
+        parameters = (self.second_level_parameters[2 * bucket_number],
+                      self.second_level_parameters[2 * bucket_number + 1])
+        return bucket_start + universal_hash(key, parameters, self.prime, bucket_end - bucket_start)
+
+    def _allocate(self, counts: Iterable[int]):
+        """Prefix sums of squared bucket sizes and empty slots"""
+        self.offsets = array.array(OFFSET_TYPECODE, [0])
+        for bucket_size in counts:
+            self.offsets.append(self.offsets[-1] + bucket_size * bucket_size)
+        self.slots = array.array(SLOT_TYPECODE, [MIN_INT]) * self.offsets[-1]
+        self.second_level_parameters = array.array(OFFSET_TYPECODE, [0]) * (2 * self.collection_size)
+
+    def fill_hash_table(self, keys: List[int], max_trials: int = MAX_TRIALS):
         """
         Building two-level perfect hash
 
-        * For second-level tables we are able to use HashTableChain class,
-        but for efficiency let's reimplement it
-        * For second iteration of hashing we could store or recalculate
-        bucket_numbers from first iteation depending on time or memory
-        optimization. I've chosen to recalculate
+        * First level is retried up to max_trials times while the sum of
+        squared bucket sizes exceeds 4n
+        * Every bucket of size c gets its own second-level function into c^2
+        slots, which is redrawn on collision for this bucket only
+        """
+        for _ in range(max_trials):
+            self.first_level_parameters = self.get_random_hash_parameters()
+            counts = array.array("l", [0]) * self.collection_size
+            for key in keys:
+                counts[self.first_level_hash(key)] += 1
+            sum_of_squares = sum(bucket_size * bucket_size for bucket_size in counts)
+            if sum_of_squares <= 4 * self.collection_size:
+                break
+        else:
+            raise ValueError("cannot build perfect hash table within %s trials" % max_trials)
+
+        buckets = [[] for _ in range(self.collection_size)]
+        for key in keys:
+            buckets[self.first_level_hash(key)].append(key)
+        self._allocate(counts)
+        for bucket_number, bucket in enumerate(buckets):
+            if bucket:
+                self._fill_bucket(bucket_number, bucket)
+
+    def fill_hash_table_vectorized(self, keys: np.ndarray, max_trials: int = MAX_TRIALS):
+        """
+        Building two-level perfect hash in NumPy passes over all keys
+
+        * First-level buckets of all keys are computed at once and the 4n
+        memory bound is checked with bincount
+        * Second-level functions are drawn for all buckets together, then
+        redrawn for colliding buckets only, until no bucket collides
         """
-        is_not_builded_successfully = True
-        current_trial = 0
-        while is_not_builded_successfully:
-            current_trial += 1
-            if current_trial > MAX_TRIALS:
-                raise ValueError("cannot build perfect hash table within %s trials" % MAX_TRIALS)
-
-            self.counts = array.array("l", [0] * self.collection_size)
-            self.hash_table = [array.array("l", [])] * self.collection_size
-
-            # pick random hash functions:
-            self.hash_first_level = self.get_random_hash_function()
-            self.hash_second_level = self.get_random_hash_function()
-
-            # hashing. First iteration
-            for element in collection:
-                key = self.hash_first_level(element, self.collection_size)
-                self.counts[key] += 1
-
-            sum_of_squares = sum(bucket_size ** 2 for bucket_size in self.counts)
-            starting_over = sum_of_squares > 4 * self.collection_size
-            if starting_over:
-                continue
-
-            # hashing. Second iteration
-            collision_detected = False
-            for element in collection:
-                bucket_number = self.hash_first_level(element, self.collection_size)
-                key = self.hash_second_level(element, self.counts[bucket_number] ** 2)
-                if self.hash_table[bucket_number] == array.array("l", []):
-                    # Is not initialized before
-                    self.hash_table[bucket_number] = array.array("l", [MIN_INT] * self.counts[bucket_number] ** 2)
-                elif self.hash_table[bucket_number][key] != MIN_INT:
-                    # print("collision!")
-                    collision_detected = True
+        if self.prime > HUGE_PRIME_NUMBER:
+            raise ValueError("vectorized build needs prime not greater than %s" % HUGE_PRIME_NUMBER)
+        random_generator = np.random.default_rng()
+        reduced_keys = keys % self.prime
+        for _ in range(max_trials):
+            self.first_level_parameters = self.get_random_hash_parameters()
+            bucket_numbers = universal_hash_many(
+                reduced_keys, self.first_level_parameters, self.prime, max(self.collection_size, 1)
+            )
+            counts = np.bincount(bucket_numbers, minlength=self.collection_size)
+            if int((counts * counts).sum()) <= 4 * self.collection_size:
+                break
+        else:
+            raise ValueError("cannot build perfect hash table within %s trials" % max_trials)
+
+        sizes = counts * counts
+        offsets = np.zeros(self.collection_size + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        parameters = np.zeros((self.collection_size, 2), dtype=np.int64)
+        positions = np.zeros(len(keys), dtype=np.int64)
+        pending_keys = np.arange(len(keys))
+        colliding_buckets = np.ones(self.collection_size, dtype=bool)
+        second_level_trials = 0
+        while len(pending_keys):
+            if second_level_trials == MAX_SECOND_LEVEL_TRIALS:
+                raise ValueError("cannot build buckets of perfect hash table within %s trials"
+                                 % MAX_SECOND_LEVEL_TRIALS)
+            second_level_trials += 1
+            pending_buckets = np.flatnonzero(colliding_buckets)
+            parameters[pending_buckets, 0] = random_generator.integers(1, self.prime, len(pending_buckets))
+            parameters[pending_buckets, 1] = random_generator.integers(0, self.prime, len(pending_buckets))
+            key_buckets = bucket_numbers[pending_keys]
+            positions[pending_keys] = offsets[key_buckets] + universal_hash_many(
+                reduced_keys[pending_keys], (parameters[key_buckets, 0], parameters[key_buckets, 1]),
+                self.prime, sizes[key_buckets],
+            )
+            order = pending_keys[np.argsort(positions[pending_keys], kind="stable")]
+            collided = (positions[order[1:]] == positions[order[:-1]]) & (keys[order[1:]] != keys[order[:-1]])
+            colliding_buckets[pending_buckets] = False
+            colliding_buckets[bucket_numbers[order[1:][collided]]] = True
+            pending_keys = pending_keys[colliding_buckets[bucket_numbers[pending_keys]]]
+
+        slots = np.full(int(offsets[-1]), MIN_INT, dtype=np.int64)
+        slots[positions] = keys
+        self.offsets = array.array(OFFSET_TYPECODE, offsets.tobytes())
+        self.second_level_parameters = array.array(OFFSET_TYPECODE, parameters.tobytes())
+        self.slots = array.array(SLOT_TYPECODE, slots.tobytes())
+
+    def contains_many(self, items: Iterable) -> np.ndarray:
+        """Check membership of every item at once, return boolean array"""
+        if self.key_function is None:
+            queries = np.asarray(items, dtype=np.int64)
+        else:
+            queries = np.fromiter(map(self.key_function, items), dtype=np.int64)
+        if self.collection_size == 0 or not len(queries):
+            return np.zeros(len(queries), dtype=bool)
+        if self.prime > HUGE_PRIME_NUMBER:
+            return np.fromiter((self._contains_key(key) for key in queries.tolist()),
+                               dtype=bool, count=len(queries))
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        parameters = np.frombuffer(self.second_level_parameters, dtype=np.int64).reshape(-1, 2)
+        slots = np.frombuffer(self.slots, dtype=np.int64)
+        reduced_queries = queries % self.prime
+        bucket_numbers = universal_hash_many(
+            reduced_queries, self.first_level_parameters, self.prime, self.collection_size
+        )
+        bucket_starts = offsets[bucket_numbers]
+        sizes = offsets[bucket_numbers + 1] - bucket_starts
+        is_empty = sizes == 0
+        positions = bucket_starts + universal_hash_many(
+            reduced_queries, (parameters[bucket_numbers, 0], parameters[bucket_numbers, 1]),
+            self.prime, np.maximum(sizes, 1),
+        )
+        positions[is_empty] = 0
+        return ~is_empty & (slots[positions] == queries)
+
+    def _fill_bucket(self, bucket_number: int, bucket: List[int]):
+        """Draw second-level functions for the bucket until its keys do not collide"""
+        bucket_start, bucket_end = self.offsets[bucket_number], self.offsets[bucket_number + 1]
+        table_size = bucket_end - bucket_start
+        for _ in range(MAX_SECOND_LEVEL_TRIALS):
+            parameters = self.get_random_hash_parameters()
+            self.slots[bucket_start:bucket_end] = array.array(SLOT_TYPECODE, [MIN_INT]) * table_size
+            for key in bucket:
+                position = bucket_start + universal_hash(key, parameters, self.prime, table_size)
+                if self.slots[position] not in (MIN_INT, key):
                     break
-                self.hash_table[bucket_number][key] = element
+                self.slots[position] = key
+            else:
+                self.second_level_parameters[2 * bucket_number] = parameters[0]
+                self.second_level_parameters[2 * bucket_number + 1] = parameters[1]
+                return
+        raise ValueError("cannot build bucket %s of perfect hash table within %s trials"
+                         % (bucket_number, MAX_SECOND_LEVEL_TRIALS))
 
-            if collision_detected:
-                continue
+    def save(self, filepath: str):
+        """
+        Save hash table to file readable by load
 
-            # success, if we are here!
-            is_not_builded_successfully = False
+        Layout: header (magic, collection size, prime, first-level parameters),
+        offsets, second-level parameters and slots as native 8-byte integers
+        """
+        with open(filepath, "wb") as fout:
+            fout.write(PERFECT_HASH_HEADER.pack(
+                PERFECT_HASH_MAGIC, self.collection_size, self.prime, *self.first_level_parameters
+            ))
+            for flat_array in (self.offsets, self.second_level_parameters, self.slots):
+                fout.write(flat_array)
+
+    @classmethod
+    def load(cls, filepath: str, key_function: Callable[..., int] = None) -> HashTablePerfect:
+        """Map saved hash table into memory, its arrays are zero-copy views of the file"""
+        with open(filepath, "rb") as fin:
+            mapped_file = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, collection_size, prime, *first_level_parameters = PERFECT_HASH_HEADER.unpack_from(mapped_file, 0)
+        if magic != PERFECT_HASH_MAGIC:
+            mapped_file.close()
+            raise ValueError(f"{filepath} is not a perfect hash table")
+        hash_table = cls.__new__(cls)
+        hash_table.key_function = key_function
+        hash_table.prime = prime
+        hash_table.collection_size = collection_size
+        hash_table.first_level_parameters = tuple(first_level_parameters)
+        hash_table._mmap = mapped_file
+        view = memoryview(mapped_file)
+        item_size = struct.calcsize(OFFSET_TYPECODE)
+        parameters_start = PERFECT_HASH_HEADER.size + item_size * (collection_size + 1)
+        slots_start = parameters_start + item_size * 2 * collection_size
+        hash_table.offsets = view[PERFECT_HASH_HEADER.size:parameters_start].cast(OFFSET_TYPECODE)
+        hash_table.second_level_parameters = view[parameters_start:slots_start].cast(OFFSET_TYPECODE)
+        hash_table.slots = view[slots_start:].cast(SLOT_TYPECODE)
+        view.release()
+        return hash_table
+
+    def close(self):
+        """Release views of file loaded by load"""
+        if self._mmap is None:
+            return
+        for flat_array in (self.offsets, self.second_level_parameters, self.slots):
+            flat_array.release()
+        self._mmap.close()
+        self._mmap = None
 
     def __contains__(self, item) -> bool:
-        bucket_number = self.hash_first_level(item, self.collection_size)
-        if self.hash_table[bucket_number] == array.array("l", []):
-            return False
-        else:
-            key = self.hash_second_level(item, self.counts[bucket_number] ** 2)
-            item_is_presented = (self.hash_table[bucket_number][key] == item)
-            return item_is_presented
+        return self._contains_key(item if self.key_function is None else self.key_function(item))
+
+    def _contains_key(self, key: int) -> bool:
+        """Probe the only slot the key may occupy"""
+        position = self.slot_position(key)
+        return position >= 0 and self.slots[position] == key
+
+
+class HashTableReport(NamedTuple):
+    """Measurements of one hash table on one collection"""
+    name: str
+    keys_count: int
+    build_time: float
+    lookups_per_second: float
+    memory_size: int
+
+
+BENCHMARK_HASH_TABLES = {
+    "chain": HashTableChain,
+    "open addressing": HashTableOpenAddressing,
+    "perfect": lambda collection: HashTablePerfect(collection, vectorized=True),
+}
+
+
+def benchmark_hash_tables(sizes: Sequence[int] = BENCHMARK_SIZES,
+                          lookups_count: int = BENCHMARK_LOOKUPS) -> List[HashTableReport]:
+    """
+    Measure build time, lookup throughput and getsize memory of hash tables
+
+    Every collection has distinct random keys below HUGE_PRIME_NUMBER, half of
+    the lookups are hits and half are misses. Perfect hash is built by the
+    vectorized NumPy mode, lookups go through __contains__ for all tables.
+    """
+    reports = []
+    for size in sizes:
+        keys = sample(range(HUGE_PRIME_NUMBER), size + lookups_count // 2)
+        collection, missing_keys = keys[:size], keys[size:]
+        queries = [collection[number % size] for number in range(lookups_count - len(missing_keys))]
+        queries += missing_keys
+        for name, hash_table_class in BENCHMARK_HASH_TABLES.items():
+            build_start = perf_counter()
+            hash_table = hash_table_class(collection)
+            build_time = perf_counter() - build_start
+            found = 0
+            lookup_start = perf_counter()
+            for query in queries:
+                found += query in hash_table
+            lookup_time = perf_counter() - lookup_start
+            reports.append(HashTableReport(
+                name, size, build_time, len(queries) / lookup_time, getsize(hash_table)
+            ))
+            print("%s on %s keys: build %.3fs, %.0f lookups/s, %s bytes" % reports[-1], file=sys.stderr)
+    return reports
+
+
+if __name__ == "__main__":
+    benchmark_hash_tables()
@@ -1,9 +1,18 @@
+import json
 import pytest
+import random
+import threading
+import time
+from timeit import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 # from bs4 import BeautifulSoup
 
 from task_Yaropolov_Oleg_asset_web_service import parse_cbr_currency_base_daily, parse_cbr_key_indicators, ASSET_COLLECTION, return_cbr_daily, return_cbr_key_indicators
+from task_Yaropolov_Oleg_asset_web_service import CBR_RATES_CACHE, CbrRatesCache, Composite, Asset
+from task_Yaropolov_Oleg_asset_web_service import parse_cbr_currency_base_daily_bs4, parse_cbr_key_indicators_bs4
 from task_Yaropolov_Oleg_asset_web_service import app as tested_app
+from flask import jsonify
 
 # from pdb import set_trace; set_trace()
 
@@ -11,9 +20,16 @@ from task_Yaropolov_Oleg_asset_web_service import app as tested_app
 def client():
     with tested_app.test_client() as client:
         yield client
+    CBR_RATES_CACHE.wait_for_revalidation()
+    CBR_RATES_CACHE.stop()
+    CBR_RATES_CACHE.clear()
 
 CBR_CURRENCY_DAILY_LOCAL = "cbr_currency_base_daily.html"
 CBR_KEY_INDICATOR_LOCAL = "cbr_key_indicators.html"
+CBR_PARSERS_WITH_REFERENCES = [
+    pytest.param(parse_cbr_currency_base_daily, parse_cbr_currency_base_daily_bs4, CBR_CURRENCY_DAILY_LOCAL, id="daily"),
+    pytest.param(parse_cbr_key_indicators, parse_cbr_key_indicators_bs4, CBR_KEY_INDICATOR_LOCAL, id="key_indicators"),
+]
 
 def test_daily_parsing_is_correct():
     parsed_currency_collection = parse_cbr_currency_base_daily(open(CBR_CURRENCY_DAILY_LOCAL, encoding="utf8").read())
@@ -26,6 +42,25 @@ def test_key_indicator_parsing_is_correct():
     assert 4529.59 == parsed_key_indicator_collection["Au"]
     assert 5667.14 == parsed_key_indicator_collection["Pd"]
     
+@pytest.mark.parametrize(
+    "fast_parser, reference_parser, filepath",
+    CBR_PARSERS_WITH_REFERENCES,
+)
+def test_lxml_parsers_match_beautiful_soup(fast_parser, reference_parser, filepath):
+    html_data = open(filepath, encoding="utf8").read()
+    assert list(reference_parser(html_data).items()) == list(fast_parser(html_data).items())
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    "fast_parser, reference_parser, filepath",
+    CBR_PARSERS_WITH_REFERENCES,
+)
+def test_lxml_parsers_are_faster(fast_parser, reference_parser, filepath):
+    html_data = open(filepath, encoding="utf8").read()
+    lxml_time = timeit(lambda: fast_parser(html_data), number=50)
+    beautiful_soup_time = timeit(lambda: reference_parser(html_data), number=50)
+    assert lxml_time < beautiful_soup_time
+
 def test_service_replied_to_cbr_daily(client):
     response = client.get("/cbr/daily")
     assert 200 == response.status_code
@@ -87,6 +122,7 @@ def test_service_can_add_show_assets(client):
 @patch('task_Yaropolov_Oleg_asset_web_service.download_cbr_key_indicator')
 def test_revenue_calculation_is_correct(mock_cbr_key_indicator, mock_cbr_daily, client):
     client.get("/api/asset/cleanup")
+    CBR_RATES_CACHE.clear()
 
     mock_cbr_daily.return_value = open(CBR_CURRENCY_DAILY_LOCAL, encoding="utf8").read()
     mock_cbr_key_indicator.return_value = open(CBR_KEY_INDICATOR_LOCAL, encoding="utf8").read()
@@ -123,3 +159,350 @@ def test_revenue_calculation_is_correct(mock_cbr_key_indicator, mock_cbr_daily,
     assert round(profit[1], 8) == response_calculations.json['3']
 
 
+
+CBR_STUB_PAGES = {
+    "/daily/": CBR_CURRENCY_DAILY_LOCAL,
+    "/key-indicators/": CBR_KEY_INDICATOR_LOCAL,
+}
+
+class CbrStubHandler(BaseHTTPRequestHandler):
+    """Serve bundled CBR pages once requests pass the gate and the barrier (if set)"""
+    def do_GET(self):
+        self.server.requests_count += 1
+        assert self.server.gate.wait(5)
+        if self.server.barrier is not None:
+            self.server.barrier.wait()
+        with open(CBR_STUB_PAGES[self.path], "rb") as fin:
+            page = fin.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def cbr_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CbrStubHandler)
+    server.requests_count, server.barrier = 0, None
+    server.gate = threading.Event()
+    server.gate.set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    with patch("task_Yaropolov_Oleg_asset_web_service.CBR_DAILY_HTML", f"{base_url}/daily/"), \
+            patch("task_Yaropolov_Oleg_asset_web_service.CBR_KEY_INDICATOR_HTML", f"{base_url}/key-indicators/"):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_rates_cache_fetches_pages_concurrently(cbr_stub_server):
+    cbr_stub_server.barrier = threading.Barrier(2, timeout=5)
+    rates_cache = CbrRatesCache(ttl=60)
+    daily_rate, key_indicators = rates_cache.get()
+    assert parse_cbr_currency_base_daily(open(CBR_CURRENCY_DAILY_LOCAL, encoding="utf8").read()) == daily_rate
+    assert parse_cbr_key_indicators(open(CBR_KEY_INDICATOR_LOCAL, encoding="utf8").read()) == key_indicators
+    assert 2 == cbr_stub_server.requests_count
+    assert (daily_rate, key_indicators) == rates_cache.get()
+    assert 2 == cbr_stub_server.requests_count
+
+def test_rates_cache_serves_stale_while_revalidating(cbr_stub_server):
+    clock = FakeClock()
+    rates_cache = CbrRatesCache(ttl=60, clock=clock)
+    rates = rates_cache.get()
+    cbr_stub_server.gate.clear()
+    clock.now = 61
+    assert rates == rates_cache.get()
+    assert rates == rates_cache.get()
+    revalidation_is_running = rates_cache._revalidation is not None
+    cbr_stub_server.gate.set()
+    assert revalidation_is_running
+    rates_cache.wait_for_revalidation()
+    assert 4 == cbr_stub_server.requests_count
+    assert rates == rates_cache.get()
+    assert 4 == cbr_stub_server.requests_count
+
+def test_rates_cache_keeps_stale_rates_if_cbr_is_unavailable(cbr_stub_server):
+    clock = FakeClock()
+    rates_cache = CbrRatesCache(ttl=60, clock=clock)
+    rates = rates_cache.get()
+    clock.now = 61
+    with patch("task_Yaropolov_Oleg_asset_web_service.CBR_DAILY_HTML", "http://127.0.0.1:1/daily/"):
+        assert rates == rates_cache.get()
+        rates_cache.wait_for_revalidation()
+    assert rates == rates_cache.get()
+
+def test_rates_cache_is_refreshed_in_background(cbr_stub_server):
+    rates_cache = CbrRatesCache(ttl=60, refresh_interval=0.01)
+    rates_cache.get()
+    deadline = time.monotonic() + 5
+    while cbr_stub_server.requests_count < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    rates_cache.stop()
+    assert cbr_stub_server.requests_count >= 4
+    requests_count = cbr_stub_server.requests_count
+    time.sleep(0.05)
+    assert requests_count == cbr_stub_server.requests_count
+
+def test_revenue_calculation_uses_rates_cache(cbr_stub_server, client):
+    client.get("/api/asset/cleanup")
+    client.get("/api/asset/add/USD/deposit/10/0.01")
+    with patch("task_Yaropolov_Oleg_asset_web_service.CBR_RATES_CACHE", CbrRatesCache(ttl=60)):
+        first_response = client.get("/api/asset/calculate_revenue?period=1")
+        second_response = client.get("/api/asset/calculate_revenue?period=1")
+    assert 200 == first_response.status_code
+    assert first_response.json == second_response.json
+    assert 2 == cbr_stub_server.requests_count
+    client.get("/api/asset/cleanup")
+
+def test_composite_indexes_assets_by_name_and_char_code():
+    composite = Composite()
+    for number in range(1000):
+        composite.add_by_params(f"asset{number}", 100.0 + number, 0.01, ["RUB", "EUR", "USD"][number % 3])
+    assert composite.asset_with_provided_name_is_already_exists("asset999")
+    assert not composite.asset_with_provided_name_is_already_exists("asset1000")
+    assert Asset("asset10", 110.0, 0.01, "EUR") == composite.get("asset10")
+    assert composite.get("missing") is None
+    assert [f"asset{number}" for number in range(1, 1000, 3)] == [asset.name for asset in composite.get_by_char_code("EUR")]
+    assert [] == composite.get_by_char_code("AMD")
+    with pytest.raises(ValueError):
+        composite.add(Asset("asset1", 1.0, 0.1, "USD"))
+    composite.remove_all()
+    assert 0 == len(composite._asset_collection) and composite.get("asset1") is None and [] == composite.get_by_char_code("EUR")
+
+def test_selected_assets_are_ordered_as_before(client):
+    client.get("/api/asset/cleanup")
+    assets = [("EUR", "b", 10.0, 0.5), ("RUB", "a", 5.0, 0.1), ("EUR", "a2", 1.0, 0.2), ("USD", "c", 3.0, 0.3)]
+    for char_code, name, capital, interest in assets:
+        client.get(f"/api/asset/add/{char_code}/{name}/{capital}/{interest}")
+    assert 4 == len(ASSET_COLLECTION._asset_collection)
+    assert [list(asset) for asset in sorted(assets)] == client.get("/api/asset/list").json
+    assert [["EUR", "b", 10.0, 0.5], ["RUB", "a", 5.0, 0.1]] == client.get("/api/asset/get?name=a&name=b&name=a&name=zzz").json
+    assert [["EUR", "a2", 1.0, 0.2], ["EUR", "b", 10.0, 0.5], ["USD", "c", 3.0, 0.3]] == client.get("/api/asset/get?char_code=USD&char_code=EUR").json
+    assert [["EUR", "b", 10.0, 0.5]] == client.get("/api/asset/get?name=a&name=b&char_code=EUR").json
+    client.get("/api/asset/cleanup")
+    assert 0 == len(ASSET_COLLECTION._asset_collection)
+
+def test_vectorized_revenue_matches_per_asset_sum():
+    random_generator = random.Random(22)
+    exchange_rates = {"RUB": 1, "EUR": 91.9822, "AMD": 0.144485, "Au": 4529.59}
+    composite = Composite()
+    for number in range(1000):
+        composite.add_by_params(f"asset{number}", random_generator.uniform(1, 10 ** 6),
+                                random_generator.uniform(0, 0.2), random_generator.choice(list(exchange_rates)))
+    periods = [0, 2.5] + list(range(1, 51))
+    revenues = composite.calculate_revenue(periods, exchange_rates.__getitem__)
+    for period, revenue in zip(periods, revenues):
+        expected = sum(asset.calculate_revenue(period) * exchange_rates[asset.char_code] for asset in composite._asset_collection)
+        assert round(expected, 8) == round(float(revenue), 8)
+    assert [0.0, 0.0] == Composite().calculate_revenue([1, 3], exchange_rates.__getitem__).tolist()
+    assert [] == composite.calculate_revenue([], {}.__getitem__).tolist()
+
+def test_revenue_calculation_aborts_on_unknown_currency(client):
+    client.get("/api/asset/cleanup")
+    client.get("/api/asset/add/XXX/deposit/10/0.01")
+    with patch("task_Yaropolov_Oleg_asset_web_service.CBR_RATES_CACHE.get", return_value=({}, {})):
+        assert 501 == client.get("/api/asset/calculate_revenue?period=1").status_code
+        response = client.get("/api/asset/calculate_revenue")
+        assert 200 == response.status_code and {} == response.json
+    client.get("/api/asset/cleanup")
+
+def test_bulk_add_assets_from_jsonl(client):
+    client.get("/api/asset/cleanup")
+    client.get("/api/asset/add/RUB/stock/1000/0.01")
+    body = "\n".join([
+        json.dumps({"char_code": "EUR", "name": "deposit", "capital": 100, "interest": 0.05}),
+        json.dumps(["USD", "bond", "50.5", 0.02]),
+        "",
+        json.dumps({"char_code": "EUR", "name": "stock", "capital": 1, "interest": 0.1}),
+        "{not json",
+        json.dumps({"char_code": "EUR", "name": "house", "capital": "many", "interest": 0.1}),
+        json.dumps({"char_code": "EUR", "name": "car"}),
+        json.dumps(["AMD", "deposit", 1, 0.1]),
+    ])
+    response = client.post("/api/asset/bulk_add", data=body, content_type="application/x-ndjson")
+    assert 200 == response.status_code
+    assert 2 == response.json["added"]
+    assert [4, 5, 6, 7, 8] == [error["line"] for error in response.json["errors"]]
+    assert "Asset 'stock' is already exists!" == response.json["errors"][0]["error"]
+    assert "Asset 'deposit' is already exists!" == response.json["errors"][-1]["error"]
+    assert [["EUR", "deposit", 100.0, 0.05], ["RUB", "stock", 1000.0, 0.01], ["USD", "bond", 50.5, 0.02]] == client.get("/api/asset/list").json
+    client.get("/api/asset/cleanup")
+
+def test_bulk_add_assets_from_csv(client):
+    client.get("/api/asset/cleanup")
+    rows = ["char_code,name,capital,interest"] + [f"EUR,asset{number},{number},0.01" for number in range(5000)] + ["EUR,asset1,1,0.01", "EUR,broken"]
+    response = client.post("/api/asset/bulk_add", data="\n".join(rows), content_type="text/csv")
+    assert 200 == response.status_code
+    assert 5000 == response.json["added"] == len(ASSET_COLLECTION._asset_collection)
+    assert [5002, 5003] == [error["line"] for error in response.json["errors"]]
+    assert 415 == client.post("/api/asset/bulk_add?format=xml", data="<assets/>").status_code
+    client.get("/api/asset/cleanup")
+
+def test_bulk_add_rejects_invalid_encoding_and_booleans(client):
+    client.get("/api/asset/cleanup")
+    response = client.post("/api/asset/bulk_add", data=b'["EUR", "deposit", 1, 0.1]\n\xff\xfe["EUR"]\n', content_type="application/x-ndjson")
+    assert 400 == response.status_code
+    assert 0 == len(ASSET_COLLECTION._asset_collection)
+    body = "\n".join([json.dumps(["EUR", "deposit", True, 0.1]), json.dumps({"char_code": "EUR", "name": "bond", "capital": 1, "interest": False})])
+    response = client.post("/api/asset/bulk_add", data=body, content_type="application/x-ndjson")
+    assert 0 == response.json["added"]
+    assert [(1, "capital and interest must be numbers"), (2, "capital and interest must be numbers")] == [(error["line"], error["error"]) for error in response.json["errors"]]
+    client.get("/api/asset/cleanup")
+
+def test_composite_stays_consistent_under_concurrent_adds_and_lists():
+    composite = Composite()
+    writers_count, assets_per_writer = 8, 200
+    states_are_consistent = []
+
+    def write(writer_number):
+        for asset_number in range(assets_per_writer):
+            try:
+                composite.add_by_params(f"asset{asset_number}", asset_number, 0.01, f"C{writer_number}")
+            except ValueError:
+                pass
+
+    def read(stop_reading):
+        while not stop_reading.is_set():
+            with composite._lock:
+                state = composite._state
+                lengths = {
+                    len(state.assets), len(state.assets_by_name),
+                    sum(map(len, state.assets_by_char_code.values())),
+                    len(state.capitals), len(state.interests), len(state.currency_numbers),
+                }
+            states_are_consistent.append(1 == len(lengths))
+            listed = composite.return_to_request(None)
+            states_are_consistent.append(len(listed) == len({name for _, name, _, _ in listed}))
+
+    stop_reading = threading.Event()
+    readers = [threading.Thread(target=read, args=(stop_reading,)) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    writers = [threading.Thread(target=write, args=(writer_number,)) for writer_number in range(writers_count)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    stop_reading.set()
+    for reader in readers:
+        reader.join()
+    assert states_are_consistent and all(states_are_consistent)
+    assert assets_per_writer == len(composite.return_to_request(None))
+    assert assets_per_writer == sum(len(composite.get_by_char_code(f"C{writer_number}")) for writer_number in range(writers_count))
+
+def test_readers_do_not_block_writers():
+    composite = Composite()
+    composite.add_by_params("stock", 1000, 0.01)
+    serializing, release = threading.Event(), threading.Event()
+
+    def slow_serialize(rows):
+        serializing.set()
+        release.wait(5)
+        return json.dumps(rows)
+
+    reader = threading.Thread(target=composite.return_to_request_json, args=(None, None, slow_serialize))
+    reader.start()
+    assert serializing.wait(5)
+    writer = threading.Thread(target=composite.add_by_params, args=("bond", 50, 0.02))
+    writer.start()
+    writer.join(1)
+    writer_finished = not writer.is_alive()
+    release.set()
+    reader.join()
+    writer.join()
+    assert writer_finished
+    assert [["RUB", "bond", 50, 0.02], ["RUB", "stock", 1000, 0.01]] == json.loads(composite.return_to_request_json(None, serialize=json.dumps))
+
+def test_json_cache_keeps_newest_version_under_concurrent_readers():
+    composite = Composite()
+
+    def read_and_add(reader_number):
+        for number in range(200):
+            composite.return_to_request_json(None, serialize=json.dumps)
+            composite.return_to_request_json(None, ["RUB"], json.dumps)
+            composite.add_by_params(f"asset{reader_number}_{number}", number, 0.01)
+
+    readers = [threading.Thread(target=read_and_add, args=(reader_number,)) for reader_number in range(4)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert composite.return_to_request(None) == json.loads(composite.return_to_request_json(None, serialize=json.dumps))
+    assert 800 == len(json.loads(composite.return_to_request_json(None, ["RUB"], json.dumps)))
+
+@pytest.mark.benchmark
+def test_composite_add_cost_does_not_grow_with_collection_size():
+    def add_time(composite, numbers):
+        started = time.perf_counter()
+        for number in numbers:
+            composite.add_by_params(f"asset{number:07d}", number, 0.01)
+        return time.perf_counter() - started
+
+    numbers = random.sample(range(10 ** 6), 206_000)
+    big_composite = Composite()
+    big_composite.add_many((number, Asset(f"asset{number:07d}", number, 0.01)) for number in numbers[:200_000])
+    small_time = min(add_time(Composite(), numbers[200_000 + 2000 * trial:][:2000]) for trial in range(3))
+    big_time = min(add_time(big_composite, numbers[200_000 + 2000 * trial:][:2000]) for trial in range(3))
+    assert 200_000 + 6000 == len(big_composite._asset_collection)
+    assert big_time < 5 * small_time
+
+def test_composite_clear_replaces_state_at_once(client):
+    client.get("/api/asset/cleanup")
+    for number in range(10):
+        client.get(f"/api/asset/add/RUB/asset{number}/{number}/0.1")
+    assets_before_clear = ASSET_COLLECTION._asset_collection
+    client.get("/api/asset/cleanup")
+    assert [] == client.get("/api/asset/list").json
+    assert 10 == len(assets_before_clear) and assets_before_clear is not ASSET_COLLECTION._asset_collection
+    assert 200 == client.get("/api/asset/add/RUB/asset0/1/0.1").status_code
+    client.get("/api/asset/cleanup")
+    assert 0 == len(ASSET_COLLECTION._asset_collection)
+
+def test_sorted_view_matches_nested_sorts():
+    composite = Composite()
+    random.seed(25)
+    for number in random.sample(range(1000), 300):
+        composite.add_by_params(f"asset{number}", random.randint(1, 10), random.choice([0.1, 0.2]), random.choice(["EUR", "RUB", "USD"]))
+    expected = [asset.return_to_request() for asset in composite._asset_collection]
+    for column in (3, 2, 1, 0):
+        expected.sort(key=lambda asset: asset[column])
+    assert expected == composite.return_to_request(None)
+    assert [asset for asset in expected if asset[0] != "RUB"] == composite.return_to_request([], ["USD", "EUR"])
+
+def test_json_response_is_cached_until_mutation(client):
+    client.get("/api/asset/cleanup")
+    client.get("/api/asset/add/RUB/stock/1000/0.01")
+    with tested_app.app_context():
+        cached_response = ASSET_COLLECTION.return_to_request_json(None)
+        assert cached_response is ASSET_COLLECTION.return_to_request_json(None)
+    assert [["RUB", "stock", 1000.0, 0.01]] == json.loads(cached_response)
+    client.get("/api/asset/add/EUR/deposit/100/0.05")
+    assert [["EUR", "deposit", 100.0, 0.05], ["RUB", "stock", 1000.0, 0.01]] == client.get("/api/asset/list").json
+    assert [["EUR", "deposit", 100.0, 0.05]] == client.get("/api/asset/get?char_code=EUR").json
+    client.get("/api/asset/cleanup")
+    assert [] == client.get("/api/asset/list").json
+    assert [] == client.get("/api/asset/get?char_code=EUR").json
+
+def test_cached_json_response_is_byte_identical_to_jsonify(client):
+    client.get("/api/asset/cleanup")
+    client.get("/api/asset/add/RUB/stock/1000/0.01")
+    client.get("/api/asset/add/EUR/deposit/100/0.05")
+    with tested_app.app_context():
+        expected_list = jsonify([["EUR", "deposit", 100.0, 0.05], ["RUB", "stock", 1000.0, 0.01]]).get_data()
+        expected_get = jsonify([["RUB", "stock", 1000.0, 0.01]]).get_data()
+    for _ in range(2):
+        list_response = client.get("/api/asset/list")
+        assert expected_list == list_response.data and "application/json" == list_response.mimetype
+        assert expected_get == client.get("/api/asset/get?name=stock").data
+    assert b", " not in expected_list
+    client.get("/api/asset/cleanup")
@@ -2,8 +2,29 @@ import re
 import json
 import pytest
 import os
+import asyncio
+from array import array
+from time import perf_counter
+from timeit import repeat
+from unittest.mock import patch
 
 from task_Yaropolov_Oleg_inverted_index import InvertedIndex, build_inverted_index, load_documents, make_query_for_requested_words, process_query, process_build
+from task_Yaropolov_Oleg_inverted_index import build_compact_inverted_index, build_inverted_index_from_stream, iterate_documents
+from task_Yaropolov_Oleg_inverted_index import split_dataset_into_ranges, build_shard, merge_shards
+from task_Yaropolov_Oleg_inverted_index import gallop_to, intersect_postings, intersect_postings_with_sets
+from task_Yaropolov_Oleg_inverted_index import process_benchmark, QueryServer
+from task_Yaropolov_Oleg_inverted_index import QueryResultCache, query_with_cache
+from task_Yaropolov_Oleg_inverted_index import update_index, compact_index, start_background_compaction, load_segments_manifest
+from task_Yaropolov_Oleg_inverted_index import SEGMENTS_MANIFEST_SUFFIX, WRITER_LOCK_SUFFIX
+from task_Yaropolov_Oleg_inverted_index import Tokenizer
+import random
+import subprocess
+import sys
+import threading
+from storage_policy import STORAGE_POLICIES, StoragePolicy, register_storage_policy, CompressedPostings, MappedPostings, PerfectHashPostings, encode_postings
+
+SEARCH_QUERIES = "wikipedia_search_queries.txt"
+STOP_WORDS = "stop_words_en.txt"
 # import task_Yaropolov_Oleg_inverted_index
 
 SAMPLE_DOCUMENTS_FOR_TESTING = "test_tiny_inverted_index_sample.txt"
@@ -29,11 +50,51 @@ def test_building_method_on_trivial_example():
     expected_dict = {'one': [1],
                      'two': [1,2],
                      'three': [1,2],
-                     'four': [2],
-                     '': [1]}
+                     'four': [2]}
     inverted_index = build_inverted_index(example_documents)
     assert expected_dict == inverted_index.data
     
+def test_compact_building_stores_arrays():
+    example_documents = {1: "one two three. !",
+                         2: "two three. four"}
+    inverted_index = build_compact_inverted_index(example_documents)
+    assert array('I', [1, 2]) == inverted_index.data['two']
+    assert build_inverted_index(example_documents) == inverted_index
+
+@pytest.mark.parametrize(
+    "strategy",
+    [
+        pytest.param('json', id='json'),
+        pytest.param('struct', id='struct'),
+    ]
+)
+def test_compact_dump_is_byte_identical(strategy, tmpdir, testing_sample_documents):
+    build_inverted_index(testing_sample_documents).dump(tmpdir.join("lists"), strategy)
+    build_compact_inverted_index(testing_sample_documents).dump(tmpdir.join("arrays"), strategy)
+    assert tmpdir.join("lists").read_binary() == tmpdir.join("arrays").read_binary()
+
+def test_iterate_documents_is_lazy():
+    documents_stream = iterate_documents(SAMPLE_DOCUMENTS_FOR_TESTING)
+    document_index, words = next(documents_stream)
+    assert 12 == document_index
+    assert ["anarchism", "anarchism", "is"] == words[:3]
+    assert [290] == [document_index for document_index, _ in documents_stream]
+
+def test_streaming_build_matches_loaded_documents(testing_sample_documents):
+    streamed_index = build_inverted_index_from_stream(iterate_documents(SAMPLE_DOCUMENTS_FOR_TESTING))
+    assert build_inverted_index(testing_sample_documents) == streamed_index
+
+@pytest.mark.benchmark
+def test_compact_building_scales_linearly():
+    def build_time(documents_count):
+        documents = {index: f"common word{index}" for index in range(documents_count)}
+        return min(repeat(lambda: build_compact_inverted_index(documents), number=1, repeat=3))
+
+    small_time, large_time = build_time(20_000), build_time(80_000)
+    assert large_time / small_time <= 8, (
+        f"4x more documents took {large_time / small_time:.1f}x more time"
+    )
+
 def test_load_method_trivial_example(testing_sample_documents):
     s_12 = "Anarchism         Anarchism is often defined as a political philosophy which holds the state to be undesirable, unnecessary, or harmful.          The following sources cite anarchism as a political philosophy:      Slevin, Carl. \"Anarchism.\""
     s_290 = "A         A (named a  , plural aes ) is the first letter and vowel in the ISO basic Latin alphabet. It is similar to the Ancient Greek letter alpha, from which it derives. OriginsThe earliest certain ancestor of A is aleph (also called 'aleph), the first letter of the Phoenician alphabet  (which, by consisting entirely of consonants, is an abjad rather than a true alphabet). In turn, the origin of aleph may have been a pictogram of an ox head in Egyptian hieroglyphs, styled as a triangular head with 2 horns extended. Egyptian  Phoenician  aleph Greek  Alpha Etruscan  A Roman/Cyrillic  A        In 1600 B.C.E., the Phoenician alphabet's letter had a linear form that served as the base for some later forms. Its name must have corresponded closely to the Hebrew or Arabic aleph.  Blackletter A  Uncial A  Another Blackletter A    Modern Roman A  Modern Italic A  Modern Script A When the ancient Greeks adopted the alphabet, they had no use for the glottal stop—the first phoneme of the Phoenician pronunciation of the letter, and the sound that the letter denoted in Phoenician and other Semitic languages—so they used an adaptation of the sign to represent the vowel  , and gave it the similar name of alpha. In the earliest Greek inscriptions after the Greek Dark Ages, dating to the 8th century BC, the letter rests upon its side, but in the Greek alphabet of later times it generally resembles the modern capital letter, although many local varieties can be distinguished by the shortening of one leg, or by the angle at which the cross line is set.The Etruscans brought the Greek alphabet to their civilization in the Italian Peninsula and left the letter unchanged. The Romans later adopted the Etruscan alphabet to write the Latin language, and the resulting letter was preserved in the Latin alphabet used to write many languages, including English. During Roman times there were many variations on the letter A. First, was the monumental or lapidary style, which was used when inscribing on stone or other permanent mediums Α α : Greek letter Alpha А а : Cyrillic letter A   : Latin letter Alpha / Script A (or:    A a   )   : a turned lowercase letter A, used by the International Phonetic Alphabet for the near-open central vowel   : a turned capital letter A, used in predicate logic to specify universal quantification (for all)  ª  : an ordinal indicator Æ æ : Latin letter Æ ligature Computing codes   1    Other representations  References  External links    History of the Alphabet"
@@ -50,6 +111,10 @@ def test_load_method_trivial_example(testing_sample_documents):
     [
         pytest.param('json', id='json'),
         pytest.param('struct', id='struct'),
+        pytest.param('mmap', id='mmap'),
+        pytest.param('compressed', id='compressed'),
+        pytest.param('pickle', id='pickle'),
+        pytest.param('perfect', id='perfect'),
     ]
 )
 def test_dump_load(strategy, tmpdir, testing_inverted_index):
@@ -119,6 +184,9 @@ def test_several_queries_CLI(testing_inverted_index, capsys, tmpdir):
         pytest.param("struct", "queries_cp1251.txt", "cp1251", "12,290\n\n12\n\n\n", id="cp1251_struct"),
         pytest.param("json", "queries_utf8.txt", "utf-8", "12,290\n\n12\n\n\n", id="utf-8_json"),
         pytest.param("struct", "queries_utf8.txt", "utf-8", "12,290\n\n12\n\n\n", id="utf-8_struct"),
+        pytest.param("mmap", "queries_utf8.txt", "utf-8", "12,290\n\n12\n\n\n", id="utf-8_mmap"),
+        pytest.param("compressed", "queries_utf8.txt", "utf-8", "12,290\n\n12\n\n\n", id="utf-8_compressed"),
+        pytest.param("perfect", "queries_utf8.txt", "utf-8", "12,290\n\n12\n\n\n", id="utf-8_perfect"),
     ]
 )
 def test_process_query_from_file(strategy, query_filepath, query_encoding, expected_data, capsys, tmpdir, testing_inverted_index):
@@ -128,6 +196,30 @@ def test_process_query_from_file(strategy, query_filepath, query_encoding, expec
         captured = capsys.readouterr()
     assert captured.out == expected_data
 
+    with open(query_filepath, encoding = query_encoding) as query_fileio:
+        process_query(tmpdir.join(DUMPED_INDEX), strategy, None, query_fileio, batch=True)
+        captured = capsys.readouterr()
+    assert captured.out == expected_data
+    assert "cache hit ratio" in captured.err
+
+@pytest.mark.parametrize(
+    "query_text",
+    [
+        pytest.param("\n\n  \nis\n\nanarchism\n\n", id="leading_blank_lines"),
+        pytest.param("\n \n", id="blank_file"),
+    ]
+)
+def test_batch_query_file_is_parsed_like_whole_file(query_text, capsys, tmpdir, testing_inverted_index):
+    query_path = tmpdir.join("queries.txt")
+    query_path.write_text(query_text, encoding="utf-8")
+    testing_inverted_index.dump(tmpdir.join(DUMPED_INDEX), "json")
+    outputs = []
+    for batch in [False, True]:
+        with open(query_path, encoding="utf-8") as query_fileio:
+            process_query(tmpdir.join(DUMPED_INDEX), "json", None, query_fileio, batch=batch)
+        outputs.append(capsys.readouterr().out)
+    assert outputs[0] == outputs[1]
+
 
 
 @pytest.mark.parametrize(
@@ -135,6 +227,7 @@ def test_process_query_from_file(strategy, query_filepath, query_encoding, expec
     [
         pytest.param('json', id='json'),
         pytest.param('struct', id='struct'),
+        pytest.param('mmap', id='mmap'),
     ]
 )
 def test_process_build(strategy, tmpdir):
@@ -142,3 +235,558 @@ def test_process_build(strategy, tmpdir):
     assert 0 != os.stat(tmpdir.join(DUMPED_INDEX)).st_size
 
 
+
+@pytest.fixture
+def several_documents_dataset(tmpdir):
+    dataset_path = tmpdir.join("several_documents.txt")
+    dataset_path.write_text(
+        "3\tone two\n1\ttwo three\n\n7\tthree four one\n5\tFour five\n", encoding="utf-8"
+    )
+    return str(dataset_path)
+
+@pytest.mark.parametrize("parts", [1, 2, 3, 4, 100])
+def test_dataset_ranges_are_aligned_to_lines(parts, several_documents_dataset):
+    ranges = split_dataset_into_ranges(several_documents_dataset, parts)
+    assert len(ranges) <= parts
+    documents = [
+        document_index
+        for start, end in ranges
+        for document_index, _ in iterate_documents(several_documents_dataset, start, end)
+    ]
+    assert [3, 1, 7, 5] == documents
+
+def test_merged_shards_match_single_build(several_documents_dataset):
+    shards = [
+        build_shard(several_documents_dataset, start, end)
+        for start, end in split_dataset_into_ranges(several_documents_dataset, 3)
+    ]
+    assert all(isinstance(shard[2], array) for shard in shards)
+    merged_index = merge_shards(shards)
+    assert array('I', [3, 7]) == merged_index.data["one"]
+    assert array('I', [1, 3]) == merged_index.data["two"]
+    assert array('I', [5, 7]) == merged_index.data["four"]
+
+@pytest.mark.parametrize(
+    "strategy",
+    [
+        pytest.param('json', id='json'),
+        pytest.param('struct', id='struct'),
+    ]
+)
+def test_process_build_with_workers(strategy, tmpdir, testing_inverted_index):
+    process_build(strategy, SAMPLE_DOCUMENTS_FOR_TESTING, tmpdir.join(DUMPED_INDEX), workers=2)
+    assert testing_inverted_index == InvertedIndex.load(tmpdir.join(DUMPED_INDEX), strategy)
+
+def test_mapped_postings_are_zero_copy(tmpdir, testing_inverted_index):
+    testing_inverted_index.dump(tmpdir.join(DUMPED_INDEX), 'mmap')
+    mapped_postings = MappedPostings(tmpdir.join(DUMPED_INDEX))
+    postings = mapped_postings["is"]
+    assert isinstance(postings, memoryview)
+    assert [12, 290] == postings.tolist()
+    assert "wow" not in mapped_postings
+    assert sorted(testing_inverted_index.data) == list(mapped_postings)
+    postings.release()
+    mapped_postings.close()
+
+def test_mapped_postings_reject_other_formats(tmpdir, testing_inverted_index):
+    testing_inverted_index.dump(tmpdir.join(DUMPED_INDEX), 'struct')
+    with pytest.raises(ValueError):
+        MappedPostings(tmpdir.join(DUMPED_INDEX))
+    with pytest.raises(ValueError):
+        PerfectHashPostings(tmpdir.join(DUMPED_INDEX))
+
+def test_perfect_hash_postings_probe_one_slot(tmpdir):
+    index_as_dict = {f"слово{number}": [number, number + 7] for number in range(3000)}
+    InvertedIndex(index_as_dict).dump(tmpdir.join(DUMPED_INDEX), 'perfect')
+    perfect_postings = PerfectHashPostings(tmpdir.join(DUMPED_INDEX))
+    assert 3000 == len(perfect_postings)
+    assert sorted(index_as_dict) == sorted(perfect_postings)
+    postings = perfect_postings["слово42"]
+    assert isinstance(postings, memoryview)
+    assert [42, 49] == postings.tolist()
+    assert all(index_as_dict[word] == perfect_postings[word].tolist() for word in index_as_dict)
+    assert "слово3000" not in perfect_postings and "" not in perfect_postings
+    postings.release()
+    perfect_postings.close()
+
+def test_perfect_hash_index_rejects_words_with_the_same_hash(tmpdir):
+    with patch("task_Yaropolov_Oleg_perfect_hashing.stable_string_hash", lambda word: 7):
+        with pytest.raises(ValueError, match="same key"):
+            InvertedIndex({"one": [1], "two": [2]}).dump(tmpdir.join(DUMPED_INDEX), 'perfect')
+
+def test_inverted_index_does_not_import_perfect_hashing():
+    script = ("import sys, task_Yaropolov_Oleg_inverted_index; "
+              "print('task_Yaropolov_Oleg_perfect_hashing' in sys.modules, 'numpy' in sys.modules)")
+    assert "False False\n" == subprocess.run([sys.executable, "-c", script], capture_output=True,
+                                             text=True, check=True).stdout
+
+def test_perfect_hash_postings_of_empty_index(tmpdir):
+    InvertedIndex({}).dump(tmpdir.join(DUMPED_INDEX), 'perfect')
+    perfect_postings = PerfectHashPostings(tmpdir.join(DUMPED_INDEX))
+    assert 0 == len(perfect_postings) and [] == list(perfect_postings)
+    assert "wow" not in perfect_postings
+
+@pytest.mark.parametrize(
+    "target, low, expected_position",
+    [
+        pytest.param(1, 0, 0, id="first"),
+        pytest.param(9, 0, 4, id="present"),
+        pytest.param(10, 0, 5, id="absent"),
+        pytest.param(100, 0, 8, id="after the end"),
+        pytest.param(3, 5, 5, id="before low"),
+    ]
+)
+def test_gallop_to(target, low, expected_position):
+    postings = array('I', [1, 3, 5, 7, 9, 11, 13, 15])
+    assert expected_position == gallop_to(postings, target, low)
+
+def test_intersection_is_sorted_and_starts_from_rarest():
+    postings_lists = [
+        array('I', range(0, 1000, 2)),
+        [999, 998, 30, 6],
+        array('I', range(0, 1000, 3)),
+    ]
+    postings_lists[1].sort()
+    assert [6, 30] == intersect_postings(postings_lists)
+    assert [] == intersect_postings([[1, 2], [3, 4]])
+    assert [] == intersect_postings([])
+
+def test_streaming_build_sorts_postings():
+    inverted_index = build_inverted_index_from_stream([(7, ["one"]), (2, ["one", "two"]), (5, ["one"])])
+    assert array('I', [2, 5, 7]) == inverted_index.data["one"]
+    assert [2] == inverted_index.query(["two", "one"])
+
+def test_compressed_postings_support_32_bit_ids():
+    postings = array('I', [0, 1, 300, 65535, 65536, 70000, 2 ** 32 - 1])
+    compressed_postings = CompressedPostings(len(postings), memoryview(encode_postings(postings)))
+    assert len(postings) == len(compressed_postings)
+    assert list(postings) == list(compressed_postings)
+
+def test_compressed_cursor_decodes_only_needed_blocks():
+    postings = array('I', range(0, 100_000, 3))
+    compressed_postings = CompressedPostings(len(postings), memoryview(encode_postings(postings)))
+    with patch.object(CompressedPostings, "decode_block", autospec=True,
+                      side_effect=CompressedPostings.decode_block) as decode_block:
+        assert [3, 99_999] == intersect_postings([compressed_postings, [2, 3, 99_999, 100_000]])
+    assert 2 == decode_block.call_count
+
+def test_compressed_index_is_smaller_than_struct(tmpdir):
+    inverted_index = build_inverted_index_from_stream(
+        (document_index, ["common", f"word{document_index % 100}"]) for document_index in range(60_000)
+    )
+    inverted_index.dump(tmpdir.join("struct"), 'struct')
+    inverted_index.dump(tmpdir.join("compressed"), 'compressed')
+    assert os.stat(tmpdir.join("compressed")).st_size < os.stat(tmpdir.join("struct")).st_size
+    assert inverted_index == InvertedIndex.load(tmpdir.join("compressed"), 'compressed')
+
+def build_search_queries_index():
+    with open(SEARCH_QUERIES, encoding="utf-8") as fin:
+        queries = [list(set(re.split(r"\W+", line.strip()))) for line in fin if line.strip()]
+    query_words = sorted({word for query in queries for word in query})
+    documents_count = 200_000
+    inverted_index = build_inverted_index_from_stream(
+        (document_index, [
+            word for rank, word in enumerate(query_words)
+            if document_index % (rank + 1) ** 2 == 0 or word == "python"
+        ])
+        for document_index in range(documents_count)
+    )
+
+    def run_queries(intersect):
+        return [
+            intersect([inverted_index.data.get(word, []) for word in query])
+            for query in queries
+        ]
+    return run_queries
+
+@pytest.mark.slow
+def test_intersection_on_search_queries():
+    run_queries = build_search_queries_index()
+    assert [sorted(found) for found in run_queries(intersect_postings_with_sets)] == run_queries(intersect_postings)
+
+@pytest.mark.benchmark
+def test_intersection_benchmark_on_search_queries(record_property):
+    run_queries = build_search_queries_index()
+    record_property("set_based_time", min(repeat(lambda: run_queries(intersect_postings_with_sets), number=1, repeat=3)))
+    record_property("galloping_time", min(repeat(lambda: run_queries(intersect_postings), number=1, repeat=3)))
+
+def test_storage_policies_are_registered():
+    assert {"json", "struct", "pickle", "mmap", "compressed", "perfect"} <= set(STORAGE_POLICIES)
+    assert all(name == policy.name for name, policy in STORAGE_POLICIES.items())
+
+def test_incomplete_storage_policy_is_rejected():
+    class DumpOnlyStoragePolicy(StoragePolicy):
+        @staticmethod
+        def dump(word_to_docs_mapping, filepath):
+            pass
+
+    with pytest.raises(TypeError):
+        DumpOnlyStoragePolicy()
+    with pytest.raises(TypeError, match="does not implement load"):
+        register_storage_policy("dump-only")(DumpOnlyStoragePolicy)
+    assert "dump-only" not in STORAGE_POLICIES
+
+def test_storage_benchmark_reports_every_policy(tmpdir, capsys):
+    reports = process_benchmark(SAMPLE_DOCUMENTS_FOR_TESTING, tmpdir)
+    assert sorted(STORAGE_POLICIES) == [report.name for report in reports]
+    assert all(report.file_size == os.stat(tmpdir.join(f"inverted_index.{report.name}")).st_size
+               for report in reports)
+    assert len(reports) == len(capsys.readouterr().out.strip().split("\n"))
+
+def test_storage_measure_closes_mapped_files(tmpdir):
+    index_as_dict = build_inverted_index(load_documents(SAMPLE_DOCUMENTS_FOR_TESTING)).data
+    for policy_name, postings_class in [("mmap", MappedPostings), ("perfect", PerfectHashPostings)]:
+        with patch.object(postings_class, "close", autospec=True, side_effect=postings_class.close) as close:
+            STORAGE_POLICIES[policy_name].measure(index_as_dict, tmpdir.join(policy_name))
+        close.assert_called_once()
+
+def test_query_server_answers_like_query_command(tmpdir, testing_inverted_index):
+    socket_path = str(tmpdir.join("inverted_index.sock"))
+    query_server = QueryServer(testing_inverted_index, batch_size=4)
+
+    async def run_clients():
+        server = await query_server.start(socket_path)
+        connections = [await asyncio.open_unix_connection(socket_path) for _ in range(3)]
+        for reader, writer in connections:
+            writer.write(b"is\nwow\nanarchism\nis, wow\n")
+        responses = []
+        for reader, writer in connections:
+            responses.append([(await reader.readline()).decode() for _ in range(4)])
+            writer.close()
+        await query_server.stop(server)
+        return responses
+
+    responses = asyncio.run(run_clients())
+    assert [["12,290\n", "\n", "12\n", "\n"]] * 3 == responses
+    assert 12 == query_server.requests_count
+    p50, p99 = query_server.latency_percentiles()
+    assert 0 < p50 <= p99
+
+def test_query_server_survives_failed_queries_and_cancelled_requests(tmpdir, testing_inverted_index):
+    socket_path = str(tmpdir.join("inverted_index.sock"))
+    query_server = QueryServer(testing_inverted_index, batch_size=4)
+    original_query = testing_inverted_index.query
+
+    def failing_query(words):
+        if "boom" in words:
+            raise RuntimeError("broken postings")
+        return original_query(words)
+
+    async def run_client():
+        server = await query_server.start(socket_path)
+        cancelled_response = asyncio.get_running_loop().create_future()
+        cancelled_response.cancel()
+        await query_server._requests.put(("is", cancelled_response, perf_counter()))
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b"boom\nis\n")
+        responses = [(await reader.readline()).decode() for _ in range(2)]
+        writer.close()
+        batches_task = query_server._batches_task
+        await query_server.stop(server)
+        return responses, batches_task
+
+    with patch.object(testing_inverted_index, "query", side_effect=failing_query):
+        responses, batches_task = asyncio.run(run_client())
+    assert ["error: RuntimeError('broken postings')\n", "12,290\n"] == responses
+    assert batches_task.cancelled()
+
+def test_batch_queries_reuse_cache_and_prefixes(testing_inverted_index):
+    cache = QueryResultCache(max_size=10)
+    assert (12,) == query_with_cache(testing_inverted_index, ["is", "anarchism"], cache)
+    assert (12,) == query_with_cache(testing_inverted_index, ["anarchism", "is", "anarchism"], cache)
+    assert (1, 1, 0) == (cache.hits, cache.misses, cache.prefix_hits)
+    assert (12,) == query_with_cache(testing_inverted_index, ["anarchism", "is", "a"], cache)
+    assert 1 == cache.prefix_hits
+    assert () == query_with_cache(testing_inverted_index, ["anarchism", "wow"], cache)
+    assert (12,) == query_with_cache(testing_inverted_index, ["a", "is", "anarchism"], cache)
+    assert 0.5 == cache.hit_ratio
+
+def test_query_cache_is_bounded():
+    cache = QueryResultCache(max_size=2)
+    cache.put(("one",), (1,))
+    cache.put(("two",), (2,))
+    cache.get(("one",))
+    cache.put(("three",), (3,))
+    assert 2 == len(cache)
+    assert cache.get(("two",)) is None
+    assert (1,) == cache.get(("one",))
+
+def test_delta_segments_and_tombstones_are_merged_at_query_time():
+    inverted_index = build_inverted_index_from_stream([(1, ["one", "two"]), (3, ["two"])])
+    inverted_index.add_documents([(2, ["one"]), (4, ["one", "two"])])
+    assert [1, 2, 4] == inverted_index.query(["one"])
+    inverted_index.delete_documents([1, 4])
+    inverted_index.add_documents([(4, ["two"])])
+    assert [2] == inverted_index.query(["one"])
+    assert [3, 4] == inverted_index.query(["two"])
+    compacted_index = inverted_index.compact()
+    assert {"one": [2], "two": [3, 4]} == {word: list(postings) for word, postings in compacted_index.data.items()}
+
+@pytest.mark.parametrize(
+    "strategy",
+    [
+        pytest.param('json', id='json'),
+        pytest.param('mmap', id='mmap'),
+        pytest.param('compressed', id='compressed'),
+        pytest.param('perfect', id='perfect'),
+    ]
+)
+def test_update_and_compact_index_files(strategy, tmpdir, several_documents_dataset):
+    index_path = str(tmpdir.join(DUMPED_INDEX))
+    process_build(strategy, several_documents_dataset, index_path)
+    added_dataset = tmpdir.join("added.txt")
+    added_dataset.write_text("9\tone six\n5\tfive only\n", encoding="utf-8")
+
+    update_index(index_path, strategy, iterate_documents(str(added_dataset)), [3, 5])
+    assert [7, 9] == InvertedIndex.load(index_path, strategy).query(["one"])
+    assert [5] == InvertedIndex.load(index_path, strategy).query(["five"])
+    assert [] == InvertedIndex.load(index_path, strategy).query(["four", "five"])
+    base_size = os.stat(index_path).st_size
+
+    start_background_compaction(index_path, strategy).join()
+    manifest = load_segments_manifest(index_path)
+    compacted_base_name = manifest["base"]
+    assert DUMPED_INDEX == manifest["obsolete"][0] and 2 == len(manifest["obsolete"])
+    assert {compacted_base_name, DUMPED_INDEX + SEGMENTS_MANIFEST_SUFFIX, DUMPED_INDEX + WRITER_LOCK_SUFFIX,
+            *manifest["obsolete"]} == {
+        path.basename for path in tmpdir.listdir() if path.basename.startswith(DUMPED_INDEX)
+    }
+    assert base_size != os.stat(tmpdir.join(compacted_base_name)).st_size
+    compacted_index = InvertedIndex.load(index_path, strategy)
+    assert not compacted_index.segments and not compacted_index.deleted_documents
+    assert [7, 9] == compacted_index.query(["one"])
+    assert [5] == compacted_index.query(["five"])
+
+    process_build(strategy, several_documents_dataset, index_path)
+    assert {DUMPED_INDEX, DUMPED_INDEX + WRITER_LOCK_SUFFIX} == {
+        path.basename for path in tmpdir.listdir() if path.basename.startswith(DUMPED_INDEX)
+    }
+    assert [5] == InvertedIndex.load(index_path, strategy).query(["four", "five"])
+
+def test_readers_of_old_manifest_survive_compaction(tmpdir, several_documents_dataset):
+    index_path = str(tmpdir.join(DUMPED_INDEX))
+    process_build("mmap", several_documents_dataset, index_path)
+    update_index(index_path, "mmap", [(9, ["one", "six"])], [3])
+    old_manifest = load_segments_manifest(index_path)
+    compact_index(index_path, "mmap")
+    expected = InvertedIndex.load(index_path, "mmap").query(["one"])
+    assert expected == InvertedIndex.load(index_path, "mmap", old_manifest).query(["one"])
+
+    update_index(index_path, "mmap", [(10, ["ten"])])
+    compact_index(index_path, "mmap")
+    assert not os.path.exists(index_path)
+    with pytest.raises(FileNotFoundError):
+        InvertedIndex.load(index_path, "mmap", old_manifest)
+    manifests = [old_manifest]
+    with patch("task_Yaropolov_Oleg_inverted_index.load_segments_manifest",
+               side_effect=lambda path: manifests.pop() if manifests else load_segments_manifest(path)):
+        assert expected == InvertedIndex.load(index_path, "mmap").query(["one"])
+    assert [10] == InvertedIndex.load(index_path, "mmap").query(["ten"])
+
+def test_index_with_frequencies_or_positions_is_not_compacted(tmpdir, several_documents_dataset):
+    index_path = str(tmpdir.join(DUMPED_INDEX))
+    for options in [{"with_frequencies": True}, {"with_positions": True}]:
+        process_build("mmap", several_documents_dataset, index_path, **options)
+        update_index(index_path, "mmap", [(9, ["one", "six"])], [3])
+        manifest = load_segments_manifest(index_path)
+        with pytest.raises(ValueError, match="compaction cannot rebuild"):
+            compact_index(index_path, "mmap")
+        assert manifest == load_segments_manifest(index_path)
+        process = subprocess.run(
+            [sys.executable, "task_Yaropolov_Oleg_inverted_index.py", "compact", "-i", index_path, "-s", "mmap"],
+            capture_output=True, text=True,
+        )
+        assert 2 == process.returncode and "compaction cannot rebuild" in process.stderr
+        assert "Traceback" not in process.stderr
+        inverted_index = InvertedIndex.load(index_path, "mmap")
+        assert [9] == inverted_index.query(["six"])
+        assert (inverted_index.ranking_data is not None) == ("with_frequencies" in options)
+        assert (inverted_index.positional_index is not None) == ("with_positions" in options)
+        for suffix in [".frequencies", ".positions"]:
+            if os.path.exists(index_path + suffix):
+                os.remove(index_path + suffix)
+
+def test_query_applies_segments_and_tombstones_without_merging_base():
+    random_generator = random.Random(10)
+    vocabulary = ["one", "two", "three", "four"]
+    def random_documents(document_indexes):
+        return [(document_index, random_generator.sample(vocabulary, random_generator.randint(1, 3)))
+                for document_index in document_indexes]
+    inverted_index = build_inverted_index_from_stream(random_documents(range(0, 300, 2)))
+    for _ in range(4):
+        inverted_index.delete_documents(random_generator.sample(range(300), 30))
+        inverted_index.add_documents(random_documents(random_generator.sample(range(300), 20)))
+    queries = [["one"], ["one", "two"], ["two", "three", "four"], ["four", "missing"], []]
+    expected = []
+    for words in queries:
+        postings_lists = [inverted_index.postings(word) for word in words]
+        expected.append([] if None in postings_lists else intersect_postings(postings_lists))
+    with patch.object(InvertedIndex, "postings", side_effect=AssertionError("base postings are merged")):
+        assert expected == [inverted_index.query(words) for words in queries]
+        cache = QueryResultCache()
+        assert expected == [list(query_with_cache(inverted_index, words, cache)) for words in queries]
+
+def test_concurrent_updates_and_compaction_are_not_lost(tmpdir, several_documents_dataset):
+    index_path = str(tmpdir.join(DUMPED_INDEX))
+    process_build("compressed", several_documents_dataset, index_path)
+    update_index(index_path, "compressed", [(5, ["five", "again"])], [5])
+
+    def update_during_compaction(compacted_index):
+        updates = [
+            threading.Thread(target=update_index, args=(index_path, "compressed", [(100 + number, ["added"])]))
+            for number in range(8)
+        ]
+        for update in updates:
+            update.start()
+        for update in updates:
+            update.join()
+        return original_compact(compacted_index)
+
+    original_compact = InvertedIndex.compact
+    with patch.object(InvertedIndex, "compact", update_during_compaction):
+        compact_index(index_path, "compressed")
+    inverted_index = InvertedIndex.load(index_path, "compressed")
+    assert 8 == len(inverted_index.segments)
+    assert list(range(100, 108)) == inverted_index.query(["added"])
+    assert [5] == inverted_index.query(["five", "again"])
+    assert [] == inverted_index.query(["four", "five"])
+
+def brute_force_bm25(inverted_index, words, top_k):
+    ranking_data = inverted_index.ranking_data
+    scores = {}
+    for word in set(words):
+        postings = inverted_index.data.get(word, [])
+        idf = ranking_data.idf(len(postings))
+        for document_index, frequency in zip(postings, ranking_data.frequencies.get(word, [])):
+            scores[document_index] = scores.get(document_index, 0.0) + idf * ranking_data.term_weight(frequency, document_index)
+    return sorted(scores, key=lambda document_index: (-scores[document_index], document_index))[:top_k]
+
+def test_bm25_top_k_matches_exhaustive_ranking():
+    random_generator = random.Random(42)
+    vocabulary = [f"word{rank}" for rank in range(50)]
+    weights = [1 / (rank + 1) for rank in range(50)]
+    inverted_index = build_inverted_index_from_stream(
+        ((document_index, random_generator.choices(vocabulary, weights, k=random_generator.randint(1, 30)))
+         for document_index in range(2000)),
+        with_frequencies=True,
+    )
+    for query in [["word0"], ["word0", "word1"], ["word3", "word17", "word40"], ["word49", "missing"]]:
+        for top_k in [1, 5, 50]:
+            expected = brute_force_bm25(inverted_index, query, top_k)
+            assert expected == inverted_index.rank_query(query, top_k), (query, top_k)
+
+def test_bm25_query_from_cli(tmpdir, capsys):
+    process_build("compressed", SAMPLE_DOCUMENTS_FOR_TESTING, tmpdir.join(DUMPED_INDEX), with_frequencies=True)
+    capsys.readouterr()
+    process_query(tmpdir.join(DUMPED_INDEX), "compressed", [["anarchism", "alphabet"], ["wow"]], None,
+                  rank="bm25", top_k=1)
+    assert "12\n\n" == capsys.readouterr().out
+    inverted_index = InvertedIndex.load(tmpdir.join(DUMPED_INDEX), "compressed")
+    assert [12, 290] == inverted_index.rank_query(["anarchism", "alphabet"], 2)
+    inverted_index.delete_documents([12])
+    assert [290] == inverted_index.rank_query(["anarchism", "alphabet"], 2)
+
+def test_ranking_data_and_positions_are_memory_mapped(tmpdir):
+    random_generator = random.Random(7)
+    vocabulary = [f"word{rank}" for rank in range(30)]
+    inverted_index = build_inverted_index_from_stream(
+        ((document_index, random_generator.choices(vocabulary, k=random_generator.randint(1, 20)))
+         for document_index in random_generator.sample(range(10 ** 6), 500)),
+        with_frequencies=True, with_positions=True,
+    )
+    inverted_index.dump(tmpdir.join(DUMPED_INDEX), "mmap")
+    loaded_index = InvertedIndex.load(tmpdir.join(DUMPED_INDEX), "mmap")
+    assert isinstance(loaded_index.ranking_data.frequencies, MappedPostings)
+    assert isinstance(loaded_index.positional_index.positions, MappedPostings)
+    assert inverted_index.ranking_data.average_length == loaded_index.ranking_data.average_length
+    assert dict(inverted_index.ranking_data.document_lengths) == dict(loaded_index.ranking_data.document_lengths)
+    assert inverted_index.ranking_data.upper_bounds == dict(loaded_index.ranking_data.upper_bounds)
+    for query in [["word0"], ["word1", "word2"], ["word3", "word4", "word5"], ["word6", "missing"]]:
+        assert inverted_index.rank_query(query, 20) == loaded_index.rank_query(query, 20)
+        assert inverted_index.phrase_query(query) == loaded_index.phrase_query(query)
+    for suffix in [".frequencies", ".positions"]:
+        with open(tmpdir.join(DUMPED_INDEX + suffix), "wb") as fout:
+            fout.write(bytes(100))
+        with pytest.raises(ValueError):
+            InvertedIndex.load(tmpdir.join(DUMPED_INDEX), "mmap")
+        os.remove(tmpdir.join(DUMPED_INDEX + suffix))
+
+def test_parallel_build_with_frequencies_is_usage_error(tmpdir):
+    for option in ["--with-frequencies", "--with-positions"]:
+        process = subprocess.run(
+            [sys.executable, "task_Yaropolov_Oleg_inverted_index.py", "build", "-d", SAMPLE_DOCUMENTS_FOR_TESTING,
+             "-o", str(tmpdir.join(DUMPED_INDEX)), "-w", "2", option],
+            capture_output=True, text=True,
+        )
+        assert 2 == process.returncode
+        assert f"error: {option} is supported by single worker build only" in process.stderr
+        assert "Traceback" not in process.stderr
+
+def test_tokenizer_drops_empty_and_stop_words():
+    tokenizer = Tokenizer.from_stop_words_file(STOP_WORDS)
+    assert ["anarchism", "political", "philosophy"] == tokenizer.tokenize("anarchism is a political philosophy!")
+    assert ["is", "a"] == Tokenizer().tokenize("  is a  !")
+    assert [] == tokenizer.tokenize("")
+
+def test_tokenizer_interns_words():
+    tokenizer = Tokenizer(intern_words=True)
+    first_word, = tokenizer.tokenize("".join(["py", "thon"]))
+    second_word, = tokenizer.tokenize("python!")
+    assert first_word is second_word
+
+def test_stop_words_are_not_indexed_nor_queried(tmpdir, capsys):
+    process_build("json", SAMPLE_DOCUMENTS_FOR_TESTING, tmpdir.join(DUMPED_INDEX), stop_words_path=STOP_WORDS)
+    inverted_index = InvertedIndex.load(tmpdir.join(DUMPED_INDEX), "json")
+    assert "is" not in inverted_index.data and "" not in inverted_index.data
+    capsys.readouterr()
+    process_query(tmpdir.join(DUMPED_INDEX), "json", [["is", "anarchism"], ["is"]], None, stop_words_path=STOP_WORDS)
+    assert "12\n\n" == capsys.readouterr().out
+
+def test_phrase_query_matches_adjacent_words_only():
+    documents = {
+        3: "python network programming",
+        1: "network of python snakes",
+        7: "python python network",
+        5: "network python network",
+    }
+    inverted_index = build_inverted_index(documents, with_positions=True)
+    assert [3, 5, 7] == inverted_index.phrase_query(["python", "network"])
+    assert [5] == inverted_index.phrase_query(["network", "python"])
+    assert [1] == inverted_index.phrase_query(["of", "python", "snakes"])
+    assert [7] == inverted_index.phrase_query(["python", "python"])
+    assert [5] == inverted_index.phrase_query(["network", "python", "network"])
+    assert [] == inverted_index.phrase_query(["python", "missing"])
+    assert [1, 3, 5, 7] == inverted_index.phrase_query(["network"])
+    inverted_index.delete_documents([5])
+    assert [3, 7] == inverted_index.phrase_query(["python", "network"])
+    with pytest.raises(ValueError):
+        build_inverted_index(documents).phrase_query(["python"])
+
+def test_phrase_query_matches_brute_force():
+    random_generator = random.Random(13)
+    vocabulary = [f"word{rank}" for rank in range(8)]
+    documents = {
+        document_index: random_generator.choices(vocabulary, k=random_generator.randint(1, 40))
+        for document_index in random_generator.sample(range(1000), 300)
+    }
+    inverted_index = build_inverted_index_from_stream(documents.items(), with_positions=True)
+    for phrase in [["word0", "word1"], ["word2", "word2", "word3"], ["word5"], ["word7", "word6", "word5", "word4"]]:
+        expected = [
+            document_index for document_index, words in sorted(documents.items())
+            if any(words[start:start + len(phrase)] == phrase for start in range(len(words)))
+        ]
+        assert expected == inverted_index.phrase_query(phrase), phrase
+
+def test_phrase_query_from_cli(tmpdir, capsys):
+    process_build("mmap", SAMPLE_DOCUMENTS_FOR_TESTING, tmpdir.join(DUMPED_INDEX), with_positions=True)
+    assert os.path.exists(tmpdir.join(DUMPED_INDEX + ".positions"))
+    inverted_index = InvertedIndex.load(tmpdir.join(DUMPED_INDEX), "mmap")
+    documents = load_documents(SAMPLE_DOCUMENTS_FOR_TESTING)
+    expected = [document_index for document_index in sorted(documents) if "political philosophy" in documents[document_index]]
+    assert expected and expected == inverted_index.phrase_query(["political", "philosophy"])
+    capsys.readouterr()
+    process_query(tmpdir.join(DUMPED_INDEX), "mmap", [["political", "philosophy"], ["philosophy", "political"]], None,
+                  phrase=True)
+    assert f"{','.join(map(str, expected))}\n\n" == capsys.readouterr().out
+    with pytest.raises(ValueError):
+        process_build("json", SAMPLE_DOCUMENTS_FOR_TESTING, tmpdir.join(DUMPED_INDEX), workers=2, with_positions=True)
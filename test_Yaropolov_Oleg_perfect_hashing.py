@@ -1,7 +1,17 @@
+import array
+import os
+import random
+import subprocess
+import sys
+import numpy as np
 import pytest
 from timeit import timeit
+from unittest.mock import patch
 
-from task_Yaropolov_Oleg_perfect_hashing import HashTablePerfect, HashTableChain
+from task_Yaropolov_Oleg_perfect_hashing import HashTablePerfect, HashTableChain, stable_string_hash
+from task_Yaropolov_Oleg_perfect_hashing import HashTableOpenAddressing, MIN_INT, benchmark_hash_tables
+from total_size_recipe import getsize
+import perfect_hashing
 
 COLLECTION_PATH = "bad_input.txt"
 
@@ -30,4 +40,158 @@ def test_chain_hash_is_not_stable(data_for_testing):
     fast_time = timeit(lambda: fast_key in hash_table)
     slow_time = timeit(lambda: slow_key in hash_table)
     assert slow_time / fast_time >= 30
-    
\ No newline at end of file
+    
+def test_stable_string_hash_does_not_depend_on_hash_seed():
+    script = "from task_Yaropolov_Oleg_perfect_hashing import stable_string_hash; print(stable_string_hash('python'))"
+    outputs = {
+        subprocess.run([sys.executable, "-c", script], env={**os.environ, "PYTHONHASHSEED": seed},
+                       capture_output=True, text=True, check=True).stdout
+        for seed in ["1", "2"]
+    }
+    assert {f"{stable_string_hash('python')}\n"} == outputs
+    assert stable_string_hash("python") != stable_string_hash("nohtyp")
+
+def test_perfect_hash_over_strings():
+    words = [f"word{number}" for number in range(20000)]
+    hash_table = HashTablePerfect(words, key_function=stable_string_hash)
+    assert all(word in hash_table for word in words)
+    assert not any(f"missing{number}" in hash_table for number in range(1000))
+    assert len(hash_table.slots) <= 4 * len(words)
+
+def test_perfect_hash_rejects_distinct_elements_with_the_same_key():
+    hash_table = HashTablePerfect(["ab", "ab", "abc"], key_function=len)
+    assert "ab" in hash_table and "abc" in hash_table
+    with pytest.raises(ValueError, match="same key"):
+        HashTablePerfect(["ab", "cd"], key_function=len)
+
+def test_perfect_hash_over_random_ints():
+    collection = random.sample(range(-10 ** 9, 10 ** 9), 10000)
+    hash_table = HashTablePerfect(collection)
+    assert all(element in hash_table for element in collection)
+    assert sum(element in hash_table for element in range(10 ** 4)) == len(set(collection) & set(range(10 ** 4)))
+    assert 1 not in HashTablePerfect([])
+
+def test_vectorized_perfect_hash_matches_membership():
+    random_generator = np.random.default_rng(15)
+    collection = random_generator.choice(2 * 10 ** 9, 100000, replace=False) - 10 ** 9
+    hash_table = HashTablePerfect(collection, vectorized=True)
+    assert hash_table.contains_many(collection).all()
+    queries = random_generator.integers(-10 ** 9, 10 ** 9, 10000)
+    assert (np.isin(queries, collection) == hash_table.contains_many(queries)).all()
+    assert all(int(element) in hash_table for element in collection[:1000])
+    assert len(hash_table.slots) <= 4 * len(collection)
+
+def test_contains_many_of_python_built_tables():
+    collection = list(range(0, 3000, 3))
+    for hash_table in [HashTablePerfect(collection), HashTablePerfect(collection + collection, vectorized=True)]:
+        assert [0 <= element < 3000 and element % 3 == 0 for element in range(-10, 3010)] == hash_table.contains_many(range(-10, 3010)).tolist()
+    words = [f"word{number}" for number in range(100)]
+    hash_table = HashTablePerfect(words, key_function=stable_string_hash)
+    assert [True, False] == hash_table.contains_many(["word7", "word100"]).tolist()
+    assert not HashTablePerfect([], vectorized=True).contains_many([1]).any()
+
+def test_vectorized_build_succeeds_on_last_second_level_trial():
+    with patch("task_Yaropolov_Oleg_perfect_hashing.MAX_SECOND_LEVEL_TRIALS", 1):
+        hash_table = HashTablePerfect(np.array([42]), vectorized=True)
+    assert 42 in hash_table and 43 not in hash_table
+
+@pytest.mark.benchmark
+def test_vectorized_build_is_faster():
+    collection = np.random.default_rng(0).choice(2 * 10 ** 9, 10 ** 6, replace=False)
+    python_time = timeit(lambda: HashTablePerfect(collection.tolist()), number=1)
+    vectorized_time = timeit(lambda: HashTablePerfect(collection, vectorized=True), number=1)
+    assert vectorized_time < python_time
+
+def test_perfect_hash_save_and_load_with_mmap(tmpdir):
+    collection = random.sample(range(-10 ** 9, 10 ** 9), 5000)
+    for hash_table in [HashTablePerfect(collection), HashTablePerfect(collection, vectorized=True)]:
+        hash_table.save(tmpdir.join("perfect_hash.bin"))
+        loaded_hash_table = HashTablePerfect.load(tmpdir.join("perfect_hash.bin"))
+        assert isinstance(loaded_hash_table.slots, memoryview)
+        assert all(element in loaded_hash_table for element in collection)
+        queries = list(range(10 ** 4))
+        assert hash_table.contains_many(queries).tolist() == loaded_hash_table.contains_many(queries).tolist()
+        loaded_hash_table.close()
+    words = ["python", "network", "perfect"]
+    HashTablePerfect(words, key_function=stable_string_hash).save(tmpdir.join("words.bin"))
+    loaded_hash_table = HashTablePerfect.load(tmpdir.join("words.bin"), key_function=stable_string_hash)
+    assert "network" in loaded_hash_table and "hash" not in loaded_hash_table
+    loaded_hash_table.close()
+    with open(tmpdir.join("bad.bin"), "wb") as fout:
+        fout.write(bytes(100))
+    with pytest.raises(ValueError):
+        HashTablePerfect.load(tmpdir.join("bad.bin"))
+
+def test_flat_layout_takes_less_memory_than_bucket_arrays():
+    collection = random.sample(range(10 ** 9), 10000)
+    hash_table = HashTablePerfect(collection)
+    offsets, slots = hash_table.offsets, hash_table.slots
+    bucket_arrays = [
+        array.array("q", slots[offsets[bucket_number]:offsets[bucket_number + 1]])
+        for bucket_number in range(len(collection))
+    ]
+    bucket_counts = array.array("q", [0] * len(collection))
+    flat_size = getsize(hash_table)
+    assert 8 == slots.itemsize
+    assert len(slots) <= 4 * len(collection)
+    assert flat_size < getsize(bucket_arrays) + getsize(bucket_counts)
+    assert flat_size < 2 * slots.itemsize * 4 * len(collection)
+
+def test_template_hash_tables_contain_collection():
+    collection = random.sample(range(-10 ** 9, 10 ** 9), 10000)
+    queries, collection_set = collection[:1000] + list(range(1000)), set(collection)
+    for hash_table in [perfect_hashing.HashTableChain(collection), perfect_hashing.HashTablePerfect(collection)]:
+        assert all(element in hash_table for element in collection)
+        assert [query in collection_set for query in queries] == [query in hash_table for query in queries]
+    assert 1 not in perfect_hashing.HashTableChain([])
+    assert 1 not in perfect_hashing.HashTablePerfect([])
+
+def test_template_perfect_hash_statistics():
+    collection = random.sample(range(10 ** 9), 10000)
+    hash_table = perfect_hashing.HashTablePerfect(collection, max_trials_first_level=10)
+    statistics = hash_table.statistics
+    assert 1 <= statistics.first_level_trials <= 10
+    assert statistics.hash_function_counter == statistics.first_level_trials + sum(hash_table.hash_function_counter_per_bucket)
+    assert statistics.hash_function_counter <= 2 * len(collection)
+    assert all(
+        functions_count == 1
+        for functions_count, bucket_size in zip(hash_table.hash_function_counter_per_bucket, hash_table.counts)
+        if bucket_size == 1
+    )
+    assert len(collection) <= statistics.slots_count <= 4 * len(collection)
+    assert statistics.memory_size > statistics.slots_count * perfect_hashing.LONG_SIZE_IN_BYTES
+
+def test_template_perfect_hash_errors():
+    collection = list(range(0, 10 ** 6, 7))
+    with pytest.raises(perfect_hashing.PerfectHashFirstLevelError):
+        perfect_hashing.HashTablePerfect(collection, max_trials_first_level=0)
+    with pytest.raises(perfect_hashing.PerfectHashSecondLevelError):
+        perfect_hashing.HashTablePerfect(collection, max_hash_function_counter=10)
+    with pytest.raises(perfect_hashing.HashError):
+        perfect_hashing.HashTablePerfect(collection, max_hash_function_counter=1)
+
+def test_open_addressing_hash_table(data_for_testing):
+    collection = data_for_testing[2]
+    hash_table = HashTableOpenAddressing(collection)
+    assert all(element in hash_table for element in collection)
+    assert 2 * len(collection) <= len(hash_table.hash_table) < 4 * len(collection)
+    collection_set = set(collection)
+    assert [number in collection_set for number in range(-1000, 10 ** 5)] == [number in hash_table for number in range(-1000, 10 ** 5)]
+    assert MIN_INT not in hash_table
+    assert 1 in HashTableOpenAddressing([1, 1, 1]) and 0 not in HashTableOpenAddressing([])
+    with pytest.raises(ValueError):
+        HashTableOpenAddressing([1, MIN_INT])
+
+def test_benchmark_hash_tables_reports_every_table():
+    reports = benchmark_hash_tables(sizes=(100, 1000), lookups_count=1000)
+    assert [(name, size) for size in (100, 1000) for name in ("chain", "open addressing", "perfect")] == [
+        (report.name, report.keys_count) for report in reports
+    ]
+    assert all(report.build_time > 0 and report.lookups_per_second > 0 and report.memory_size > 0 for report in reports)
+
+@pytest.mark.slow
+def test_benchmark_hash_tables_memory():
+    reports = {(report.name, report.keys_count): report for report in benchmark_hash_tables(sizes=(10 ** 5, 10 ** 6))}
+    for size in (10 ** 5, 10 ** 6):
+        assert reports["open addressing", size].memory_size < reports["chain", size].memory_size
+        assert reports["perfect", size].memory_size < reports["chain", size].memory_size